@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+"""
+Compares batched and sequential inference of the CPU detector on pairs of frames
+(crosswalk + road, as in the main loop).
+
+python3 benchmark_detectors.py --model yolov4-tiny-416 --video video/cross_uma_02.webm --video2 video/car_uma_01.webm
+"""
+
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from utils import detectors
+
+
+def load_frames(path, count, width=640, height=480):
+    """
+    Reads frames from a video file, or generates random frames if there is no file
+    :param path: str, video file (or None)
+    :param count: int, number of frames
+    :return: list of BGR numpy frames
+    """
+    frames = []
+    if path:
+        cam = cv2.VideoCapture(path)
+        while len(frames) < count:
+            ok, frame = cam.read()
+            if not ok:
+                break
+            frames.append(frame)
+        cam.release()
+    rng = np.random.default_rng(0)
+    while len(frames) < count:
+        frames.append(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8))
+    return frames
+
+
+def run(detect_pair, crosswalk_frames, road_frames, warmup):
+    for i in range(min(warmup, len(crosswalk_frames))):
+        detect_pair(crosswalk_frames[i], road_frames[i])
+    start = time.time()
+    for crosswalk, road in zip(crosswalk_frames, road_frames):
+        detect_pair(crosswalk, road)
+    return len(crosswalk_frames) / (time.time() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default='yolov4-tiny-416', help='Darknet model in yolo/, or ONNX file name')
+    parser.add_argument('--video', default=None, help='crosswalk video (random frames if not given)')
+    parser.add_argument('--video2', default=None, help='road video (random frames if not given)')
+    parser.add_argument('--pairs', type=int, default=100, help='number of frame pairs')
+    parser.add_argument('--warmup', type=int, default=5, help='frame pairs run before timing')
+    parser.add_argument('--threads', type=int, default=0, help='OpenCV threads (0 = all cores)')
+    parser.add_argument('--conf', type=float, default=0.5, help='confidence threshold')
+    args = parser.parse_args()
+
+    net = detectors.load_detector('cpu_yolo', args.model, num_threads=args.threads)
+    crosswalk_frames = load_frames(args.video, args.pairs)
+    road_frames = load_frames(args.video2, args.pairs)
+
+    def sequential(crosswalk, road):
+        return net.detect(crosswalk, args.conf), net.detect(road, args.conf)
+
+    def batched(crosswalk, road):
+        return net.detect_batch([crosswalk, road], args.conf)
+
+    fps_sequential = run(sequential, crosswalk_frames, road_frames, args.warmup)
+    fps_batched = run(batched, crosswalk_frames, road_frames, args.warmup)
+
+    print('threads: %d (OpenCV reports %d)' % (args.threads, cv2.getNumThreads()))
+    print('sequential: %.2f pairs/s' % fps_sequential)
+    print('batched:    %.2f pairs/s (x%.2f)' % (fps_batched, fps_batched / fps_sequential))
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+
+"""
+Microbenchmarks of the tracking module.
+
+python3 benchmark_tracking.py costs
+python3 benchmark_tracking.py assignment --sizes 50 100 200 500 1000
+python3 benchmark_tracking.py suppression
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from utils import tracking
+
+
+def loop_costs_matrix(A, B, maximum_cost, value_to_use_as_inf):
+    """ Reference implementation: the former double loop of create_costs_matrix, plus the gating """
+    n = A.shape[0]
+    m = B.shape[0]
+    C = -1 * np.ones(shape=(n, m))
+    for i in range(n):
+        for j in range(m):
+            C[i, j] = np.linalg.norm(A[i] - B[j])
+    C[C > maximum_cost] = value_to_use_as_inf
+    return C
+
+
+def timeit(function, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        function()
+    return (time.perf_counter() - start) / repeat
+
+
+def bench_costs(sizes, repeat):
+    rng = np.random.default_rng(0)
+    print('%8s %14s %14s %14s %14s' % ('traces', 'loop (ms)', 'euclid (ms)', 'sqeuclid (ms)', 'iou (ms)'))
+    for n in sizes:
+        A = rng.uniform(0, 640, size=(n, 2))
+        B = A + rng.normal(0, 10, size=(n, 2))
+        boxes_A = np.concatenate([A - 20, A + 20], axis=1)
+        boxes_B = np.concatenate([B - 20, B + 20], axis=1)
+
+        reference = loop_costs_matrix(A, B, 200, 20000)
+        vectorized = tracking.create_costs_matrix(A, B, 'euclidean', 200, 20000)
+        assert np.allclose(reference, vectorized)
+
+        # the loop gets too slow for big sizes, fewer repetitions are enough
+        t_loop = timeit(lambda: loop_costs_matrix(A, B, 200, 20000), max(1, repeat // max(1, n // 10)))
+        t_euclid = timeit(lambda: tracking.create_costs_matrix(A, B, 'euclidean', 200, 20000), repeat)
+        t_sq = timeit(lambda: tracking.create_costs_matrix(A, B, 'sqeuclidean', 200 ** 2, 20000 * 200), repeat)
+        t_iou = timeit(lambda: tracking.create_costs_matrix(boxes_A, boxes_B, 'iou', 0.9, 20000), repeat)
+        print('%8d %14.3f %14.3f %14.3f %14.3f' % (n, t_loop * 1000, t_euclid * 1000, t_sq * 1000, t_iou * 1000))
+
+
+def dense_assignment(A, B, maximum_distance, value_to_use_as_inf):
+    """ Dense path of Tracker.assign_incomming_positions: accepted pairs of linear_sum_assignment on the whole matrix """
+    C = tracking.create_costs_matrix(A, B, 'euclidean', maximum_distance, value_to_use_as_inf)
+    rows, cols = linear_sum_assignment(C)
+    accepted = C[rows, cols] < maximum_distance
+    return rows[accepted], cols[accepted]
+
+
+def bench_assignment(sizes, repeat, maximum_distance, density):
+    """
+    Traces spread over an area that grows with their number (constant density, as pedestrians in a wider crosswalk),
+    detections moved from them plus some missed and some new ones.
+    """
+    rng = np.random.default_rng(0)
+    print('%8s %12s %14s %14s %10s' % ('traces', 'components', 'dense (ms)', 'sparse (ms)', 'speedup'))
+    for n in sizes:
+        side = np.sqrt(n / density)
+        A = rng.uniform(0, side, size=(n, 2))
+        B = A + rng.normal(0, maximum_distance / 4, size=(n, 2))
+        B = np.concatenate([B[rng.random(n) > 0.1], rng.uniform(0, side, size=(n // 10, 2))])
+        inf = maximum_distance * 100
+
+        dense_rows, dense_cols = dense_assignment(A, B, maximum_distance, inf)
+        sparse_rows, sparse_cols, _ = tracking.gated_assignment(A, B, maximum_distance, 'euclidean', maximum_distance, inf)
+        assert sorted(zip(dense_rows, dense_cols)) == sorted(zip(sparse_rows, sparse_cols))
+
+        rows, cols = tracking.gated_candidate_pairs(A, B, maximum_distance)
+        graph = coo_matrix((np.ones(rows.shape[0]), (rows, n + cols)), shape=(n + len(B), n + len(B)))
+        components = connected_components(graph, directed=False)[0]
+
+        t_dense = timeit(lambda: dense_assignment(A, B, maximum_distance, inf), repeat)
+        t_sparse = timeit(lambda: tracking.gated_assignment(A, B, maximum_distance, 'euclidean', maximum_distance, inf), repeat)
+        print('%8d %12d %14.3f %14.3f %10.1f' % (n, components, t_dense * 1000, t_sparse * 1000, t_dense / t_sparse))
+
+
+def loop_suppression(pedestrian_centers, motorcycle_centers, min_distance):
+    """ Reference implementation: the former rider filter of main.py """
+    keep = []
+    for pcenter in pedestrian_centers:
+        valid = True
+        for mcenter in motorcycle_centers:
+            if (abs(mcenter[0] - pcenter[0]) < min_distance and
+                    abs(mcenter[1] - pcenter[1]) < min_distance):
+                valid = False
+                break
+        keep.append(valid)
+    return np.array(keep, dtype=bool)
+
+
+def bench_suppression(sizes, repeat):
+    rng = np.random.default_rng(0)
+    print('%8s %12s %14s %14s' % ('peds', 'motorcycles', 'loop (ms)', 'mask (ms)'))
+    for n in sizes:
+        m = max(1, n // 5)
+        pedestrians = rng.integers(0, 640, size=(n, 2))
+        motorcycles = rng.integers(0, 640, size=(m, 2))
+        # riders: pedestrians exactly at the distance limit and just inside it
+        motorcycles[0] = pedestrians[0] + [70, 0]
+        if n > 1:
+            motorcycles[-1] = pedestrians[1] + [69, -69]
+
+        reference = loop_suppression(pedestrians, motorcycles, 70)
+        vectorized = tracking.suppression_keep_mask(pedestrians, motorcycles, 'chebyshev', 70)
+        assert np.array_equal(reference, vectorized)
+
+        t_loop = timeit(lambda: loop_suppression(pedestrians, motorcycles, 70), repeat)
+        t_mask = timeit(lambda: tracking.suppression_keep_mask(pedestrians, motorcycles, 'chebyshev', 70), repeat)
+        print('%8d %12d %14.3f %14.3f' % (n, m, t_loop * 1000, t_mask * 1000))
+
+    # overlap rule: a box half covered is suppressed at 0.5, kept above
+    boxes = np.array([[0, 0, 10, 10], [100, 100, 110, 110]])
+    cover = np.array([[5, 0, 20, 10]])
+    assert np.array_equal(tracking.suppression_keep_mask(boxes, cover, 'overlap', 0.5), [False, True])
+    assert np.array_equal(tracking.suppression_keep_mask(boxes, cover, 'overlap', 0.6), [True, True])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['costs', 'assignment', 'suppression'], help='benchmark to run')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 5, 10, 50, 100, 200, 500],
+                        help='numbers of traces (and detections)')
+    parser.add_argument('--repeat', type=int, default=20, help='repetitions per size')
+    parser.add_argument('--distance', type=float, default=50, help='assignment: maximum distance to assign (pixels)')
+    parser.add_argument('--density', type=float, default=1e-4, help='assignment: traces per square pixel')
+    args = parser.parse_args()
+
+    if args.benchmark == 'costs':
+        bench_costs(args.sizes, args.repeat)
+    elif args.benchmark == 'assignment':
+        bench_assignment(args.sizes, args.repeat, args.distance, args.density)
+    elif args.benchmark == 'suppression':
+        bench_suppression(args.sizes, args.repeat)
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+"""
+Sends a command to a running main.py through its control socket and prints the answer.
+
+python3 control.py help
+python3 control.py snapshot
+python3 control.py state
+python3 control.py stats
+python3 control.py reload
+python3 control.py record start
+"""
+
+import argparse
+import json
+import sys
+
+from utils import control
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', nargs='+', help='command and its arguments')
+    parser.add_argument('--socket', default='dias2p.sock', help='control socket of main.py (controlSocket)')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to wait for the answer')
+    args = parser.parse_args()
+
+    try:
+        response = control.send_command(args.socket, ' '.join(args.command), args.timeout)
+    except OSError as e:
+        print('Could not reach %s: %s' % (args.socket, e))
+        sys.exit(2)
+    if not response['ok']:
+        print(response['error'])
+        sys.exit(1)
+    result = response['result']
+    print(result if isinstance(result, str) else json.dumps(result, indent=2))
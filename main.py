@@ -1,17 +1,14 @@
 #!/usr/bin/python3
 
-import jetson.inference
-import jetson.utils
 import cv2
 import sys
 import os
 import os.path
 import time
-from threading import Timer
-from utils import utils, classes_yolo, classes_ssd, gpios, cameras, info, tracking, contour, backend
-from trackers.bboxyolo import BBox_yolo
-from trackers.bboxssd import BBox_ssd
-from utils_yolo.yolo_with_plugins import TrtYOLO
+from threading import Timer, Lock
+from utils import utils, classes_yolo, gpios, cameras, info, tracking, contour, backend
+from utils import capture, synchronizer, sources, detectors, detections, pipeline, motion, scheduling, writers
+from utils import journal, retention, control
 import platform
 import numpy as np
 import signal
@@ -22,6 +19,8 @@ gpio = gpios.PinController(output_pin=gpio_pin)
 
 # check if running on jetson
 is_jetson = utils.is_jetson_platform()
+if is_jetson:
+    import jetson.utils
 
 
 def finalize_jetson(sgn, frame):
@@ -50,17 +49,41 @@ if isdaemon:
 # else:
 #  make_handler(signal.SIGINT, is_jetson)
 
-# do "touch /home/username/Desktop/DIAS2P/gimmeit" to get snapshots from both cameras
-saveFilesOnDemand = is_jetson
-saveFileThisTime = False
+# commands on a Unix-domain socket in the working directory (snapshots from both cameras, tracker state,
+# stats, reloading the contours, starting / stopping the recording), e.g. "python3 control.py snapshot"
+useControlSocket = True
+controlSocket = 'dias2p.sock'
+snapshotRequested = False
 
+# record every frame of both cameras into video segments of recordSegmentSeconds,
+# with a sidecar index per camera to pull single frames out (see writers.RecordingIndex)
 recordAllFrames = False
 prefixFrames = ''
-numRecordsToFragment = 5000
-
+prefixRecordings = prefixFrames + 'recordings/'
+recordSegmentSeconds = 300
+recordFps = 15
+# OpenCV encoder, or a GStreamer pipeline with a %s for the file path (e.g. the Jetson hardware encoder:
+# 'appsrc ! videoconvert ! nvvidconv ! nvv4l2h264enc ! h264parse ! qtmux ! filesink location=%s')
+recordFourcc = 'mp4v'
+recordGstPipeline = None
+
+# log the detections of the frames with detections inside the contours (and of the warnings)
+# into a binary journal (see journal.JournalReader), rotated by size and time
 recordDetections = False
-recordThisTime = False
-detectionsLog = prefixFrames + 'detections.log'
+prefixJournal = prefixFrames + 'journal/'
+detectionsJournal = prefixJournal + 'detections'
+journalMaxMegabytes = 64
+journalMaxSeconds = 3600
+
+# when the warnings fire, save a clip per camera with the eventClipPreSeconds before and the eventClipPostSeconds after.
+# The frames are kept in memory, as JPEG bytes of eventClipJpegQuality (None keeps raw frames, faster but ~10x more RAM),
+# up to eventClipMaxMegabytes per camera
+recordEventClips = False
+prefixEventClips = prefixFrames + 'events/'
+eventClipPreSeconds = 5
+eventClipPostSeconds = 5
+eventClipMaxMegabytes = 48
+eventClipJpegQuality = 85
 
 recordCountsByMinute = True
 recordCountsByHour = True
@@ -75,9 +98,440 @@ counters = backend.RecordCounters(
 
 prefixOneOffSnapshots = prefixFrames + 'snapshot/'
 prefixDetectionSnapshots = prefixFrames + 'detect/'
+# detection snapshots are saved only when the tracked objects change, or every
+# snapshotMinInterval seconds while the same objects are still tracked
+useKeyframeSnapshots = True
+snapshotMinInterval = 10.0
+
+# keep each recording folder under its budget (in megabytes) deleting its oldest files,
+# and stop writing while the disk has less than minFreeMegabytes free (until resumeFreeMegabytes)
+useRetention = True
+retentionMegabytes = {
+    prefixOneOffSnapshots: 256,
+    prefixDetectionSnapshots: 2048,
+    prefixRecordings: 8192,
+    prefixEventClips: 2048,
+    prefixJournal: 512,
+}
+minFreeMegabytes = 512
+resumeFreeMegabytes = 1024
 
 useTrackerForWarnings = True
 
+class FrameData:
+    """ Everything the pipeline stages know about one pair of crosswalk / road frames """
+
+    def __init__(self):
+        self.crosswalk_img = None       # BGR numpy frames (None if not copied out of CUDA memory)
+        self.road_img = None
+        self.crosswalk_stamp = None     # capture timestamps
+        self.road_stamp = None
+        self.skew = 0.0
+        self.frame_number = 0
+        self.crosswalk_cuda = None      # CUDA images (detectNet on gstreamer cameras)
+        self.road_cuda = None
+        self.save_snapshot = False      # one-off snapshot requested with the 'snapshot' command
+        self.ped_detections = detections.DetectionBatch()    # raw detections
+        self.veh_detections = detections.DetectionBatch()
+        self.road_observed = True       # False if the road detector did not run on this frame (low rate)
+        self.road_elapsed = 1           # frames since the previous road detection
+        self.ped_up = detections.DetectionBatch()           # filtered detections
+        self.ped_down = detections.DetectionBatch()
+        self.vehicles = detections.DetectionBatch()
+        self.ped_selected = np.zeros(0, dtype=bool)         # raw detections that passed the filters
+        self.veh_selected = np.zeros(0, dtype=bool)
+        self.peds_tracked = {}          # tracked detection records by trace id, for the overlay
+        self.vehs_tracked = {}
+        self.record = False             # save this pair of frames as a detection
+        self.warning = False            # warnings were activated for this pair of frames
+
+
+# ---------------------------------------
+#
+#      VIDEO PROCESSING PIPELINE STAGES
+#
+# ---------------------------------------
+
+def capture_stage():
+    """
+    Gets a new pair of frames
+    :return: FrameData, or None when there are no more frames
+    """
+    global frameCount, snapshotRequested
+
+    fd = FrameData()
+    fd.frame_number = frameCount
+    frameCount += 1
+
+    if snapshotRequested:
+        snapshotRequested = False
+        fd.save_snapshot = True
+
+    # Frames from the capture threads: every detector takes BGR numpy frames
+    if useCaptureThreads:
+        framePair = frameSync.next_pair(CAPTURE_TIMEOUT)
+        if framePair is None:
+            print("No more frames")
+            return None
+        fd.crosswalk_img, fd.crosswalk_stamp, fd.road_img, fd.road_stamp, fd.skew = framePair
+
+    # Mobilenet network on gstreamer cameras: capture straight into CUDA memory
+    # (gstCamera keeps a ring of buffers, so the frames queued for detection are not overwritten)
+    else:
+        doZeroCopy = recordDetections or recordAllFrames or recordEventClips or SHOW_INPUTS_IF_JETSON or fd.save_snapshot
+        # get frame from crosswalk and detect
+        # print('CAPTURING SNAPSHOT FROM CROSSWALK CAMERA')
+        fd.crosswalk_cuda, _, _ = crosswalkCam.capture_rgba(zeroCopy=doZeroCopy)
+        fd.crosswalk_stamp = crosswalkCam.timestamp
+        # get frame from road and detect
+        # print('CAPTURING SNAPSHOT FROM ROAD CAMERA')
+        fd.road_cuda, _, _ = roadCam.capture_rgba(zeroCopy=doZeroCopy)
+        fd.road_stamp = roadCam.timestamp
+        # print('FINISHED CAPTURING SNAPSHOTS')
+
+        if doZeroCopy:
+            jetson.utils.cudaDeviceSynchronize()
+            crosswalk_numpy_img = jetson.utils.cudaToNumpy(fd.crosswalk_cuda, W, H, 4)
+            road_numpy_img = jetson.utils.cudaToNumpy(fd.road_cuda, W, H, 4)
+            fd.crosswalk_img = cv2.cvtColor(crosswalk_numpy_img.astype(np.uint8), cv2.COLOR_RGBA2BGR)
+            fd.road_img = cv2.cvtColor(road_numpy_img.astype(np.uint8), cv2.COLOR_RGBA2BGR)
+
+    return fd
+
+
+def detect_stage(fd):
+    """
+    Runs the detector on both frames
+    """
+    # vehicles only matter for the warnings while pedestrians are tracked:
+    # otherwise the road camera is detected at a lower rate, and its frames in between
+    # are not observed at all (the vehicle tracker is not updated with them)
+    if useRoadScheduler:
+        fd.road_observed, fd.road_elapsed = roadScheduler.should_detect(crosswalk_tracker.any_tracked('pedestrian'),
+                                                                        fd.road_stamp)
+    toDetect = [True, fd.road_observed]
+
+    if useMotionGate:
+        # skip the detector on cameras where nothing moves inside the contours;
+        # the trackers still get the (empty) detections, so traces age out normally
+        crosswalkBusy = crosswalk_tracker.any_tracked()
+        roadBusy = road_tracker.any_tracked()
+        crosswalkMoved = crosswalkGate.should_detect(fd.crosswalk_img,
+                                                     force=crosswalkBusy and not MOTION_GATE_WHILE_TRACKING)
+        roadMoved = roadGate.should_detect(fd.road_img, force=roadBusy and not MOTION_GATE_WHILE_TRACKING)
+        toDetect = [toDetect[0] and crosswalkMoved, toDetect[1] and roadMoved]
+
+    if fd.crosswalk_cuda is None:
+        frames = [fd.crosswalk_img, fd.road_img]
+        rois = [crosswalkRoi, roadRoi]
+        # the frames to detect go through the detector in a single batch
+        results = iter(net.detect_batch_rois([f for f, d in zip(frames, toDetect) if d],
+                                             [r for r, d in zip(rois, toDetect) if d], conf_th))
+        (bboxesPedestrian, confsPedestrian, clssPedestrian), (bboxesVehicle, confsVehicle, clssVehicle) = \
+            [next(results) if d else detectors.empty_detections() for d in toDetect]
+    else:
+        # print('DETECTING PEDESTRIANS')
+        bboxesPedestrian, confsPedestrian, clssPedestrian = net.detect_cuda(fd.crosswalk_cuda, W, H, conf_th)
+        # print('DETECTING VEHICLES')
+        if toDetect[1]:
+            bboxesVehicle, confsVehicle, clssVehicle = net.detect_cuda(fd.road_cuda, W, H, conf_th)
+        else:
+            bboxesVehicle, confsVehicle, clssVehicle = detectors.empty_detections()
+        # print('FINISHED DETECTING VEHICLES')
+
+    fd.ped_detections = detections.DetectionBatch(bboxesPedestrian, clssPedestrian, confsPedestrian)
+    fd.veh_detections = detections.DetectionBatch(bboxesVehicle, clssVehicle, confsVehicle)
+    return fd
+
+
+def track_stage(fd):
+    """
+    Filters the detections, updates the trackers and counters, and manages the warnings
+    """
+    global scheduler
+
+    # control commands that touch the trackers or the contours run here, between two frames
+    if useControlSocket:
+        controlServer.run_pending()
+
+    # filter crosswalk detections recognised as pedestrians / motorcycles
+    crosswalk = fd.ped_detections
+    ped_raw_idxs = np.flatnonzero(crosswalk.in_classes(pedestrian_class_mask))
+    mots = crosswalk.select(crosswalk.in_classes(pedestrian_vehicle_class_mask))
+
+    # track the motorcycles first, then cull the pedestrians next to a tracked motorcycle (at its updated
+    # position, or its last one if not detected now): they are its rider
+    crosswalk_tracker.update(mots.centers, np.full(len(mots), MOTORCYCLE_LABEL), None, list(mots.records()),
+                             class_names=['motorcycle'])
+    ped_raw_idxs = ped_raw_idxs[tracking.suppression_keep_mask(crosswalk.centers[ped_raw_idxs],
+                                                               crosswalk_tracker.class_positions('motorcycle'),
+                                                               'chebyshev', min_motorcycle_distance_to_pedestrian)]
+    # crosswalk zone of every pedestrian at once (kept in the raw detections too, for the journal)
+    crosswalk.zones[ped_raw_idxs] = crosswalkZones.labels(crosswalk.centers[ped_raw_idxs])
+    peds = crosswalk.select(ped_raw_idxs)
+    fd.ped_up = peds.select(peds.zones == ZONE_UP)
+    fd.ped_down = peds.select(peds.zones == ZONE_DOWN)
+    fd.ped_selected = np.zeros(len(crosswalk), dtype=bool)
+    fd.ped_selected[ped_raw_idxs[peds.zones != contour.ZoneMap.OUTSIDE]] = True
+
+    # filter road detections recognised as vehicles inside the road contour
+    road = fd.veh_detections
+    road.zones = roadZones.labels(road.centers)
+    fd.veh_selected = road.in_classes(vehicle_class_mask) & (road.zones != contour.ZoneMap.OUTSIDE)
+    fd.vehicles = road.select(fd.veh_selected)
+
+    if len(fd.ped_up) or len(fd.ped_down) or len(fd.vehicles):
+        fd.record = recordDetections
+
+    # Relate previous detections to new ones
+    crosswalk_tracked = detections.DetectionBatch.concatenate([fd.ped_up, fd.ped_down])
+    crosswalk_events = crosswalk_tracker.update(crosswalk_tracked.centers, np.full(len(crosswalk_tracked), PEDESTRIAN_LABEL),
+                                                crosswalk_tracked.zones, list(crosswalk_tracked.records()),
+                                                class_names=['pedestrian'])
+    # going_up, going_down is to keep track of pedestrians who have been detected to cross the crosswalk
+    going_up = crosswalk_events.transitions_to('pedestrian', ZONE_UP)
+    going_down = crosswalk_events.transitions_to('pedestrian', ZONE_DOWN)
+    if fd.road_observed:
+        # the Kalman filter predicts the vehicles over the frames elapsed since the last road detection and
+        # the skipped frames are scaled by them, so vehicles keep their identity (and are counted once) at
+        # the low detection rate; the gates only grow a little (see tracking.elapsed_gate)
+        road_events = road_tracker.update(fd.vehicles.centers, np.full(len(fd.vehicles), VEHICLE_LABEL), None,
+                                          list(fd.vehicles.records()), fd.road_elapsed)
+        new_vehicle_idxs = road_events.new['vehicle']
+    else:
+        new_vehicle_idxs = []
+    # copies for the output stage, the trackers keep changing meanwhile
+    fd.peds_tracked = crosswalk_tracker.tracked_items('pedestrian')
+    fd.vehs_tracked = road_tracker.tracked_items()
+
+    # count vehicles and pedestrian and post regular counts to the backend
+    counters.add(new_vehicle_idxs, going_up, going_down)
+
+    # ---------------------------------------
+    #
+    #         MANAGING SECURITY
+    #
+    # ---------------------------------------
+
+    if useTrackerForWarnings:
+        activateWarnings = road_tracker.any_tracked() and crosswalk_tracker.any_tracked('pedestrian')
+    else:
+        activateWarnings = len(fd.vehicles) > 0 and (len(fd.ped_up) > 0 or len(fd.ped_down) > 0)
+
+    if activateWarnings:
+        fd.warning = True
+        # Security actions Here
+        if is_jetson:
+            # Activate Warnings
+            gpio.warning_ON()
+            print("ACTIVATE WARNINGS!!!!!")
+            # Deactivate Warnings after DELAY_TIME
+            scheduler.cancel()
+            scheduler = Timer(DELAY_TIME, gpio.warning_OFF, ())
+            scheduler.start()
+
+        else:
+
+            # Deactivate Warnings after DELAY_TIME
+            scheduler.cancel()  # Cancel every possible Scheduler Thread
+            scheduler = Timer(DELAY_TIME, gpio.security_OFF, ())  # Restart
+            scheduler.start()
+
+    return fd
+
+
+def output_stage(fd):
+    """
+    Saves snapshots and detection logs, shows the frames and the program info
+    """
+    global minute_count, lastOutputTime
+
+    crosswalk_numpy_img = fd.crosswalk_img
+    road_numpy_img = fd.road_img
+    # nothing is written to disk while it is almost full
+    diskFull = useRetention and retentionManager.paused
+
+    if fd.save_snapshot and not diskFull:
+        stamp = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M.%S.%f")
+        imageWriter.write('%scrosswalk.%s' % (prefixOneOffSnapshots, stamp), crosswalk_numpy_img)
+        imageWriter.write('%sroad.%s' % (prefixOneOffSnapshots, stamp), road_numpy_img)
+
+    if fd.record:
+        detectTimestamp = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M.%S.%f")
+    if crosswalk_numpy_img is not None and not diskFull:
+        # the recording can be started / stopped meanwhile with the control socket
+        with recordingLock:
+            if recordAllFrames:
+                now = time.time()
+                crosswalkRecorder.write(crosswalk_numpy_img, fd.crosswalk_stamp or now)
+                roadRecorder.write(road_numpy_img, fd.road_stamp or now)
+    if recordEventClips and crosswalk_numpy_img is not None:
+        now = time.time()
+        for clips, img, stamp in ((crosswalkClips, crosswalk_numpy_img, fd.crosswalk_stamp or now),
+                                  (roadClips, road_numpy_img, fd.road_stamp or now)):
+            clips.add(img, stamp)
+            if fd.warning and not diskFull:
+                clips.trigger(stamp)
+    if fd.record and not recordAllFrames and not diskFull and (not useKeyframeSnapshots or keyframeSelector.should_save(
+            fd.crosswalk_stamp or time.time(),
+            [('crosswalk', i) for i in fd.peds_tracked] + [('road', i) for i in fd.vehs_tracked])):
+        imageWriter.write('%sdetect.crosswalk.%s' % (prefixDetectionSnapshots, detectTimestamp), crosswalk_numpy_img)
+        imageWriter.write('%sdetect.road.%s' % (prefixDetectionSnapshots, detectTimestamp), road_numpy_img)
+    if recordDetections and (fd.record or fd.warning) and not diskFull:
+        # raw detections of both cameras, flagged if they passed the filters, and the warnings;
+        # the journal buffers them and writes them in batches
+        detectJournal.write_frame(fd.crosswalk_stamp or time.time(), fd.frame_number,
+                                  [(journal.CROSSWALK, fd.ped_detections, fd.ped_selected),
+                                   (journal.ROAD, fd.veh_detections, fd.veh_selected)],
+                                  fd.warning)
+
+    # ---------------------------------------
+    #
+    #           SHOWING PROGRAM INFO
+    #
+    # ---------------------------------------
+
+    now = time.time()
+    consoleConfig.fps = 1.0 / max(now - lastOutputTime, 1e-6)
+    lastOutputTime = now
+    consoleConfig.warnings = scheduler.is_alive()  # if True warnings are still ON
+    consoleConfig.stages = videoPipeline.stats()
+    if useCaptureThreads:
+        consoleConfig.capture = [crosswalkReader.stats(), roadReader.stats()]
+        consoleConfig.sync = frameSync.stats()
+    if useMotionGate:
+        consoleConfig.motion = [crosswalkGate.stats(), roadGate.stats()]
+    if useRoadScheduler:
+        consoleConfig.schedulers = [roadScheduler.stats()]
+    if useRetention:
+        consoleConfig.retention = retentionManager.stats()
+    consoleConfig.writers = [imageWriter.stats()]
+    with recordingLock:
+        if recordAllFrames:
+            consoleConfig.writers += [crosswalkRecorder.stats(), roadRecorder.stats()]
+    if recordEventClips:
+        consoleConfig.writers += [crosswalkClips.stats(), roadClips.stats()]
+    if counters.recordAny:
+        consoleConfig.writers += [counters.stats()]
+    if recordDetections:
+        consoleConfig.writers += [detectJournal.stats()]
+        if useKeyframeSnapshots and not recordAllFrames:
+            consoleConfig.keyframes = [keyframeSelector.stats()]
+
+    if crosswalk_numpy_img is not None and SHOW_INPUTS_IF_JETSON:
+        # draw on copies: the capture threads may hand the same frames out again
+        road_numpy_img = road_numpy_img.copy()
+        crosswalk_numpy_img = crosswalk_numpy_img.copy()
+        contour.drawContour(road_numpy_img, roadContour)
+        contour.drawContour(crosswalk_numpy_img, crossContourUp)
+        contour.drawContour(crosswalk_numpy_img, crossContourDown)
+        if useTrackerForWarnings:
+            crosswalk_numpy_img = info.print_records_to_frame(crosswalk_numpy_img, fd.peds_tracked)
+            road_numpy_img = info.print_records_to_frame(road_numpy_img, fd.vehs_tracked)
+        else:
+            crosswalk_numpy_img = info.print_batch_to_frame(crosswalk_numpy_img, fd.ped_up)
+            crosswalk_numpy_img = info.print_batch_to_frame(crosswalk_numpy_img, fd.ped_down)
+            road_numpy_img = info.print_batch_to_frame(road_numpy_img, fd.vehicles)
+        cv2.imshow("crosswalk", crosswalk_numpy_img)
+        cv2.imshow("road", road_numpy_img)
+
+    if isdaemon:
+        time_delta = datetime.datetime.now() - timestart
+        # print(time_delta)
+        systemd.daemon.notify('WATCHDOG=1')
+        delta_minutes = time_delta.seconds // 60
+        if delta_minutes != minute_count:
+            info.print_console(consoleConfig)
+            minute_count = delta_minutes
+    else:
+        # SHOW DATA IN CONSOLE
+        info.print_console(consoleConfig)
+        # Quit program pressing 'q'
+        key = cv2.waitKey(1) & 0xFF
+        if key == ord("q"):
+            videoPipeline.stop()
+
+
+# ---------------------------------------
+#
+#           CONTROL COMMANDS
+#
+# ---------------------------------------
+
+def open_recorders():
+    """
+    :return: SegmentedVideoRecorder of the crosswalk and road cameras, in a new folder
+    """
+    parentFolder = prefixRecordings + datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
+    return [writers.SegmentedVideoRecorder(parentFolder, name, fps=recordFps, segment_seconds=recordSegmentSeconds,
+                                           fourcc=recordFourcc, gst_pipeline=recordGstPipeline)
+            for name in ('crosswalk', 'road')]
+
+
+def request_snapshot(args):
+    global snapshotRequested
+    snapshotRequested = True
+    return 'snapshot requested'
+
+
+def rearm_snapshot(fd):
+    # a frame pair dropped before detection hands its one-off snapshot to the next one
+    global snapshotRequested
+    if fd.save_snapshot:
+        snapshotRequested = True
+
+
+def dump_trackers(args):
+    return {'crosswalk': crosswalk_tracker.state(), 'road': road_tracker.state()}
+
+
+def report_stats(args):
+    # as last shown in the console
+    return {name: getattr(consoleConfig, name, None) for name in
+            ('fps', 'warnings', 'capture', 'sync', 'stages', 'motion', 'schedulers', 'writers', 'keyframes', 'retention')}
+
+
+def reload_contours(args):
+    """
+    Loads the contours saved in resources/ again, and rebuilds the zone maps, inference ROIs and motion gate masks
+    """
+    global crossContourUp, crossContourDown, roadContour, crosswalkRoi, roadRoi
+    up, down, road = [contour.load_contour(name) for name in ('crossContourUp', 'crossContourDown', 'roadContour')]
+    crosswalkZones.set_contours([up, down])
+    roadZones.set_contours([road])
+    if ROI_CROP:
+        crosswalkRoi = contour.get_padded_bounding_rect([up, down], ROI_PADDING, W, H)
+        roadRoi = contour.get_padded_bounding_rect([road], ROI_PADDING, W, H)
+    if useMotionGate:
+        crosswalkGate.set_contours([up, down])
+        roadGate.set_contours([road])
+    crossContourUp, crossContourDown, roadContour = up, down, road
+    return 'contours reloaded'
+
+
+def set_recording(args):
+    """
+    Starts (in a new folder) or stops recording every frame
+    """
+    global recordAllFrames, crosswalkRecorder, roadRecorder
+    if args not in (['start'], ['stop']):
+        raise ValueError('usage: record start|stop')
+    closing = []
+    # the output stage checks recordAllFrames and writes to the recorders holding recordingLock too
+    with recordingLock:
+        if args[0] == 'start' and not recordAllFrames:
+            crosswalkRecorder, roadRecorder = open_recorders()
+            recordAllFrames = True
+        elif args[0] == 'stop' and recordAllFrames:
+            recordAllFrames = False
+            closing = [crosswalkRecorder, roadRecorder]
+        recording = recordAllFrames
+    # no more frames reach them: the frames still queued are encoded without holding back the output stage
+    for recorder in closing:
+        recorder.close()
+    return {'recording': recording}
+
+
 if __name__ == "__main__":
     # ---------------------------------------
     #
@@ -89,6 +543,10 @@ if __name__ == "__main__":
     # when production set this to False as it consume resources
     SHOW_IF_NOT_JETSON = False  # True
     VIDEO = False
+    # replay a directory of snapshots instead of cameras (by default the detection snapshots, see IMAGES_PATH)
+    IMAGES = False
+    # replay recorded footage at its original timestamps (True) or as fast as possible (False)
+    REPLAY_REALTIME = True
     SHOW_INPUTS_IF_JETSON = True
     # tell the script if it can spawn windows to show images
     RUNNING_ON_DESKTOP = False  # True
@@ -113,38 +571,37 @@ if __name__ == "__main__":
     if not recordDetections:
         recordAllFrames = False
     if recordDetections:
-        detectfile = open(detectionsLog, 'at')
+        detectJournal = journal.DetectionJournal(detectionsJournal, max_bytes=journalMaxMegabytes * 1024 * 1024,
+                                                 max_seconds=journalMaxSeconds)
         if recordAllFrames:
-            currentFile = 0
-            currentSubFolder = 0
-            currentFolder = 0
-            parentFolder = prefixFrames + datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
-            os.mkdir(parentFolder)
-            os.mkdir("%s/%04d" % (parentFolder, currentFolder))
-            currentFolderStr = "%s/%04d/%04d/" % (parentFolder, currentFolder, currentSubFolder)
-            os.mkdir(currentFolderStr)
-
-    # Pre-assigned parameter to choose which net to use
-    yolo_detector = True
+            crosswalkRecorder, roadRecorder = open_recorders()
+    recordingLock = Lock()
+
+    # Pre-assigned parameter to choose which net to use:
+    # 'trt_yolo' (TensorRT YOLO), 'detectnet' (Mobilenet) or 'cpu_yolo' (OpenCV dnn YOLO on the CPU)
+    detector_backend = 'trt_yolo'
+    # use the CPU backend if the GPU one cannot be loaded (e.g. broken CUDA stack)
+    fallback_to_cpu = True
 
     # Using the Yolo network
-    if yolo_detector:
+    if detector_backend in ('trt_yolo', 'cpu_yolo'):
         # load the object detection network
-        accelerated_gstreamer = False
         model = 'yolov4-tiny-416'
         category_num = 80
         conf_th = 0.5
         letter_box = True
-        net = TrtYOLO(model, category_num, letter_box)
+        net = detectors.load_detector(detector_backend, model, fallback_to_cpu,
+                                      category_num=category_num, letter_box=letter_box)
     # Using the Mobilenet network
     else:
         # load the object detecion network
-        accelerated_gstreamer = True
         arch = "ssd-mobilenet-v2"
-        overlay = "box,labels,conf"
-        threshold = 0.7
+        conf_th = 0.7
         W, H = (640, 480)
-        net = jetson.inference.detectNet(arch, sys.argv + ["--log-level=error"], threshold)
+        net = detectors.load_detector(detector_backend, arch, fallback_to_cpu,
+                                      threshold=conf_th, argv=sys.argv, cpu_model='yolov4-tiny-416')
+    # detectNet captures straight into CUDA memory from gstreamer cameras
+    accelerated_gstreamer = isinstance(net, detectors.DetectNetDetector)
 
     if CHECK_IF_RUNNING_ON_DESKTOP:
         RUNNING_ON_DESKTOP = ('DISPLAY' in os.environ) and (os.environ['DISPLAY'] != '')
@@ -157,13 +614,8 @@ if __name__ == "__main__":
     consoleConfig = info.ConsoleParams()
     consoleConfig.system = platform.system()
 
-    # Get array of classes detected by the net
-    # Using the Yolo classes
-    if yolo_detector:
-        classes = classes_yolo.classesDict
-    # Using the Mobilenet classes
-    else:
-        classes = classes_ssd.classesDict
+    # Get array of classes detected by the net (every detector reports classes_yolo ids)
+    classes = classes_yolo.classesDict
     # List to filter detections
     pedestrian_classes = [
         "person",
@@ -176,16 +628,26 @@ if __name__ == "__main__":
         "truck",
     ]
     pedestrian_vehicle_classes = ["motorcycle"]
+    # precomputed filters, indexed with the class ids of the detections
+    pedestrian_class_mask = detections.class_lookup(pedestrian_classes)
+    vehicle_class_mask = detections.class_lookup(vehicle_classes)
+    pedestrian_vehicle_class_mask = detections.class_lookup(pedestrian_vehicle_classes)
     motorcycle_index = classes.index("motorcycle")
     min_motorcycle_distance_to_pedestrian = 70  # in pixels
 
-    # Initialize Trackers
-    ped_tracker = tracking.Tracker(200, 10, 200 * 100)
-    veh_tracker = tracking.Tracker(200, 15, 200 * 100)
-    mot_tracker = tracking.Tracker(200, 5, 200 * 100)
-    peds_tracked = tracking.PedestrianTracking()
-    vehs_tracked = tracking.VehicleTracking()
-    mots_tracked = tracking.VehicleTracking()
+    # Initialize Trackers: one per camera, with (maximum distance to assign, maximum skipped frames) by class
+    # dense assignment: with a 200 px gate on a 640x480 frame the traces form a single group, so the
+    # sparse assignment (per group of nearby traces) only adds overhead, see benchmark_tracking.py assignment
+    crosswalk_tracker = tracking.MultiClassTracker({'pedestrian': (200, 10), 'motorcycle': (200, 5)}, 200 * 100)
+    # vehicles are associated to their predicted positions (constant velocity Kalman filter),
+    # fast vehicles move farther than the maximum distance between detections, above all at the low road rate
+    road_tracker = tracking.MultiClassTracker({'vehicle': (200, 15)}, 200 * 100, motion_model='kalman')
+    PEDESTRIAN_LABEL = crosswalk_tracker.class_index['pedestrian']
+    MOTORCYCLE_LABEL = crosswalk_tracker.class_index['motorcycle']
+    VEHICLE_LABEL = road_tracker.class_index['vehicle']
+    # crosswalk zones of the pedestrians (labels of the crosswalk zone map)
+    ZONE_UP = 1
+    ZONE_DOWN = 2
 
     # Activate Board
     if is_jetson: gpio.activate_jetson_board()
@@ -207,17 +669,65 @@ if __name__ == "__main__":
 
     VIDEO_PATH = "video/cross_uma_02.webm"
     VIDEO_PATH2 = "video/car_uma_01.webm"
+    # detection snapshots (the one-off ones of the snapshot command are in prefixOneOffSnapshots,
+    # named "crosswalk.*" / "road.*"); the capture time is read from their names
+    IMAGES_PATH = prefixDetectionSnapshots
+    IMAGES_PATTERN = "detect.crosswalk.*"
+    IMAGES_PATTERN2 = "detect.road.*"
+    # seconds to wait for a new frame from a camera before giving up
+    CAPTURE_TIMEOUT = 5
+    # road and crosswalk frames are paired by capture timestamp: maximum skew (seconds) within a pair,
+    # seconds to wait for a lagging camera, and whether to reuse its last frame (True) or drop the pair (False)
+    FRAME_MAX_SKEW = 0.05
+    FRAME_MAX_WAIT = 0.1
+    FRAME_REUSE_IF_LAGGING = True
+    # size of the queues between the capture, detection, tracking and output stages
+    PIPELINE_QUEUE_SIZE = 2
+    # skip inference on a camera when nothing moves inside its contours ('mog2' or 'diff' on downscaled frames)
+    MOTION_GATE = True
+    MOTION_GATE_METHOD = 'mog2'
+    MOTION_GATE_SCALE = 0.25
+    # fraction of the contour area that has to change
+    MOTION_GATE_MIN_CHANGED = 0.002
+    # run the detector anyway after this many skipped frames
+    MOTION_GATE_MAX_SKIPPED = 30
+    # keep gating while objects are tracked (False: always detect while something is tracked,
+    # so objects standing still inside the contours are not lost)
+    MOTION_GATE_WHILE_TRACKING = False
+    # detect the road camera on every frame only while pedestrians are tracked,
+    # and once every ROAD_LOW_RATE_PERIOD seconds otherwise
+    ROAD_LOW_RATE = True
+    ROAD_LOW_RATE_PERIOD = 0.5
+    # run inference only on the bounding rectangle of the contours of each camera, padded by ROI_PADDING pixels
+    # (only for frames in CPU memory)
+    ROI_CROP = True
+    ROI_PADDING = 80
+    # snapshots are encoded and written in background threads: format ('jpg', 'png' or 'webp'), jpg/webp quality,
+    # number of threads, queued images and what to do when the queue is full ('drop_oldest', 'drop_newest' or 'block')
+    IMAGE_FORMAT = 'jpg'
+    IMAGE_QUALITY = 90
+    IMAGE_WRITER_THREADS = 2
+    IMAGE_WRITER_QUEUE_SIZE = 32
+    IMAGE_WRITER_POLICY = 'drop_oldest'
 
     # Get two Video Input Resources
-    # Rather from VIDEO file (testing) or CAMERA file
+    # Rather from VIDEO file / IMAGES folder (testing) or CAMERA file
 
     if VIDEO:
         print('[*] Starting video...')
-        crosswalkCam = cv2.VideoCapture(VIDEO_PATH)
-        roadCam = cv2.VideoCapture(VIDEO_PATH2)
+        replayClock = sources.ReplayClock(realtime=REPLAY_REALTIME)
+        crosswalkCam = sources.VideoFileSource(VIDEO_PATH, replayClock)
+        roadCam = sources.VideoFileSource(VIDEO_PATH2, replayClock)
         # Override initial width and height
-        W = int(crosswalkCam.get(3))  # float
-        H = int(crosswalkCam.get(4))  # float
+        W, H = crosswalkCam.width, crosswalkCam.height
+
+    elif IMAGES:
+        print('[*] Starting image replay...')
+        replayClock = sources.ReplayClock(realtime=REPLAY_REALTIME)
+        crosswalkCam = sources.ImageDirSource(IMAGES_PATH, IMAGES_PATTERN, replayClock)
+        roadCam = sources.ImageDirSource(IMAGES_PATH, IMAGES_PATTERN2, replayClock)
+        # Override initial width and height
+        W, H = crosswalkCam.width, crosswalkCam.height
 
     elif is_jetson and accelerated_gstreamer:
         # If in jetson platform initialize Cameras from CUDA (faster inferences)
@@ -226,9 +736,9 @@ if __name__ == "__main__":
         # Select Road and Crosswalk cameras
         road_idx, crosswalk_idx = cameras.get_road_and_crosswalk_devices(videoConfig)
         # print('STARTING CROSSWALK CAMERA')
-        crosswalkCam = jetson.utils.gstCamera(W, H, crosswalk_idx)
+        crosswalkCam = sources.GstSource(crosswalk_idx, W, H)
         # print('STARTING ROAD CAMERA')
-        roadCam = jetson.utils.gstCamera(W, H, road_idx)
+        roadCam = sources.GstSource(road_idx, W, H)
         # print('FINISHED STARTING CAMERAS')
 
     else:
@@ -238,21 +748,56 @@ if __name__ == "__main__":
 
         # Select Road and Crosswalk cameras
         road_idx, crosswalk_idx = cameras.get_road_and_crosswalk_devices(videoConfig)
-        crosswalkCam = cv2.VideoCapture(crosswalk_idx)
-        roadCam = cv2.VideoCapture(road_idx)
+        crosswalkCam = sources.V4L2Source(crosswalk_idx)
+        roadCam = sources.V4L2Source(road_idx)
         # Override initial width and height
-        W = int(crosswalkCam.get(3))  # float
-        H = int(crosswalkCam.get(4))  # float
+        W, H = crosswalkCam.width, crosswalkCam.height
+
+    # replay as fast as possible: every frame has to be processed, none can be dropped
+    REPLAY_LOSSLESS = crosswalkCam.lossless and roadCam.lossless
 
-    # Get ROIs from cross and road cam
-    crossContourUp = contour.select_points_in_frame(crosswalkCam, 'crossContourUp', is_jetson=is_jetson,
+    # Get ROIs from cross and road cam (every frame source gives BGR frames through read())
+    crossContourUp = contour.select_points_in_frame(crosswalkCam, 'crossContourUp',
                                                     is_interactive=INTERACTIVE_SETUP)
-    crossContourDown = contour.select_points_in_frame(crosswalkCam, 'crossContourDown', is_jetson=is_jetson,
+    crossContourDown = contour.select_points_in_frame(crosswalkCam, 'crossContourDown',
                                                       is_interactive=INTERACTIVE_SETUP)
-    roadContour = contour.select_points_in_frame(roadCam, 'roadContour', is_jetson=is_jetson,
+    roadContour = contour.select_points_in_frame(roadCam, 'roadContour',
                                                  is_interactive=INTERACTIVE_SETUP,
                                                  point_nb=6)
 
+    # Zone label maps, to classify the detections of each camera (rebuild them whenever the contours change)
+    crosswalkZones = contour.ZoneMap([crossContourUp, crossContourDown], crosswalkCam.width, crosswalkCam.height)
+    roadZones = contour.ZoneMap([roadContour], roadCam.width, roadCam.height)
+
+    # Read frame sources in background threads, keeping only the newest frames of each camera.
+    # detectNet on live gstreamer cameras keeps capturing straight into CUDA memory instead
+    useCaptureThreads = VIDEO or IMAGES or not (is_jetson and accelerated_gstreamer)
+    if useCaptureThreads:
+        crosswalkReader, roadReader = capture.start_readers([crosswalkCam, roadCam], ['crosswalk', 'road'],
+                                                            history=4)
+        frameSync = synchronizer.FrameSynchronizer(crosswalkReader, roadReader, max_skew=FRAME_MAX_SKEW,
+                                                   max_wait=FRAME_MAX_WAIT, reuse=FRAME_REUSE_IF_LAGGING)
+
+    if ROI_CROP:
+        crosswalkRoi = contour.get_padded_bounding_rect([crossContourUp, crossContourDown], ROI_PADDING, W, H)
+        roadRoi = contour.get_padded_bounding_rect([roadContour], ROI_PADDING, W, H)
+    else:
+        crosswalkRoi = roadRoi = None
+
+    useRoadScheduler = ROAD_LOW_RATE
+    if useRoadScheduler:
+        roadScheduler = scheduling.DetectionScheduler('road', low_rate_period=ROAD_LOW_RATE_PERIOD)
+
+    # motion gates need the frames in CPU memory
+    useMotionGate = MOTION_GATE and useCaptureThreads
+    if useMotionGate:
+        crosswalkGate = motion.MotionGate('crosswalk', [crossContourUp, crossContourDown], scale=MOTION_GATE_SCALE,
+                                          method=MOTION_GATE_METHOD, min_changed=MOTION_GATE_MIN_CHANGED,
+                                          max_skipped=MOTION_GATE_MAX_SKIPPED)
+        roadGate = motion.MotionGate('road', [roadContour], scale=MOTION_GATE_SCALE,
+                                     method=MOTION_GATE_METHOD, min_changed=MOTION_GATE_MIN_CHANGED,
+                                     max_skipped=MOTION_GATE_MAX_SKIPPED)
+
     # ---------------------------------------
     #
     #      VIDEO PROCESSING MAIN LOOP
@@ -263,308 +808,77 @@ if __name__ == "__main__":
         systemd.daemon.notify('READY=1')
         timestart = datetime.datetime.now()
         minute_count = -1
-
-    while True:
-
-        start_time = time.time()  # start time of the loop
-
-        if saveFilesOnDemand and os.path.isfile('gimmeit'):
-            try:
-                os.remove('gimmeit')
-            except:
-                pass
-            saveFileThisTime = True
-
-        # ---------------------------------------
-        #
-        #              DETECTION
-        #
-        # ---------------------------------------
-
-        # Using the Yolo network
-        if yolo_detector:
-            if crosswalkCam.grab() and roadCam.grab():
-                _, crosswalk_numpy_img = crosswalkCam.read()
-                _, road_numpy_img = roadCam.read()
-            else:
-                print("No more frames")
-                break
-
-            # This is a quick-and-dirty hack to just use OpenCV's VideoCapture and TrtYolo
-            bboxesPedestrian, confsPedestrian, clssPedestrian = net.detect(crosswalk_numpy_img, conf_th)
-            bboxesVehicle, confsVehicle, clssVehicle = net.detect(road_numpy_img, conf_th)
-
-            # Together the output in a tuple
-            pedestrianDetections = zip(bboxesPedestrian, clssPedestrian)
-            vehicleDetections = zip(bboxesVehicle, clssVehicle)
-
-
-        # Using the Mobilenet network
-        else:
-            if is_jetson:
-                doZeroCopy = recordDetections or SHOW_INPUTS_IF_JETSON or saveFileThisTime
-                # get frame from crosswalk and detect
-                # print('CAPTURING SNAPSHOT FROM CROSSWALK CAMERA')
-                crosswalkMalloc, _, _ = crosswalkCam.CaptureRGBA(zeroCopy=doZeroCopy)
-                # get frame from road and detect
-                # print('CAPTURING SNAPSHOT FROM ROAD CAMERA')
-                roadMalloc, _, _ = roadCam.CaptureRGBA(zeroCopy=doZeroCopy)
-                # print('FINISHED CAPTURING SNAPSHOTS')
-
-                if doZeroCopy:
-                    jetson.utils.cudaDeviceSynchronize()
-                    crosswalk_numpy_img = jetson.utils.cudaToNumpy(crosswalkMalloc, W, H, 4)
-                    road_numpy_img = jetson.utils.cudaToNumpy(roadMalloc, W, H, 4)
-                    crosswalk_numpy_img = cv2.cvtColor(crosswalk_numpy_img.astype(np.uint8), cv2.COLOR_RGBA2BGR)
-                    road_numpy_img = cv2.cvtColor(road_numpy_img.astype(np.uint8), cv2.COLOR_RGBA2BGR)
-                    # show images here only for debug purposes
-                    # if SHOW_INPUTS_IF_JETSON:
-                    #  cv2.imshow("crosswalk", crosswalk_numpy_img)
-                    #  cv2.imshow("road", road_numpy_img)
-
-                # print('DETECTING PEDESTRIANS')
-                pedestrianDetections = net.Detect(crosswalkMalloc, W, H, overlay)
-
-                # print('DETECTING VEHICLES')
-                vehicleDetections = net.Detect(roadMalloc, W, H, overlay)
-
-                # print('FINISHED DETECTING VEHICLES')
-
-            # If we are NOT on jetson use CV2
-            else:
-                # Check if more frames are available
-                if crosswalkCam.grab() and roadCam.grab():
-                    # capture the image
-                    _, crosswalkFrame = crosswalkCam.read()
-                    _, roadFrame = roadCam.read()
-                else:
-                    print("no more frames")
-                    break
-
-                # Synchronize system
-                jetson.utils.cudaDeviceSynchronize()
-
-                # Get Cuda Malloc to be used by the net
-                # Get processes frame to fit Cuda Malloc Size
-                crosswalkFrame, crosswalkMalloc = utils.frameToCuda(crosswalkFrame, W, H)
-                roadFrame, roadMalloc = utils.frameToCuda(roadFrame, W, H)
-
-                # Get detections Detectnet.Detection Object
-                pedestrianDetections = net.Detect(crosswalkMalloc, W, H, overlay)
-                vehicleDetections = net.Detect(roadMalloc, W, H, overlay)
-
-        if saveFileThisTime:
-            saveFileThisTime = False
-            stamp = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
-            cv2.imwrite('%scrosswalk.%s.jpg' % (prefixOneOffSnapshots, stamp), crosswalk_numpy_img)
-            cv2.imwrite('%sroad.%s.jpg' % (prefixOneOffSnapshots, stamp), road_numpy_img)
-
-        # ---------------------------------------
-        #
-        #               TRACKING
-        #
-        # ---------------------------------------
-
-        # Initialize bounding boxes lists
-        ped_up_bboxes = []
-        ped_down_bboxes = []
-        veh_bboxes = []
-        mot_bboxes = []
-        ped_bboxes = []
-        ped_up_idxs = []
-        ped_down_idxs = []
-        veh_idxs = []
-
-        # Convert Crosswalk Detections to Bbox object
-        # filter detections if recognised as pedestrians / motorcycles
-        # Using Bbox YOLO
-        if yolo_detector:
-            BBox = BBox_yolo
-        # Using BBox MobileNet
-        else:
-            BBox = BBox_ssd
-
-        for detection in pedestrianDetections:
-            bbox = BBox(detection)
-            if bbox.name in pedestrian_classes:
-                ped_bboxes.append(bbox)
-            elif bbox.name in pedestrian_vehicle_classes:
-                mot_bboxes.append(bbox)
-
-        # do motorcycle tracking before anything else, to use tracked motorcycles to cull the associated false positives in pedestrian bboxes.
-        motorcycle_idxs, removed_motorcycle_idxs = mot_tracker.assign_incomming_positions(
-            np.array([x.center for x in mot_bboxes]))
-        _ = mots_tracked.update_pos(removed_motorcycle_idxs, motorcycle_idxs, mot_bboxes)
-
-        # add pedestrian list of bboxes
-        ped_idx = 0
-        mot_bboxes = mots_tracked.get_tracked_bboxes()
-        for bbox in ped_bboxes:
-            valid = True
-            pcenter = bbox.center
-            for mot in mot_bboxes.values():
-                mcenter = mot.center
-                if (abs(mcenter[0] - pcenter[0]) < min_motorcycle_distance_to_pedestrian and
-                        abs(mcenter[1] - pcenter[1]) < min_motorcycle_distance_to_pedestrian):
-                    valid = False
-                    break
-            if valid:
-                if tracking.is_point_in_contour(crossContourUp, bbox.center):
-                    ped_up_bboxes.append(bbox)
-                    ped_up_idxs.append(ped_idx)
-                    ped_idx += 1
-                    recordThisTime = recordDetections
-                elif tracking.is_point_in_contour(crossContourDown, bbox.center):
-                    ped_down_bboxes.append(bbox)
-                    ped_down_idxs.append(ped_idx)
-                    ped_idx += 1
-                    recordThisTime = recordDetections
-
-        # Convert Road Detections to Bbox object
-        # filter detections if recognised as vehicles
-        # add to vehicle list of bboxes
-        vec_idx = 0
-        for detection in vehicleDetections:
-            bbox = BBox(detection)
-            is_bbox_in_contour = tracking.is_point_in_contour(roadContour, bbox.center)
-            if bbox.name in vehicle_classes and is_bbox_in_contour:
-                recordThisTime = recordDetections
-                veh_bboxes.append(bbox)
-                veh_idxs.append(vec_idx)
-            vec_idx += 1
-
-        if recordThisTime or recordAllFrames:
-            detectTimestamp = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M.%S.%f")
-        if recordAllFrames:
-            cv2.imwrite('%scrosswalk.%s.jpg' % (currentFolderStr, detectTimestamp), crosswalk_numpy_img)
-            cv2.imwrite('%sroad.%s.jpg' % (currentFolderStr, detectTimestamp), road_numpy_img)
-            currentFile += 1
-            if currentFile >= numRecordsToFragment:
-                currentFile = 0
-                currentSubFolder += 1
-                if currentSubFolder >= numRecordsToFragment:
-                    currentSubFolder = 0
-                    currentFolder += 1
-                    os.mkdir("%s/%04d" % (parentFolder, currentFolder))
-                currentFolderStr = "%s/%04d/%04d/" % (parentFolder, currentFolder, currentSubFolder)
-                os.mkdir(currentFolderStr)
-        if recordThisTime and not recordAllFrames:
-            cv2.imwrite('%sdetect.crosswalk.%s.jpg' % (prefixDetectionSnapshots, detectTimestamp), crosswalk_numpy_img)
-            cv2.imwrite('%sdetect.road.%s.jpg' % (prefixDetectionSnapshots, detectTimestamp), road_numpy_img)
-        if recordThisTime:
-            detectfile.write("\n----------\n-- RAW DETECTIONS AT %s: %d pedestrians, %d vehicles\n" % (
-                detectTimestamp, len(pedestrianDetections), len(vehicleDetections)))
-            for d in pedestrianDetections:
-                detectfile.write("%s\n" % str(d))
-            for d in vehicleDetections:
-                detectfile.write("%s\n" % str(d))
-            try:
-                detectfile.write("-- PED UP   (INDEXES IN PEDESTRIAN DETECTIONS): %s\n" % str(ped_up_idxs))
-                detectfile.write("-- PED DOWN (INDEXES IN PEDESTRIAN DETECTIONS): %s\n" % str(ped_down_idxs))
-                detectfile.write("-- VEH      (INDEXES IN PEDESTRIAN DETECTIONS): %s\n" % str(veh_idxs))
-            except:
-                pass
-
-        # Relate previous detections to new ones
-        # updating trackers
-        vehicle_idxs, removed_vehicle_idxs = veh_tracker.assign_incomming_positions(
-            np.array([x.center for x in veh_bboxes]))
-        pedestrian_idxs, removed_pedestrian_idxs = ped_tracker.assign_incomming_positions(
-            np.array([x.center for x in ped_up_bboxes + ped_down_bboxes]))
-        # going_up, going_down is to keep track of pedestrians who have been detected to cross the crosswalk
-        going_up, going_down = peds_tracked.update_pos(removed_pedestrian_idxs, pedestrian_idxs[:len(ped_up_bboxes)],
-                                                       ped_up_bboxes, pedestrian_idxs[len(ped_up_bboxes):],
-                                                       ped_down_bboxes)
-        new_vehicle_idxs = vehs_tracked.update_pos(removed_vehicle_idxs, vehicle_idxs, veh_bboxes)
-
-        # count vehicles and pedestrian and post regular counts to the backend
-        counters.add(new_vehicle_idxs, going_up, going_down)
-
-        # ---------------------------------------
-        #
-        #         MANAGING SECURITY
-        #
-        # ---------------------------------------
-
-        if useTrackerForWarnings:
-            activateWarnings = vehs_tracked.any_currently_tracked() and peds_tracked.any_currently_tracked()
-        else:
-            activateWarnings = veh_bboxes and (ped_up_bboxes or ped_down_bboxes)
-
-        if activateWarnings:
-            # Security actions Here
-            if is_jetson:
-                # Activate Warnings
-                gpio.warning_ON()
-                print("ACTIVATE WARNINGS!!!!!")
-                if recordDetections:
-                    recordThisTime = True
-                    detectfile.write("\n  -- WARNING ACTIVATED!!!!  --\n")
-                # Deactivate Warnings after DELAY_TIME
-                scheduler.cancel()
-                scheduler = Timer(DELAY_TIME, gpio.warning_OFF, ())
-                scheduler.start()
-
-            else:
-
-                # Deactivate Warnings after DELAY_TIME
-                scheduler.cancel()  # Cancel every possible Scheduler Thread
-                scheduler = Timer(DELAY_TIME, gpio.security_OFF, ())  # Restart
-                scheduler.start()
-
-        if recordThisTime:
-            recordThisTime = False
-            detectfile.flush()
-        # ---------------------------------------
-        #
-        #           SHOWING PROGRAM INFO
-        #
-        # ---------------------------------------
-
-        consoleConfig.fps = 1.0 / (time.time() - start_time)
-        consoleConfig.warnings = scheduler.is_alive()  # if True warnings are still ON
-
-        if (not accelerated_gstreamer or doZeroCopy) and SHOW_INPUTS_IF_JETSON:
-            contour.drawContour(road_numpy_img, roadContour)
-            contour.drawContour(crosswalk_numpy_img, crossContourUp)
-            contour.drawContour(crosswalk_numpy_img, crossContourDown)
-            if useTrackerForWarnings:
-                crosswalk_numpy_img = info.print_items_to_frame(crosswalk_numpy_img, peds_tracked.get_tracked_bboxes())
-                road_numpy_img = info.print_items_to_frame(road_numpy_img, vehs_tracked.get_tracked_bboxes())
-            else:
-                crosswalk_numpy_img = info.print_bboxes_to_frame(crosswalk_numpy_img, ped_up_bboxes)
-                crosswalk_numpy_img = info.print_bboxes_to_frame(crosswalk_numpy_img, ped_down_bboxes)
-                road_numpy_img = info.print_bboxes_to_frame(road_numpy_img, veh_bboxes)
-            cv2.imshow("crosswalk", crosswalk_numpy_img)
-            cv2.imshow("road", road_numpy_img)
-
+    lastOutputTime = time.time()
+    frameCount = 0
+    keyframeSelector = scheduling.KeyframeSelector('snapshots', min_interval=snapshotMinInterval)
+    if useRetention:
+        retentionManager = retention.RetentionManager(
+            {folder: megabytes * 1024 * 1024 for folder, megabytes in retentionMegabytes.items()},
+            min_free_bytes=minFreeMegabytes * 1024 * 1024, resume_free_bytes=resumeFreeMegabytes * 1024 * 1024)
+
+    if recordEventClips:
+        crosswalkClips, roadClips = [
+            writers.EventClipRecorder(prefixEventClips, name, pre_seconds=eventClipPreSeconds,
+                                      post_seconds=eventClipPostSeconds,
+                                      max_bytes=eventClipMaxMegabytes * 1024 * 1024,
+                                      jpeg_quality=eventClipJpegQuality, fps=recordFps)
+            for name in ('crosswalk', 'road')]
+
+    imageWriter = writers.ImageWriter(workers=IMAGE_WRITER_THREADS, maxsize=IMAGE_WRITER_QUEUE_SIZE,
+                                      image_format=IMAGE_FORMAT, quality=IMAGE_QUALITY, policy=IMAGE_WRITER_POLICY,
+                                      name='snapshots')
+
+    # capture, detection, tracking and output (snapshots, logs, display) run in their own threads,
+    # joined by bounded queues. Stale frame pairs of live cameras are dropped before detection,
+    # but every detection result reaches the trackers so counts stay right, and the output stage
+    # so nothing to be recorded is lost
+    videoPipeline = pipeline.Pipeline()
+    videoPipeline.add_stage('capture', capture_stage)
+    videoPipeline.add_stage('detect', detect_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_oldest=not REPLAY_LOSSLESS,
+                            on_drop=rearm_snapshot)
+    videoPipeline.add_stage('track', track_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_oldest=False)
+    videoPipeline.add_stage('output', output_stage, maxsize=PIPELINE_QUEUE_SIZE, drop_oldest=False)
+
+    if useControlSocket:
+        controlServer = control.ControlServer(controlSocket)
+        controlServer.register('snapshot', request_snapshot, help='save snapshots from both cameras')
+        controlServer.register('state', dump_trackers, deferred=True, help='active traces of the trackers')
+        controlServer.register('stats', report_stats, help='pipeline, capture and writer stats')
+        controlServer.register('reload', reload_contours, deferred=True, help='load the contours from resources/ again')
+        controlServer.register('record', set_recording, help='record start|stop: record every frame')
+
+    # a failed stage, Ctrl+C or a signal stop the pipeline: save what is queued before exiting
+    try:
+        videoPipeline.run()
+    finally:
         # ----------------------------------
         #
         #           PROGRAM END
         #
         # ----------------------------------
 
-        if isdaemon:
-            time_delta = datetime.datetime.now() - timestart
-            # print(time_delta)
-            systemd.daemon.notify('WATCHDOG=1')
-            delta_minutes = time_delta.seconds // 60
-            if delta_minutes != minute_count:
-                info.print_console(consoleConfig)
-                minute_count = delta_minutes
-        else:
-            # SHOW DATA IN CONSOLE
-            info.print_console(consoleConfig)
-            # Quit program pressing 'q'
-            key = cv2.waitKey(1) & 0xFF
-            if key == ord("q"):
-                if recordDetections:
-                    detectfile.close()
-                # free GPIOs before quit
-                if is_jetson:
-                    gpio.warning_OFF()
-                    gpio.deactivate_jetson_board()
-                # close any open windows
-                cv2.destroyAllWindows()
-                break
-
+        if useControlSocket:
+            controlServer.close()
+        if recordDetections:
+            detectJournal.close()
+        if useCaptureThreads:
+            crosswalkReader.stop()
+            roadReader.stop()
+        # write the snapshots and recorded frames still queued
+        imageWriter.close()
+        if recordAllFrames:
+            crosswalkRecorder.close()
+            roadRecorder.close()
+        if recordEventClips:
+            crosswalkClips.close()
+            roadClips.close()
+        if useRetention:
+            retentionManager.close()
+        # post the counters still queued
+        counters.close()
+        # free GPIOs before quit
+        if is_jetson:
+            gpio.warning_OFF()
+            gpio.deactivate_jetson_board()
+        # close any open windows
+        cv2.destroyAllWindows()
@@ -5,6 +5,8 @@ import subprocess
 import os
 import datetime
 
+from utils import retention
+
 isdaemon = "DAEMONIZE_ME" in os.environ and os.environ["DAEMONIZE_ME"] in ["on", "1", "true"]
 
 def get_actual_video_indexes():
@@ -25,14 +27,19 @@ def get_nontegra_cameras():
       nontegra_cameras.append(idx)
   return nontegra_cameras
 
+# every recording goes to its own folder inside prefixRecordings; the oldest segments
+# are deleted to keep them all under recordingsMegabytes
+prefixRecordings = 'recordings/'
+recordingsMegabytes = 16384
+
 def run_script():
   idxs = get_nontegra_cameras()
   processes = []
-  prefix = ''
+  prefix = prefixRecordings
   timestamp = datetime.datetime.now().strftime("%Y.%m.%d.%H.%M")
   prefix = prefix+timestamp+"/"
-  #os.makedirs(prefix, exist_ok=True)
-  os.mkdir(prefix)
+  os.makedirs(prefix, exist_ok=True)
+  retentionManager = retention.RetentionManager({prefixRecordings: recordingsMegabytes * 1024 * 1024}, period=30.0)
   command = "gst-launch-1.0 v4l2src device=%s ! 'video/x-raw, width=(int)640, height=(int)480, format=YUY2' ! videoconvert ! 'video/x-raw,format=(string)NV12,width=640,height=480,framerate=(fraction)30/1' ! queue ! x264enc pass=5 quantizer=22 speed-preset=3 ! splitmuxsink max-size-time=60000000000 async-finalize=true location=%sdevice%d_%s_%%05d.mp4"
   #command =  "ffmpeg -hide_banner -loglevel error -nostdin -video_size 640x480 -input_format yuyv422 -i %s -c:v libx264 -preset veryfast -crf 22 -r 15 -f segment -segment_time 60 -strftime 1 -reset_timestamps 1 '%sdevice%d-%%Y.%%m.%%d.%%H.%%M.mp4'"
   for idx in idxs:
@@ -57,6 +64,7 @@ def run_script():
     print("Start Waiting for one process")
     p.wait()
     print("End Waiting for one process")
+  retentionManager.close()
   print("Ending script")
 
 #let's sleep 60 seconds because of automount issues at boot time
@@ -0,0 +1,82 @@
+import numpy as np
+
+from utils import tracking
+
+
+def loop_suppression(pedestrian_centers, motorcycle_centers, min_distance):
+    """ Reference implementation: the former rider filter of main.py """
+    keep = []
+    for pcenter in pedestrian_centers:
+        valid = True
+        for mcenter in motorcycle_centers:
+            if (abs(mcenter[0] - pcenter[0]) < min_distance and
+                    abs(mcenter[1] - pcenter[1]) < min_distance):
+                valid = False
+                break
+        keep.append(valid)
+    return np.array(keep, dtype=bool)
+
+
+def test_chebyshev_matches_loop():
+    rng = np.random.default_rng(0)
+    for n in (1, 5, 50, 200):
+        pedestrians = rng.integers(0, 640, size=(n, 2))
+        motorcycles = rng.integers(0, 640, size=(max(1, n // 5), 2))
+        np.testing.assert_array_equal(tracking.suppression_keep_mask(pedestrians, motorcycles, 'chebyshev', 70),
+                                      loop_suppression(pedestrians, motorcycles, 70))
+
+
+def test_chebyshev_distance_limit():
+    pedestrians = np.array([[100, 100], [300, 300]])
+    # exactly at the limit on one axis: kept, as in the loop (strict comparison)
+    at_limit = np.array([[170, 100], [300, 370]])
+    np.testing.assert_array_equal(tracking.suppression_keep_mask(pedestrians, at_limit, 'chebyshev', 70), [True, True])
+    # just inside on both axes: suppressed
+    inside = np.array([[169, 31]])
+    np.testing.assert_array_equal(tracking.suppression_keep_mask(pedestrians, inside, 'chebyshev', 70), [False, True])
+    for motorcycles in (at_limit, inside):
+        np.testing.assert_array_equal(tracking.suppression_keep_mask(pedestrians, motorcycles, 'chebyshev', 70),
+                                      loop_suppression(pedestrians, motorcycles, 70))
+
+
+def test_no_candidates_or_references():
+    pedestrians = np.array([[100, 100]])
+    np.testing.assert_array_equal(tracking.suppression_keep_mask(pedestrians, np.zeros((0, 2)), 'chebyshev', 70), [True])
+    assert tracking.suppression_keep_mask(np.zeros((0, 2)), pedestrians, 'chebyshev', 70).shape == (0,)
+
+
+def test_overlap():
+    # a box half covered is suppressed at 0.5, kept above
+    boxes = np.array([[0, 0, 10, 10], [100, 100, 110, 110]])
+    cover = np.array([[5, 0, 20, 10]])
+    np.testing.assert_array_equal(tracking.suppression_keep_mask(boxes, cover, 'overlap', 0.5), [False, True])
+    np.testing.assert_array_equal(tracking.suppression_keep_mask(boxes, cover, 'overlap', 0.6), [True, True])
+
+
+def test_rider_filter_uses_updated_motorcycles():
+    # as the rider filter of main.py: motorcycles updated first, pedestrians filtered with their tracked positions
+    tracker = tracking.MultiClassTracker({'pedestrian': (200, 10), 'motorcycle': (200, 1)}, 200 * 100)
+    motorcycle = tracker.class_index['motorcycle']
+    tracker.update(np.array([[100, 100], [500, 400]]), [motorcycle, motorcycle], class_names=['motorcycle'])
+    # the first one moved: its previous position no longer suppresses; the second one was not detected, its last one does
+    tracker.update(np.array([[250, 100]]), [motorcycle], class_names=['motorcycle'])
+    pedestrians = np.array([[100, 100], [250, 110], [500, 390]])
+    np.testing.assert_array_equal(
+        tracking.suppression_keep_mask(pedestrians, tracker.class_positions('motorcycle'), 'chebyshev', 70),
+        [True, False, False])
+    # not detected for too long: removed, it does not suppress anymore
+    tracker.update(np.array([[260, 100]]), [motorcycle], class_names=['motorcycle'])
+    np.testing.assert_array_equal(
+        tracking.suppression_keep_mask(pedestrians, tracker.class_positions('motorcycle'), 'chebyshev', 70),
+        [True, False, True])
+
+
+def test_update_leaves_other_classes_alone():
+    tracker = tracking.MultiClassTracker({'pedestrian': (200, 1), 'motorcycle': (200, 1)}, 200 * 100)
+    pedestrian, motorcycle = tracker.class_index['pedestrian'], tracker.class_index['motorcycle']
+    tracker.update(np.array([[100, 100]]), [pedestrian], class_names=['pedestrian'])
+    # a motorcycle next to the pedestrian trace starts its own trace, and the pedestrian skips no frames
+    for _ in range(3):
+        events = tracker.update(np.array([[110, 100]]), [motorcycle], class_names=['motorcycle'])
+    assert tracker.class_positions('pedestrian').tolist() == [[100, 100]]
+    assert len(events.new['motorcycle']) == 0 and not events.removed['pedestrian']
@@ -5,6 +5,8 @@ from firebase_admin import firestore
 import json
 import time
 import datetime
+import threading
+from collections import deque
 
 import warnings
 
@@ -64,10 +66,15 @@ class DataCounter:
       The last one is one of 'm' (minute), 'h', (hour), or 'd' (day)."""
     return {k+period[0]: getattr(c, period) for k, c in zip('vpud', self.all)}
 
+# Firestore limit of writes in a batch
+MAX_BATCH_WRITES = 500
+
 class BackEnd:
-  """ class to write vehicle / pedestrian counters to the cloud backend """
+  """ class to write vehicle / pedestrian counters to the cloud backend.
+    Posting never blocks: documents are queued (up to maxsize, the oldest are dropped beyond it)
+    and a background thread writes everything queued in one batch, retrying with exponential backoff """
 
-  def __init__(self, projName, credfile):
+  def __init__(self, projName, credfile, maxsize=4096, min_backoff=1.0, max_backoff=300.0):
     cred = credentials.Certificate(credfile)
     firebase_admin.initialize_app(cred, {
       'projectId': projName,
@@ -77,13 +84,97 @@ class BackEnd:
 
     self.format = {'minute': "%Y:%m:%d:%H:%M", 'hour': "%Y:%m:%d:%H", 'day': "%Y:%m:%d"}
 
+    self.maxsize     = maxsize
+    self.min_backoff = min_backoff
+    self.max_backoff = max_backoff
+    self.items       = deque()  # (period, entry, data) waiting to be written, oldest first
+    self.cond        = threading.Condition()
+    self.closed      = False
+    # counters
+    self.queued      = 0
+    self.posted      = 0
+    self.dropped     = 0
+    self.failed      = 0
+    self.thread = threading.Thread(target=self._run, name='backend-poster', daemon=True)
+    self.thread.start()
+
   def post_data(self, data, now, period):
-    entry = now.strftime(self.format[period])
+    """ queue one document """
+    self.post_many([(period, data)], now)
+
+  def post_many(self, posts, now):
+    """ queue several documents, list of (period, data), to be written in the same batch """
+    with self.cond:
+      if self.closed:
+        return
+      for period, data in posts:
+        self.items.append((period, now.strftime(self.format[period]), data))
+      self.queued += len(posts)
+      self._trim()
+      self.cond.notify_all()
+
+  def _trim(self):
+    while len(self.items) > self.maxsize:
+      period, entry, data = self.items.popleft()
+      self.dropped += 1
+      print('Dropped POST to by_%s at %s: %s' % (period, entry, str(data)))
+
+  def _commit(self, posts):
     try:
-      doc_ref = self.fb.collection('by_'+period).document(entry)
-      doc_ref.set(data)
-    except:
-      print('Failed to POST data to by_%s at %s: %s' % (period, entry, str(data)))
+      batch = self.fb.batch()
+      for period, entry, data in posts:
+        batch.set(self.fb.collection('by_'+period).document(entry), data)
+      batch.commit()
+      return True
+    except Exception as e:
+      print('Failed to POST data to %s: %s' % (', '.join('by_%s at %s' % (period, entry) for period, entry, _ in posts), str(e)))
+      return False
+
+  def _run(self):
+    backoff = 0
+    while True:
+      with self.cond:
+        if backoff:
+          self.cond.wait_for(lambda: self.closed, backoff)
+        self.cond.wait_for(lambda: self.items or self.closed)
+        if not self.items:
+          return
+        posts = [self.items.popleft() for _ in range(min(len(self.items), MAX_BATCH_WRITES))]
+        closing = self.closed
+      ok = self._commit(posts)
+      with self.cond:
+        if ok:
+          self.posted += len(posts)
+          backoff = 0
+          continue
+        self.failed += 1
+        if closing:
+          # one last try when closing, the rest is lost
+          self.dropped += len(posts) + len(self.items)
+          self.items.clear()
+          return
+        # back to the head of the queue, for the next try
+        self.items.extendleft(reversed(posts))
+        self._trim()
+      backoff = min(self.max_backoff, backoff * 2 if backoff else self.min_backoff)
+
+  def close(self, timeout=10.0):
+    """ write the queued documents (waiting up to timeout seconds) and stop the background thread """
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    self.thread.join(timeout)
+
+  def stats(self):
+    with self.cond:
+      return {
+        'name': 'backend',
+        'queued': self.queued,
+        'pending': len(self.items),
+        'written': self.posted,
+        'dropped': self.dropped,
+        'failed': self.failed,
+      }
 
 class RecordCounters:
   """ Glue logic to count things and save the counters to the backend """
@@ -122,14 +213,25 @@ class RecordCounters:
     now = datetime.datetime.now()
     # this check is redundant with the next one, but this way we avoid multiple dynamic checks every frame
     if self.current_minute != now.minute:
+      posts = []
       for period, current, record in self.names:
         actual = getattr(now, period)
         if getattr(self, current)!=actual:
           setattr(self, current, actual)
           if record and self.counters.any_counted(period):
-           data = self.counters.get_data(period)
-           self.backend.post_data(data, now, period)
+           posts.append((period, self.counters.get_data(period)))
            self.counters.reset(period)
         else:
           break
+      # minute, hour and day changes are written together, by the background thread
+      if posts:
+        self.backend.post_many(posts, now)
+
+  def stats(self):
+    return self.backend.stats() if self.recordAny else None
+
+  def close(self):
+    """ write the documents still queued """
+    if self.recordAny:
+      self.backend.close()
 
@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import deque
+
+
+class CameraReader:
+    """
+    Reads frames from a camera in a background thread.
+    Only the newest decoded frame is kept, so the main loop never
+    gets a stale frame from the V4L2 queue when detection is slower
+    than the camera rate.
+    """
+
+    def __init__(self, source, name, history=1):
+        """
+        :param source: FrameSource object (live camera or recorded footage).
+                       If the source is lossless, the reader waits for each frame
+                       to be consumed before reading the next one, so no frames
+                       of a recording replayed as fast as possible are skipped
+        :param name: str, name used for the thread and the stats
+        :param history: int, number of recent frames kept for timestamp pairing
+        """
+        self.source = source
+        self.name = name
+
+        self.cond = threading.Condition()
+        self.frame = None
+        self.timestamp = None
+        self.seq = 0                # sequence number of the newest frame
+        self.consumed_seq = 0       # sequence number of the last frame returned as new
+        self.history = deque(maxlen=max(1, history))  # (seq, timestamp, frame), oldest first
+        self.running = False
+        self.finished = False
+
+        # counters
+        self.frames_read = 0        # frames decoded by the reader thread
+        self.frames_dropped = 0     # frames overwritten before the loop took them
+        self.stale_reads = 0        # latest() calls returning an already consumed frame
+        self.last_staleness = 0.0   # age (seconds) of the frame returned by latest()
+        self.max_staleness = 0.0
+
+        self.thread = threading.Thread(target=self._run, name='reader-' + name, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        self.thread.join()
+        self.source.release()
+
+    def _run(self):
+        while self.running:
+            if self.source.lossless:
+                # do not overwrite a frame of a recording before it is used
+                with self.cond:
+                    while self.running and self.consumed_seq != self.seq:
+                        self.cond.wait()
+                if not self.running:
+                    break
+            if not self.source.grab():
+                break
+            timestamp = self.source.timestamp
+            ok, frame = self.source.retrieve()
+            if not ok:
+                break
+            with self.cond:
+                if self.consumed_seq != self.seq:
+                    self.frames_dropped += 1
+                self.frame = frame
+                self.timestamp = timestamp
+                self.seq += 1
+                self.history.append((self.seq, timestamp, frame))
+                self.frames_read += 1
+                self.cond.notify_all()
+        with self.cond:
+            self.finished = True
+            self.cond.notify_all()
+
+    def latest(self):
+        """
+        Non-blocking access to the newest frame
+        :return: frame (None if nothing was read yet), capture timestamp,
+                 and bool telling whether the frame was not returned before
+        """
+        with self.cond:
+            if self.frame is None:
+                return None, None, False
+            is_new = self.consumed_seq != self.seq
+            if is_new:
+                self.consumed_seq = self.seq
+                self.cond.notify_all()
+            else:
+                self.stale_reads += 1
+            self.last_staleness = time.time() - self.timestamp
+            self.max_staleness = max(self.max_staleness, self.last_staleness)
+            return self.frame, self.timestamp, is_new
+
+    def wait_new(self, timeout=None):
+        """
+        Blocks until there is a frame not yet returned by latest()
+        :param timeout: float, maximum seconds to wait
+        :return: bool, False if the camera stopped producing frames or the timeout expired
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.consumed_seq != self.seq or self.finished, timeout)
+            return self.consumed_seq != self.seq
+
+    def wait_newer(self, seq, timeout=None):
+        """
+        Blocks until the reader has a frame newer than seq
+        :param seq: int, sequence number already seen by the caller
+        :param timeout: float, maximum seconds to wait
+        :return: bool, False if the camera stopped producing frames or the timeout expired
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.seq > seq or self.finished, timeout)
+            return self.seq > seq
+
+    def recent(self):
+        """
+        :return: list of (seq, timestamp, frame) tuples of the recent frames, oldest first
+        """
+        with self.cond:
+            return list(self.history)
+
+    def consume(self, seq):
+        """
+        Marks every frame up to seq as taken by the caller
+        :param seq: int, sequence number of the frame taken
+        """
+        with self.cond:
+            if seq > self.consumed_seq:
+                self.consumed_seq = seq
+                self.cond.notify_all()
+            for s, timestamp, _ in self.history:
+                if s == seq:
+                    self.last_staleness = time.time() - timestamp
+                    self.max_staleness = max(self.max_staleness, self.last_staleness)
+
+    def stats(self):
+        """
+        :return: dict with the reader counters
+        """
+        with self.cond:
+            return {
+                'name': self.name,
+                'read': self.frames_read,
+                'dropped': self.frames_dropped,
+                'stale': self.stale_reads,
+                'staleness': self.last_staleness,
+                'max_staleness': self.max_staleness,
+            }
+
+
+def start_readers(sources, names, history=1):
+    """
+    Starts one reader thread per frame source
+    :param sources: list of FrameSource objects
+    :param names: list of str, names of the cameras
+    :param history: int, number of recent frames kept by each reader
+    :return: list of started CameraReader objects
+    """
+    return [CameraReader(source, name, history=history).start() for source, name in zip(sources, names)]
@@ -1,10 +1,14 @@
 import cv2
-import jetson
 from os import path
 from numpy import save, load
 from numpy import array
 import warnings
 import numpy as np
+from utils.utils import is_jetson_platform
+
+if is_jetson_platform():
+    import jetson.utils  # prevents jetson.utils to be imported on non jetson devices
+
 
 def drawContour(image, contour):
     
@@ -37,6 +41,78 @@ def is_point_in_contour(contour, point):
     return is_point_inside_box
 
 
+class ZoneMap:
+    
+    """
+    Label image the size of the frame, precomputed from the contours of a camera:
+    pixels inside the i-th contour are labelled i+1 (the first contour wins where they overlap)
+    and the rest OUTSIDE, so a whole array of points is classified with one indexing operation
+    instead of a pointPolygonTest per point and contour
+    """
+    
+    OUTSIDE = 0
+    
+    def __init__(self, contours, width, height):
+        """
+        :param contours: list of contours (arrays of points on frame), at most 255
+        :param width: int, frame width
+        :param height: int, frame height
+        """
+        self.width = width
+        self.height = height
+        self.labels_map = None
+        self.set_contours(contours)
+    
+    def set_contours(self, contours):
+        """
+        Rebuilds the label image, to be called whenever the contours are reloaded
+        :param contours: list of contours
+        """
+        if len(contours) > 255:
+            raise Exception('A zone map takes at most 255 contours, got %d' % len(contours))
+        labels_map = np.zeros((self.height, self.width), dtype=np.uint8)
+        # the first contours are drawn last, so they win where contours overlap (as in an if / elif chain)
+        for label, c in reversed(list(enumerate(contours, start=1))):
+            cv2.fillPoly(labels_map, [np.asarray(c, dtype=np.int32).reshape(-1, 2)], label)
+        self.contours = contours
+        self.labels_map = labels_map
+    
+    def labels(self, points):
+        """
+        Zone labels of several points
+        :param points: numpy array or list, (n, 2) x, y coordinates
+        :return: numpy array, (n,) uint8 labels (OUTSIDE for points out of every contour or out of the frame)
+        """
+        labels_map = self.labels_map
+        points = np.round(np.asarray(points, dtype=np.float32).reshape(-1, 2)).astype(np.int64)
+        x = points[:, 0]
+        y = points[:, 1]
+        inside = (x >= 0) & (x < self.width) & (y >= 0) & (y < self.height)
+        labels = np.full(points.shape[0], self.OUTSIDE, dtype=np.uint8)
+        labels[inside] = labels_map[y[inside], x[inside]]
+        return labels
+
+
+def get_padded_bounding_rect(contours, padding, width, height):
+    
+    """
+    Bounding rectangle of several contours, padded and clipped to the frame
+    :param contours: list of contours (arrays of points on frame)
+    :param padding: int, pixels added on every side
+    :param width: int, frame width
+    :param height: int, frame height
+    :return: tuple, (x, y, w, h) of the rectangle
+    """
+    
+    points = np.concatenate([np.asarray(c, dtype=np.int32).reshape(-1, 2) for c in contours], axis=0)
+    x, y, w, h = cv2.boundingRect(points)
+    x1 = max(0, x - padding)
+    y1 = max(0, y - padding)
+    x2 = min(width, x + w + padding)
+    y2 = min(height, y + h + padding)
+    return x1, y1, x2 - x1, y2 - y1
+
+
 def save_contour(contour, name):
     """
     Saves list of points
@@ -0,0 +1,134 @@
+import json
+import os
+import socket
+import socketserver
+import threading
+from collections import deque
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline(4096).decode('utf-8', 'replace').strip()
+        response = self.server.control.execute(line)
+        # numpy scalars (e.g. in the stats) as plain numbers
+        data = json.dumps(response, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+        self.wfile.write((data + '\n').encode('utf-8'))
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer:
+    """
+    Serves commands on a Unix-domain socket from a background thread: one line per connection
+    (the command name and its arguments, separated by spaces), answered with one JSON line,
+    {"ok": true, "result": ...} or {"ok": false, "error": "..."}.
+    Commands registered as deferred run in the thread that calls run_pending() (e.g. between two
+    frames of a pipeline stage), for the ones that touch its state.
+    """
+
+    def __init__(self, path, timeout=5.0):
+        """
+        :param path: str, socket path (a stale socket file left there is replaced)
+        :param timeout: float, seconds a deferred command waits to be run
+        """
+        self.path = path
+        self.timeout = timeout
+        self.commands = {}          # command name -> (function, deferred, help)
+        self.pending = deque()      # deferred commands waiting for run_pending()
+        self.register('help', lambda args: {name: command[2] for name, command in sorted(self.commands.items())},
+                      help='list the commands')
+
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = _Server(path, _Handler)
+        self.server.control = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='control-server', daemon=True)
+        self.thread.start()
+
+    def register(self, name, function, deferred=False, help=''):
+        """
+        :param name: str, command name
+        :param function: callable taking the list of arguments (str) and returning a JSON-serializable result,
+                         raising ValueError for wrong arguments
+        :param deferred: bool, run it in the thread calling run_pending() instead of the socket thread
+        :param help: str, description shown by the 'help' command
+        """
+        self.commands[name] = (function, deferred, help)
+
+    def execute(self, line):
+        """
+        :param line: str, command and arguments
+        :return: dict, response
+        """
+        words = line.split()
+        if not words or words[0] not in self.commands:
+            return {'ok': False, 'error': 'unknown command %r, try help' % line}
+        function, deferred, _ = self.commands[words[0]]
+        if not deferred:
+            return self._call(function, words[1:])
+        item = [function, words[1:], threading.Event(), None]
+        self.pending.append(item)
+        if not item[2].wait(self.timeout):
+            # still queued if nobody ran it: take it out
+            try:
+                self.pending.remove(item)
+            except ValueError:
+                item[2].wait()
+                return item[3]
+            return {'ok': False, 'error': 'command not run in %.1fs' % self.timeout}
+        return item[3]
+
+    @staticmethod
+    def _call(function, args):
+        try:
+            return {'ok': True, 'result': function(args)}
+        except ValueError as e:
+            return {'ok': False, 'error': str(e)}
+        except Exception as e:
+            print('Control command failed: %r' % e)
+            return {'ok': False, 'error': repr(e)}
+
+    def run_pending(self):
+        """
+        Runs the deferred commands received meanwhile (cheap when there are none)
+        """
+        while self.pending:
+            try:
+                item = self.pending.popleft()
+            except IndexError:
+                return
+            item[3] = self._call(item[0], item[1])
+            item[2].set()
+
+    def close(self):
+        """
+        Stops serving and removes the socket file
+        """
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def send_command(path, line, timeout=10.0):
+    """
+    Client side of ControlServer
+    :param path: str, socket path
+    :param line: str, command and arguments
+    :param timeout: float, seconds to wait for the answer
+    :return: dict, response
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall((line.strip() + '\n').encode('utf-8'))
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return json.loads(data.decode('utf-8'))
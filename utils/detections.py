@@ -0,0 +1,87 @@
+import numpy as np
+
+from utils import classes_yolo
+
+# Colors for known classes (the rest are drawn in white)
+classColors = {
+    'person': (255, 0, 0),
+    'car': (0, 255, 0),
+    'bicycle': (0, 0, 255),
+    'motorcycle': (255, 255, 0),
+    'bus': (0, 255, 255),
+    'truck': (255, 0, 255),
+}
+UNKNOWN_COLOR = (255, 255, 255)
+
+# color of each class id
+colorTable = [classColors.get(name, UNKNOWN_COLOR) for name in classes_yolo.classesDict]
+
+
+def class_lookup(names):
+    """
+    Precomputed class filter, to be indexed with class ids
+    :param names: list of str, class names
+    :return: numpy bool array, True for the ids of the given classes
+    """
+    lookup = np.zeros(len(classes_yolo.classesDict), dtype=bool)
+    lookup[[classes_yolo.classesDict.index(name) for name in names]] = True
+    return lookup
+
+
+class DetectionBatch:
+    """
+    Detections of one frame as numpy columns (instead of one object per detection):
+    boxes, centers, class ids, scores and zone labels
+    """
+
+    def __init__(self, boxes=None, class_ids=None, scores=None, zones=None):
+        """
+        :param boxes: (n, 4) array, x1, y1, x2, y2 in pixels (truncated to integers)
+        :param class_ids: (n,) array, classes_yolo ids
+        :param scores: (n,) array, confidences
+        :param zones: (n,) array, zone labels (see contour.ZoneMap), 0 if not given
+        """
+        self.boxes = np.zeros((0, 4), dtype=np.int32) if boxes is None else \
+            np.asarray(boxes).astype(np.int32).reshape(-1, 4)
+        n = self.boxes.shape[0]
+        self.class_ids = np.zeros(n, dtype=np.int64) if class_ids is None else \
+            np.asarray(class_ids).astype(np.int64).reshape(-1)
+        self.scores = np.zeros(n, dtype=np.float32) if scores is None else \
+            np.asarray(scores, dtype=np.float32).reshape(-1)
+        self.zones = np.zeros(n, dtype=np.uint8) if zones is None else np.asarray(zones, dtype=np.uint8).reshape(-1)
+        # centers rounded half to even, as the former BBox objects did
+        self.centers = np.round((self.boxes[:, :2] + self.boxes[:, 2:]) / 2).astype(np.int32)
+
+    def __len__(self):
+        return self.boxes.shape[0]
+
+    def select(self, selector):
+        """
+        :param selector: bool mask or array of indexes
+        :return: DetectionBatch with the selected detections
+        """
+        return DetectionBatch(self.boxes[selector], self.class_ids[selector], self.scores[selector], self.zones[selector])
+
+    def in_classes(self, lookup):
+        """
+        :param lookup: numpy bool array from class_lookup()
+        :return: numpy bool array, True for the detections of those classes
+        """
+        return lookup[self.class_ids]
+
+    def records(self):
+        """
+        :return: (n, 5) int32 array, box and class id of each detection (rows can be kept by the trackers)
+        """
+        return np.concatenate([self.boxes, self.class_ids[:, None].astype(np.int32)], axis=1)
+
+    @staticmethod
+    def concatenate(batches):
+        """
+        :param batches: list of DetectionBatch
+        :return: DetectionBatch with the detections of all of them, in order
+        """
+        return DetectionBatch(np.concatenate([b.boxes for b in batches]),
+                              np.concatenate([b.class_ids for b in batches]),
+                              np.concatenate([b.scores for b in batches]),
+                              np.concatenate([b.zones for b in batches]))
@@ -0,0 +1,253 @@
+import os.path
+import threading
+
+import cv2
+import numpy as np
+
+from utils import classes_yolo, classes_ssd
+
+
+class Detector:
+    """
+    Common interface of the object detection backends.
+    detect() takes a BGR numpy frame and returns the same structure as TrtYOLO.detect():
+    boxes (n,4) int array of x1, y1, x2, y2 in frame coordinates, confidences (n,) float
+    array and class ids (n,) float array indexing classes_yolo.classesDict,
+    so every backend feeds the same DetectionBatch.
+    detect_batch() does the same for several frames; backends that cannot
+    batch their inputs just call detect() for every frame.
+    """
+
+    def detect(self, frame, conf_th):
+        raise NotImplementedError
+
+    def detect_batch(self, frames, conf_th):
+        """
+        :param frames: list of BGR numpy frames
+        :param conf_th: float, minimum confidence
+        :return: list with the (boxes, confidences, class ids) of every frame
+        """
+        return [self.detect(frame, conf_th) for frame in frames]
+
+    def detect_batch_rois(self, frames, rois, conf_th):
+        """
+        Detects objects only inside a region of interest of each frame, so the network
+        input spends its pixels on the region that matters. Boxes are returned in
+        full frame coordinates.
+        :param frames: list of BGR numpy frames
+        :param rois: list of (x, y, w, h) rectangles, one per frame (None for the full frame)
+        :param conf_th: float, minimum confidence
+        :return: list with the (boxes, confidences, class ids) of every frame
+        """
+        crops = [frame if roi is None else np.ascontiguousarray(frame[roi[1]:roi[1] + roi[3], roi[0]:roi[0] + roi[2]])
+                 for frame, roi in zip(frames, rois)]
+        results = []
+        for (boxes, confs, clss), roi in zip(self.detect_batch(crops, conf_th), rois):
+            if roi is not None and len(boxes):
+                boxes = np.array(boxes, dtype=np.int32)
+                boxes[:, [0, 2]] += roi[0]
+                boxes[:, [1, 3]] += roi[1]
+            results.append((boxes, confs, clss))
+        return results
+
+
+def empty_detections():
+    return np.zeros((0, 4), dtype=np.int32), np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.float32)
+
+
+class TrtYoloDetector(Detector):
+    """
+    YOLO network accelerated with TensorRT (Jetson)
+    """
+
+    def __init__(self, model, category_num=80, letter_box=True):
+        """
+        :param model: str, model name, e.g. 'yolov4-tiny-416' (yolo/<model>.trt)
+        :param category_num: int, number of classes
+        :param letter_box: bool, keep aspect ratio when resizing frames
+        """
+        from utils_yolo.yolo_with_plugins import TrtYOLO
+        self.net = TrtYOLO(model, category_num, letter_box)
+
+    def detect(self, frame, conf_th):
+        return self.net.detect(frame, conf_th)
+
+
+class DetectNetDetector(Detector):
+    """
+    jetson.inference detectNet network (ssd-mobilenet-v2).
+    SSD class ids are mapped to classes_yolo ids by name; detections of classes
+    not present in classes_yolo are discarded.
+    """
+
+    def __init__(self, arch, threshold, argv=()):
+        """
+        :param arch: str, network name, e.g. 'ssd-mobilenet-v2'
+        :param threshold: float, minimum confidence
+        :param argv: list of str, extra command line arguments for detectNet
+        """
+        import jetson.inference
+        import jetson.utils
+        self.jetson_utils = jetson.utils
+        self.net = jetson.inference.detectNet(arch, list(argv) + ["--log-level=error"], threshold)
+        self.threshold = threshold
+        self.ssd_to_yolo = {i: classes_yolo.classesDict.index(name) if name in classes_yolo.classesDict else -1
+                            for i, name in enumerate(classes_ssd.classesDict)}
+
+    def detect_cuda(self, cuda_img, width, height, conf_th=None):
+        """
+        Detects objects in an image already in CUDA memory
+        :param cuda_img: CUDA image (RGBA)
+        :param width: int, image width
+        :param height: int, image height
+        :param conf_th: float, minimum confidence (defaults to the network threshold)
+        :return: boxes, confidences and class ids, as in Detector.detect()
+        """
+        conf_th = self.threshold if conf_th is None else conf_th
+        boxes, confs, clss = [], [], []
+        for d in self.net.Detect(cuda_img, width, height, "none"):
+            cls = self.ssd_to_yolo.get(d.ClassID, -1)
+            if cls < 0 or d.Confidence < conf_th:
+                continue
+            boxes.append((int(d.Left), int(d.Top), int(d.Right), int(d.Bottom)))
+            confs.append(d.Confidence)
+            clss.append(cls)
+        if not boxes:
+            return empty_detections()
+        return np.array(boxes, dtype=np.int32), np.array(confs, dtype=np.float32), np.array(clss, dtype=np.float32)
+
+    def detect(self, frame, conf_th):
+        height, width = frame.shape[:2]
+        rgba = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
+        cuda_img = self.jetson_utils.cudaFromNumpy(rgba)
+        return self.detect_cuda(cuda_img, width, height, conf_th)
+
+
+class CvDnnYoloDetector(Detector):
+    """
+    YOLO network running on the CPU through OpenCV's dnn module.
+    Loads Darknet (.cfg + .weights) or ONNX models with Darknet-style outputs
+    (rows of cx, cy, w, h, objectness, class scores).
+    """
+
+    def __init__(self, model, config='', input_size=416, nms_th=0.5, num_threads=0, normalized_outputs=True):
+        """
+        :param model: str, .weights or .onnx file
+        :param config: str, .cfg file (Darknet models only)
+        :param input_size: int, network input width and height
+        :param nms_th: float, IoU threshold for non-maximum suppression
+        :param num_threads: int, OpenCV worker threads (0 uses all the cores)
+        :param normalized_outputs: bool, True if boxes are relative to the image size (Darknet),
+                                   False if they are in pixels of the network input
+        """
+        if num_threads > 0:
+            cv2.setNumThreads(num_threads)
+        self.net = cv2.dnn.readNet(model, config)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+        self.output_names = self.net.getUnconnectedOutLayersNames()
+        self.input_size = input_size
+        self.nms_th = nms_th
+        self.normalized_outputs = normalized_outputs
+        # cv2.dnn.Net is not thread safe; inference itself is parallelized by OpenCV
+        self.lock = threading.Lock()
+
+    def forward(self, blob):
+        with self.lock:
+            self.net.setInput(blob)
+            outputs = self.net.forward(self.output_names)
+        return outputs
+
+    def postprocess(self, outputs, width, height, conf_th):
+        """
+        Converts the raw network outputs of one frame to boxes, confidences and class ids
+        :param outputs: list of (n, 5 + classes) arrays
+        :param width: int, frame width
+        :param height: int, frame height
+        :param conf_th: float, minimum confidence
+        """
+        rows = np.concatenate([o.reshape(-1, o.shape[-1]) for o in outputs], axis=0)
+        scores = rows[:, 5:] * rows[:, 4:5]
+        clss = scores.argmax(axis=1)
+        confs = scores[np.arange(len(clss)), clss]
+        keep = confs >= conf_th
+        if not keep.any():
+            return empty_detections()
+        rows, clss, confs = rows[keep], clss[keep], confs[keep]
+
+        scale = 1.0 if self.normalized_outputs else 1.0 / self.input_size
+        cx, cy, w, h = (rows[:, :4] * scale).T
+        x1 = (cx - w / 2) * width
+        y1 = (cy - h / 2) * height
+        boxes_wh = np.stack([x1, y1, w * width, h * height], axis=1)
+
+        # class-aware NMS: shift each class far apart so boxes of different classes never overlap
+        offsets = clss[:, None] * (width + height)
+        shifted = boxes_wh.copy()
+        shifted[:, :2] += offsets
+        idxs = cv2.dnn.NMSBoxes(shifted.tolist(), confs.tolist(), conf_th, self.nms_th)
+        idxs = np.array(idxs, dtype=np.int64).reshape(-1)
+
+        boxes = np.empty((len(idxs), 4), dtype=np.int32)
+        boxes[:, 0] = np.clip(boxes_wh[idxs, 0], 0, width - 1)
+        boxes[:, 1] = np.clip(boxes_wh[idxs, 1], 0, height - 1)
+        boxes[:, 2] = np.clip(boxes_wh[idxs, 0] + boxes_wh[idxs, 2], 0, width - 1)
+        boxes[:, 3] = np.clip(boxes_wh[idxs, 1] + boxes_wh[idxs, 3], 0, height - 1)
+        return boxes, confs[idxs].astype(np.float32), clss[idxs].astype(np.float32)
+
+    def detect(self, frame, conf_th):
+        height, width = frame.shape[:2]
+        blob = cv2.dnn.blobFromImage(frame, 1 / 255.0, (self.input_size, self.input_size), swapRB=True, crop=False)
+        return self.postprocess(self.forward(blob), width, height, conf_th)
+
+    def detect_batch(self, frames, conf_th):
+        """
+        Preprocesses all the frames into one input tensor and runs a single forward pass
+        """
+        n = len(frames)
+        if n == 0:
+            return []
+        blob = cv2.dnn.blobFromImages(frames, 1 / 255.0, (self.input_size, self.input_size), swapRB=True, crop=False)
+        # outputs are either (n, rows, 5 + classes) or (n * rows, 5 + classes)
+        outputs = [o.reshape(n, -1, o.shape[-1]) for o in self.forward(blob)]
+        results = []
+        for i, frame in enumerate(frames):
+            height, width = frame.shape[:2]
+            results.append(self.postprocess([o[i] for o in outputs], width, height, conf_th))
+        return results
+
+
+def load_detector(backend, model, fallback_to_cpu=True, **kwargs):
+    """
+    Loads a detection backend
+    :param backend: str, 'trt_yolo', 'detectnet' or 'cpu_yolo'
+    :param model: str, model name: TensorRT YOLO model (yolo/<model>.trt), detectNet network,
+                  or Darknet/ONNX YOLO model for the CPU (yolo/<model>.cfg and .weights, or yolo/<model>.onnx)
+    :param fallback_to_cpu: bool, load the CPU backend if a GPU backend fails to load (e.g. broken CUDA stack)
+    :param kwargs: extra arguments: category_num, letter_box (trt_yolo), threshold, argv (detectnet),
+                   cpu_model (CPU model name if different, e.g. 'yolov4-tiny-416.onnx'),
+                   nms_th, num_threads, normalized_outputs (cpu_yolo)
+    :return: Detector object
+    """
+    try:
+        if backend == 'trt_yolo':
+            return TrtYoloDetector(model, kwargs.get('category_num', 80), kwargs.get('letter_box', True))
+        if backend == 'detectnet':
+            return DetectNetDetector(model, kwargs.get('threshold', 0.5), kwargs.get('argv', ()))
+    except Exception as e:
+        if not fallback_to_cpu:
+            raise
+        print('Failed to load the %s detector (%s), falling back to CPU inference' % (backend, str(e)))
+        backend = 'cpu_yolo'
+    if backend != 'cpu_yolo':
+        raise Exception('Unknown detector backend %s' % backend)
+    cpu_model = kwargs.get('cpu_model', model)
+    size = os.path.splitext(cpu_model)[0].split('-')[-1]
+    input_size = int(size) if size.isdigit() else 416
+    if cpu_model.endswith('.onnx'):
+        weights, config = 'yolo/%s' % cpu_model, ''
+    else:
+        weights, config = 'yolo/%s.weights' % cpu_model, 'yolo/%s.cfg' % cpu_model
+    return CvDnnYoloDetector(weights, config, input_size=input_size,
+                             nms_th=kwargs.get('nms_th', 0.5), num_threads=kwargs.get('num_threads', 0),
+                             normalized_outputs=kwargs.get('normalized_outputs', True))
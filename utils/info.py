@@ -1,6 +1,7 @@
 #from tabulate import tabulate
 from sys import stdout
 import cv2
+from utils import classes_yolo, detections
 
 
 class ConsoleParams:
@@ -11,6 +12,14 @@ class ConsoleParams:
     system: str
     fps: float
     warnings: bool = False
+    capture: list = []
+    sync: dict = None
+    stages: list = []
+    motion: list = []
+    schedulers: list = []
+    writers: list = []
+    keyframes: list = []
+    retention: dict = None
 
 
 #def print_console(console, params: ConsoleParams):
@@ -35,6 +44,37 @@ def print_console(params: ConsoleParams):
         #]
     #)
     
+    for stats in params.capture:
+        template += " / %s: %d read, %d dropped, %d stale, %.3fs old" % (
+            stats['name'], stats['read'], stats['dropped'], stats['stale'], stats['staleness'])
+    if params.sync is not None:
+        template += " / PAIRS: %d synced, %d unsynced, %d reused, %d dropped, skew %.3fs (max %.3fs)" % (
+            params.sync['synced'], params.sync['unsynced'], params.sync['reused'], params.sync['dropped'],
+            params.sync['mean_skew'], params.sync['max_skew'])
+    for stats in params.stages:
+        template += " / %s: %.1fms, %.1f queued, %d dropped" % (
+            stats['name'].upper(), stats['mean_latency'] * 1000, stats['mean_queued'], stats['dropped'])
+    for stats in params.motion:
+        template += " / %s GATE: %d of %d inferences skipped" % (
+            stats['name'].upper(), stats['skipped'], stats['frames'])
+    for stats in params.schedulers:
+        template += " / %s RATE: %s, %d of %d frames not detected" % (
+            stats['name'].upper(), 'FULL' if stats['full_rate'] else 'LOW', stats['skipped'], stats['frames'])
+    for stats in params.keyframes:
+        template += " / %s KEYFRAMES: %d of %d frames saved" % (
+            stats['name'].upper(), stats['saved'], stats['frames'])
+    for stats in params.writers:
+        template += " / %s: %d queued, %d written, %d dropped" % (
+            stats['name'].upper(), stats['queued'], stats['written'], stats['dropped'])
+        if stats.get('failed'):
+            template += ", %d failed" % stats['failed']
+    
+    if params.retention is not None:
+        template += " / DISK: %d MB in %d files, %d evicted, %s MB free%s" % (
+            params.retention['used'] // (1024 * 1024), params.retention['files'], params.retention['evicted'],
+            '?' if params.retention['free'] is None else params.retention['free'] // (1024 * 1024),
+            ', WRITES PAUSED' if params.retention['paused'] else '')
+    
     print(system+'. '+template)
     #console.clear()
     #console.addstr(system + '\n')
@@ -77,72 +117,39 @@ def print_fps_on_frame(frame, fps):
     return fr
 
 
-def print_items_to_frame(frame, items):
+def print_records_to_frame(frame, records):
     
     """
-    take bboxes items from dict and print them into frame
+    take tracked detections from dict and print them into frame
     :param frame: numpy array, image
-    :param items: orderedDict with bboxes on values
+    :param records: dict, trace id to (x1, y1, x2, y2, class id) record (see DetectionBatch.records)
     :return: numpy array, new frame
     """
     
     fr = frame
     
-    for (k, v) in items.items():
-        
-        ids = k
-        bbox = v
-        
-        text_over_bbox = str(ids)
-        
-        fr = cv2.rectangle(
-            fr,
-            bbox.start_point,
-            bbox.end_point,
-            bbox.color,
-            2)
-        
-        cv2.putText(
-            fr,
-            text_over_bbox,
-            bbox.start_point,
-            cv2.FONT_HERSHEY_SIMPLEX,
-            1,
-            bbox.color,
-            2
-        )
+    for trace_id, (x1, y1, x2, y2, class_id) in records.items():
+        color = detections.colorTable[class_id]
+        fr = cv2.rectangle(fr, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
+        cv2.putText(fr, str(trace_id), (int(x1), int(y1)), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
     
     return fr
 
 
-def print_bboxes_to_frame(frame, bboxes):
+def print_batch_to_frame(frame, batch):
     
     """
-    take bboxes and print them into frame
+    take a batch of detections and print them into frame
     :param frame: numpy array, image
-    :param bboxes: bboxssd objects
+    :param batch: DetectionBatch
     :return: numpy array, new frame
     """
     
     fr = frame
     
-    for bbox in bboxes:
-        fr = cv2.rectangle(
-            frame,
-            bbox.start_point,
-            bbox.end_point,
-            bbox.color,
-            2)
-        
-        cv2.putText(
-            fr,
-            bbox.name,
-            # + ': ' + str(bbox.name),
-            bbox.start_point,
-            cv2.FONT_HERSHEY_SIMPLEX,
-            1,
-            bbox.color,
-            2
-        )
+    for (x1, y1, x2, y2), class_id in zip(batch.boxes.tolist(), batch.class_ids.tolist()):
+        color = detections.colorTable[class_id]
+        fr = cv2.rectangle(fr, (x1, y1), (x2, y2), color, 2)
+        cv2.putText(fr, classes_yolo.classesDict[class_id], (x1, y1), cv2.FONT_HERSHEY_SIMPLEX, 1, color, 2)
     
     return fr
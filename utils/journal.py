@@ -0,0 +1,236 @@
+import datetime
+import glob
+import os
+import threading
+import time
+
+import numpy as np
+
+# cameras
+CROSSWALK = 0
+ROAD = 1
+
+# row flags
+SELECTED = 1        # the detection passed the class / contour filters
+WARNING = 2         # the warnings were activated on this frame
+
+# one row per detection, or a single row with class_id -1 for a frame without detections
+JOURNAL_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('frame', '<u8'),
+    ('camera', 'u1'),
+    ('flags', 'u1'),
+    ('zone', 'u1'),
+    ('class_id', '<i2'),
+    ('score', '<f4'),
+    ('box', '<i4', (4,)),
+])
+
+# sparse time index of each segment: timestamp and row of the first row of each written batch
+INDEX_DTYPE = np.dtype([('timestamp', '<f8'), ('row', '<u8')])
+
+SEGMENT_EXTENSION = '.det'
+INDEX_EXTENSION = '.idx'
+
+
+class DetectionJournal:
+    """
+    Binary detection log: fixed-size rows (JOURNAL_DTYPE) buffered in memory and written in batches
+    to segment files that rotate by size and by time. Next to each segment, a sparse time index
+    (INDEX_DTYPE) lets JournalReader load only the rows of a time range. A background thread
+    writes the rows left buffered for flush_seconds when no more frames come.
+    """
+
+    def __init__(self, prefix, max_bytes=64 * 1024 * 1024, max_seconds=3600, flush_rows=1024, flush_seconds=5.0):
+        """
+        :param prefix: str, path prefix of the segments (<prefix>.<start time>.det), its folder is created if missing
+        :param max_bytes: int, a segment is closed once it reaches this size
+        :param max_seconds: float, a segment is closed once it spans this many seconds
+        :param flush_rows: int, buffered rows that trigger a write
+        :param flush_seconds: float, maximum time rows stay buffered
+        """
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.flush_rows = flush_rows
+        self.flush_seconds = flush_seconds
+
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.closed = False
+        self.buffer = []
+        self.buffered_rows = 0
+        self.buffered_since = None      # time the oldest buffered rows were added
+        self.segment = None
+        self.index = None
+        self.segment_start = None
+        self.segment_rows = 0
+
+        # counters
+        self.rows = 0
+        self.segments = 0
+
+        self.thread = threading.Thread(target=self._run, name='journal-flush', daemon=True)
+        self.thread.start()
+
+    def _rows(self, timestamp, frame, camera, batch, selected, warning):
+        n = len(batch)
+        rows = np.zeros(max(n, 1), dtype=JOURNAL_DTYPE)
+        rows['timestamp'] = timestamp
+        rows['frame'] = frame
+        rows['camera'] = camera
+        rows['flags'] = WARNING if warning else 0
+        if n == 0:
+            rows['class_id'] = -1
+            return rows
+        if selected is not None:
+            rows['flags'] |= np.where(selected, SELECTED, 0).astype(np.uint8)
+        rows['zone'] = batch.zones
+        rows['class_id'] = batch.class_ids
+        rows['score'] = batch.scores
+        rows['box'] = batch.boxes
+        return rows
+
+    def write_frame(self, timestamp, frame, cameras, warning=False):
+        """
+        Buffers the detections of one frame pair
+        :param timestamp: float, capture timestamp
+        :param frame: int, frame number
+        :param cameras: list of (camera, DetectionBatch, selected mask or None) tuples
+        :param warning: bool, the warnings were activated on this frame
+        """
+        rows = np.concatenate([self._rows(timestamp, frame, camera, batch, selected, warning)
+                               for camera, batch, selected in cameras])
+        with self.cond:
+            if not self.buffer:
+                self.buffered_since = time.time()
+                self.cond.notify_all()
+            self.buffer.append(rows)
+            self.buffered_rows += len(rows)
+            if self.buffered_rows >= self.flush_rows or time.time() - self.buffered_since >= self.flush_seconds:
+                self._flush()
+
+    def _run(self):
+        with self.cond:
+            while not self.closed:
+                if not self.buffer:
+                    self.cond.wait()
+                    continue
+                remaining = self.buffered_since + self.flush_seconds - time.time()
+                if remaining > 0:
+                    self.cond.wait(remaining)
+                else:
+                    self._flush()
+
+    def _open_segment(self, timestamp):
+        stamp = datetime.datetime.fromtimestamp(timestamp).strftime("%Y.%m.%d.%H.%M.%S.%f")
+        path = '%s.%s' % (self.prefix, stamp)
+        self.segment = open(path + SEGMENT_EXTENSION, 'ab')
+        self.index = open(path + INDEX_EXTENSION, 'ab')
+        self.segment_start = timestamp
+        self.segment_rows = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.index.close()
+            self.segment = None
+            self.index = None
+
+    def _flush(self):
+        if not self.buffer:
+            return
+        rows = np.concatenate(self.buffer)
+        self.buffer = []
+        self.buffered_rows = 0
+        first = rows['timestamp'][0]
+        if (self.segment is None or self.segment_rows * JOURNAL_DTYPE.itemsize >= self.max_bytes or
+                first - self.segment_start >= self.max_seconds):
+            self._close_segment()
+            self._open_segment(first)
+        rows.tofile(self.segment)
+        self.segment.flush()
+        np.array([(first, self.segment_rows)], dtype=INDEX_DTYPE).tofile(self.index)
+        self.index.flush()
+        self.segment_rows += len(rows)
+        self.rows += len(rows)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        with self.lock:
+            self._flush()
+            self._close_segment()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': 'journal',
+                'queued': self.buffered_rows,
+                'written': self.rows,
+                'dropped': 0,
+                'segments': self.segments,
+            }
+
+
+class JournalReader:
+    """
+    Reads the rows of a DetectionJournal in a time range, memory-mapping only the segments
+    (and, through their time indexes, only the rows) that overlap it
+    """
+
+    def __init__(self, prefix):
+        """
+        :param prefix: str, path prefix given to the DetectionJournal
+        """
+        self.segments = []      # (start time of the first batch, segment path, time index), oldest first
+        for path in sorted(glob.glob(glob.escape(prefix) + '.*' + SEGMENT_EXTENSION)):
+            index_path = path[:-len(SEGMENT_EXTENSION)] + INDEX_EXTENSION
+            if not os.path.isfile(index_path):
+                continue
+            index = np.fromfile(index_path, dtype=INDEX_DTYPE)
+            if len(index):
+                self.segments.append((index['timestamp'][0], path, index))
+        self.segments.sort(key=lambda segment: segment[0])
+
+    def _segment_rows(self, path, index, start, end):
+        # whole rows only (the last one may be incomplete if the process died while writing)
+        rows = np.memmap(path, dtype=JOURNAL_DTYPE, mode='r', shape=(os.path.getsize(path) // JOURNAL_DTYPE.itemsize,))
+        # batches starting before the range may hold rows inside it, the ones starting after it cannot
+        first = max(np.searchsorted(index['timestamp'], start, 'right') - 1, 0)
+        last = np.searchsorted(index['timestamp'], end, 'right')
+        lo = index['row'][first]
+        hi = index['row'][last] if last < len(index) else len(rows)
+        chunk = rows[lo:hi]
+        return np.array(chunk[(chunk['timestamp'] >= start) & (chunk['timestamp'] <= end)])
+
+    def read(self, start, end, camera=None, with_markers=False):
+        """
+        :param start: float, first capture timestamp (included)
+        :param end: float, last capture timestamp (included)
+        :param camera: int, CROSSWALK or ROAD (both if None)
+        :param with_markers: bool, include the rows of frames without detections (class_id -1)
+        :return: numpy structured array of JOURNAL_DTYPE rows, with columns rows['timestamp'], rows['box']...
+        """
+        chunks = []
+        for i, (first_time, path, index) in enumerate(self.segments):
+            next_time = self.segments[i + 1][0] if i + 1 < len(self.segments) else np.inf
+            if first_time > end or next_time < start:
+                continue
+            chunks.append(self._segment_rows(path, index, start, end))
+        rows = np.concatenate(chunks) if chunks else np.zeros(0, dtype=JOURNAL_DTYPE)
+        if camera is not None:
+            rows = rows[rows['camera'] == camera]
+        if not with_markers:
+            rows = rows[rows['class_id'] >= 0]
+        return rows
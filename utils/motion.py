@@ -0,0 +1,117 @@
+import threading
+
+import cv2
+import numpy as np
+
+
+class MotionGate:
+    """
+    Cheap motion detector used to skip inference when nothing moves inside the contours
+    of a camera. It works on a downscaled frame, with either an OpenCV MOG2 background
+    subtractor or the difference with the previous frame, masked to the contours.
+    """
+
+    def __init__(self, name, contours, scale=0.25, method='mog2', min_changed=0.002, max_skipped=30):
+        """
+        :param name: str, camera name for the stats
+        :param contours: list of contours (arrays of points in frame coordinates)
+        :param scale: float, downscaling factor applied to the frames
+        :param method: str, 'mog2' (background subtraction) or 'diff' (frame difference)
+        :param min_changed: float, fraction of the contour area that must change to detect motion
+        :param max_skipped: int, run the detector anyway after this many consecutive skipped frames
+        """
+        self.name = name
+        self.contours = contours
+        self.scale = scale
+        self.method = method
+        self.min_changed = min_changed
+        self.max_skipped = max_skipped
+
+        # (frame shape, downscaled size, mask, mask area), replaced whole when the contours change
+        # so that changed() never mixes the mask of some contours with the area of others
+        self.masking = None
+        self.previous = None
+        if method == 'mog2':
+            self.subtractor = cv2.createBackgroundSubtractorMOG2(history=500, varThreshold=16, detectShadows=False)
+        elif method == 'diff':
+            self.subtractor = None
+        else:
+            raise Exception('Unknown motion gate method %s' % method)
+
+        # counters
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.skipped = 0
+        self.consecutive_skipped = 0
+        self.last_changed = 0.0
+
+    def set_contours(self, contours):
+        """
+        Changes the contours, can be called from another thread than changed()
+        :param contours: list of contours
+        """
+        self.contours = contours
+        masking = self.masking
+        if masking is not None:
+            self.masking = self._build_mask(masking[0], contours)
+
+    def _build_mask(self, shape, contours):
+        height, width = shape
+        size = (max(1, int(width * self.scale)), max(1, int(height * self.scale)))
+        mask = np.zeros((size[1], size[0]), dtype=np.uint8)
+        for contour in contours:
+            points = np.round(np.asarray(contour, dtype=np.float32) * self.scale).astype(np.int32)
+            cv2.fillPoly(mask, [points], 255)
+        return shape, size, mask, max(1, cv2.countNonZero(mask))
+
+    def changed(self, frame):
+        """
+        :param frame: BGR numpy frame
+        :return: float, fraction of the contour area that changed
+        """
+        masking = self.masking
+        if masking is None or masking[0] != frame.shape[:2]:
+            masking = self.masking = self._build_mask(frame.shape[:2], self.contours)
+            self.previous = None
+        _, size, mask, mask_area = masking
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if self.subtractor is not None:
+            foreground = self.subtractor.apply(small)
+        else:
+            gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+            if self.previous is None:
+                self.previous = gray
+                return 1.0
+            foreground = cv2.absdiff(gray, self.previous)
+            self.previous = gray
+            _, foreground = cv2.threshold(foreground, 25, 255, cv2.THRESH_BINARY)
+        foreground = cv2.bitwise_and(foreground, mask)
+        return cv2.countNonZero(foreground) / mask_area
+
+    def should_detect(self, frame, force=False):
+        """
+        Updates the motion model with a new frame and tells whether the detector has to run
+        :param frame: BGR numpy frame
+        :param force: bool, run the detector regardless of motion
+        :return: bool
+        """
+        changed = self.changed(frame)
+        with self.lock:
+            self.frames += 1
+            self.last_changed = changed
+            detect = force or changed >= self.min_changed or self.consecutive_skipped >= self.max_skipped
+            if detect:
+                self.consecutive_skipped = 0
+            else:
+                self.skipped += 1
+                self.consecutive_skipped += 1
+        return detect
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'frames': self.frames,
+                'skipped': self.skipped,
+                'changed': self.last_changed,
+            }
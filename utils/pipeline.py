@@ -0,0 +1,218 @@
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+class StageQueue:
+    """
+    Bounded queue between two pipeline stages.
+    When it is full, put() either drops the oldest item (drop_oldest=True)
+    or waits for the next stage to take one (drop_oldest=False).
+    """
+
+    def __init__(self, maxsize=2, drop_oldest=True, on_drop=None):
+        """
+        :param maxsize: int, maximum number of queued items
+        :param drop_oldest: bool, drop the oldest item instead of blocking when full
+        :param on_drop: callable taking each dropped item (e.g. to hand a request it carries to a later item)
+        """
+        self.items = deque()
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.on_drop = on_drop
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.put_count = 0
+        self.dropped = 0
+        self.occupancy_sum = 0      # sum of the queue length seen by each put(), for the mean occupancy
+
+    def put(self, item):
+        dropped = None
+        with self.cond:
+            if self.drop_oldest:
+                if len(self.items) >= self.maxsize:
+                    dropped = self.items.popleft()
+                    self.dropped += 1
+            else:
+                self.cond.wait_for(lambda: len(self.items) < self.maxsize or self.closed)
+                if self.closed:
+                    return
+            self.items.append(item)
+            self.put_count += 1
+            self.occupancy_sum += len(self.items)
+            self.cond.notify_all()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self):
+        """
+        :return: the oldest item, or None if the queue is closed and empty
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.closed)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items)
+
+
+class Stage:
+    """
+    One step of the pipeline. The function takes the item produced by the previous stage
+    (nothing for the first stage) and returns the item for the next stage.
+    The first stage ends the pipeline by returning None; the other stages
+    can skip an item by returning None, or stop the pipeline by calling Pipeline.stop().
+    """
+
+    def __init__(self, name, function, input_queue=None):
+        self.name = name
+        self.function = function
+        self.input_queue = input_queue
+        self.output_queue = None
+
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.latency_sum = 0.0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+
+    def run_once(self):
+        """
+        :return: bool, False when the stage has no more input
+        """
+        if self.input_queue is None:
+            start = time.time()
+            item = self.function()
+            if item is None:
+                return False
+        else:
+            item = self.input_queue.get()
+            if item is None:
+                return False
+            start = time.time()
+            item = self.function(item)
+        latency = time.time() - start
+        with self.lock:
+            self.processed += 1
+            self.latency_sum += latency
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+        if item is not None and self.output_queue is not None:
+            self.output_queue.put(item)
+        return True
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'name': self.name,
+                'processed': self.processed,
+                'latency': self.last_latency,
+                'mean_latency': self.latency_sum / self.processed if self.processed else 0.0,
+                'max_latency': self.max_latency,
+                'queued': 0,
+                'mean_queued': 0.0,
+                'dropped': 0,
+            }
+        if self.input_queue is not None:
+            q = self.input_queue
+            with q.cond:
+                stats['queued'] = len(q.items)
+                stats['mean_queued'] = q.occupancy_sum / q.put_count if q.put_count else 0.0
+                stats['dropped'] = q.dropped
+        return stats
+
+
+class Pipeline:
+    """
+    Chain of stages, each one running in its own thread and joined to the next one
+    by a bounded StageQueue, so the stages overlap in time (e.g. inference on one pair
+    of frames while the next pair is captured and the previous one is written to disk).
+    """
+
+    def __init__(self):
+        self.stages = []
+        self.threads = []
+        self.running = False
+        self.errors = []            # (stage name, exception) of the stages that failed
+
+    def add_stage(self, name, function, maxsize=2, drop_oldest=True, on_drop=None):
+        """
+        :param name: str, stage name for the stats
+        :param function: callable, see Stage
+        :param maxsize: int, size of the queue feeding this stage (ignored for the first stage)
+        :param drop_oldest: bool, policy of the queue feeding this stage when it is full
+        :param on_drop: callable, called with each item dropped from that queue
+        :return: the pipeline, to chain calls
+        """
+        input_queue = None
+        if self.stages:
+            input_queue = StageQueue(maxsize, drop_oldest, on_drop)
+            self.stages[-1].output_queue = input_queue
+        self.stages.append(Stage(name, function, input_queue))
+        return self
+
+    def _loop(self, stage):
+        try:
+            while self.running and stage.run_once():
+                pass
+        except Exception as e:
+            # a failed stage stops the whole pipeline, run() raises the error once every stage has ended
+            print('Pipeline stage %s failed:' % stage.name)
+            traceback.print_exc()
+            self.errors.append((stage.name, e))
+            self.stop()
+        finally:
+            # let the next stages finish the items already queued (and never wait forever for this one)
+            if stage.output_queue is not None:
+                stage.output_queue.close()
+
+    def run(self, last_in_caller=True):
+        """
+        Starts the stages and blocks until the pipeline ends.
+        Raises the error of the first stage that failed, if any.
+        :param last_in_caller: bool, run the last stage in the calling thread
+                               (OpenCV windows must be handled from the main thread)
+        """
+        self.running = True
+        threaded = self.stages[:-1] if last_in_caller else self.stages
+        for stage in threaded:
+            thread = threading.Thread(target=self._loop, args=(stage,), name='stage-' + stage.name, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        try:
+            if last_in_caller:
+                self._loop(self.stages[-1])
+        finally:
+            # interrupted in the calling thread (Ctrl+C, sys.exit from a signal handler): stop the other stages too
+            if sys.exc_info()[0] is not None:
+                self.stop()
+            for thread in self.threads:
+                thread.join()
+        if self.errors:
+            raise self.errors[0][1]
+
+    def stop(self):
+        self.running = False
+        for stage in self.stages:
+            if stage.input_queue is not None:
+                stage.input_queue.close()
+
+    def stats(self):
+        """
+        :return: list of dicts with the counters of each stage
+        """
+        return [stage.stats() for stage in self.stages]
@@ -0,0 +1,279 @@
+import heapq
+import os
+import shutil
+import threading
+import time
+
+# directory mtimes can be this coarse (e.g. FAT on SD cards): folders modified this recently are listed again
+MTIME_GRANULARITY = 2.0
+# files kept as possibly still being written (besides the newest ones of each folder)
+NEWEST_PER_FOLDER = 2
+# the newest files of a folder are taken as closed once not modified for this long
+IDLE_SECONDS = 3600.0
+# sidecar index of a SegmentedVideoRecorder (<name>.index.csv), deleted with the segments of its recording
+RECORDING_INDEX_SUFFIX = '.index.csv'
+
+
+class _Budget:
+    """ Byte budget of one directory tree and the index of its files """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.sizes = {}             # size of every indexed file, by path
+        self.oldest = []            # heap of (mtime, path), entries of files gone are skipped when popped
+        self.folders = {}           # folder path -> (mtime when listed, file names, subfolder paths)
+        # files whose size is read again on every pass: adding files to a folder changes its mtime,
+        # but a file growing (an open video segment, index or journal) does not
+        self.growing = set()
+        self.newest = {}            # folder path -> (mtime, path) of its newest files, oldest first
+
+
+class RetentionManager:
+    """
+    Keeps each recording directory (snapshots, videos, clips...) under a byte budget, deleting its
+    oldest files first, from a background thread. Usage is tracked incrementally: only the folders
+    whose modification time changed since the last pass are listed again, and only their new files
+    are stat'ed, so huge trees are walked once at startup and not on every pass. Files that may
+    still be growing (modified recently, or the newest of their folder) are stat'ed on every pass
+    and never deleted. The segments of a recording and its sidecar index are deleted together.
+    When the free space of the disk drops below a watermark, `paused` is set until it recovers,
+    for the writers to stop writing.
+    """
+
+    def __init__(self, budgets, min_free_bytes=512 * 1024 * 1024, resume_free_bytes=1024 * 1024 * 1024, period=10.0,
+                 name='retention'):
+        """
+        :param budgets: dict, maximum bytes by directory (created if missing)
+        :param min_free_bytes: int, `paused` is set when the free space of any of their disks drops below this
+        :param resume_free_bytes: int, `paused` is cleared when the free space of all of them is back above this
+        :param period: float, seconds between passes
+        :param name: str, name for the stats
+        """
+        self.budgets = []
+        for directory, max_bytes in budgets.items():
+            os.makedirs(directory, exist_ok=True)
+            self.budgets.append(_Budget(directory, max_bytes))
+        self.min_free_bytes = min_free_bytes
+        self.resume_free_bytes = max(resume_free_bytes, min_free_bytes)
+        self.period = period
+        self.name = name
+
+        self.paused = False         # read without the lock by the writers, a stale value for one frame is fine
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.free = None
+        self.evicted = 0
+        self.evicted_bytes = 0
+
+        self.thread = threading.Thread(target=self._run, name='%s-manager' % name, daemon=True)
+        self.thread.start()
+
+    def _forget(self, budget, path):
+        size = budget.sizes.pop(path, None)
+        if size is not None:
+            budget.used -= size
+        budget.growing.discard(path)
+
+    def _refresh(self, budget, now):
+        """ Reads again the size of the files that may still be growing """
+        newest = {path for files in budget.newest.values() for _, path in files}
+        for path in list(budget.growing):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                budget.growing.discard(path)
+                continue
+            if path in budget.sizes:
+                budget.used += stat.st_size - budget.sizes[path]
+                budget.sizes[path] = stat.st_size
+            # not modified for a while and not among the newest of its folder (or idle for long): done
+            idle = now - stat.st_mtime
+            if idle > 2 * self.period + MTIME_GRANULARITY and (path not in newest or idle > IDLE_SECONDS):
+                budget.growing.discard(path)
+
+    def _scan(self, budget, folder, now):
+        """ Updates the index with the changes of folder and its subfolders """
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            mtime = None
+        listed_mtime, names, subfolders = budget.folders.get(folder, (None, set(), []))
+        if mtime is None:
+            # folder gone (e.g. emptied and removed): forget everything under it
+            for name in names:
+                self._forget(budget, os.path.join(folder, name))
+            for subfolder in subfolders:
+                self._scan(budget, subfolder, now)
+            budget.folders.pop(folder, None)
+            budget.newest.pop(folder, None)
+            return
+        if mtime != listed_mtime or now - mtime < MTIME_GRANULARITY:
+            new_names = set()
+            new_subfolders = []
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            new_subfolders.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            new_names.add(entry.name)
+            except OSError as e:
+                print('Could not list %s: %s' % (folder, e))
+                return
+            for name in names - new_names:
+                self._forget(budget, os.path.join(folder, name))
+            for name in new_names - names:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    new_names.discard(name)
+                    continue
+                budget.sizes[path] = stat.st_size
+                budget.used += stat.st_size
+                heapq.heappush(budget.oldest, (stat.st_mtime, path))
+                budget.growing.add(path)
+                newest = budget.newest.setdefault(folder, [])
+                newest.append((stat.st_mtime, path))
+                newest.sort()
+                del newest[:-NEWEST_PER_FOLDER]
+            for subfolder in set(subfolders) - set(new_subfolders):
+                self._scan(budget, subfolder, now)
+            names, subfolders = new_names, new_subfolders
+            budget.folders[folder] = (mtime, names, subfolders)
+        for subfolder in subfolders:
+            self._scan(budget, subfolder, now)
+
+    @staticmethod
+    def _recording(path):
+        """ Files of the recording path belongs to (its sidecar index and segments), None if not a recording """
+        folder, name = os.path.split(path)
+        if name.endswith(RECORDING_INDEX_SUFFIX):
+            prefix = name[:-len(RECORDING_INDEX_SUFFIX)] + '.'
+        else:
+            prefix = name.split('.', 1)[0] + '.'
+            if not os.path.exists(os.path.join(folder, prefix[:-1] + RECORDING_INDEX_SUFFIX)):
+                return None
+        try:
+            names = os.listdir(folder)
+        except OSError:
+            return None
+        return [os.path.join(folder, name) for name in names if name.startswith(prefix)]
+
+    def _remove(self, budget, path):
+        """ Deletes path, and its folders left empty """
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            self._forget(budget, path)
+            return
+        except OSError as e:
+            print('Could not remove %s: %s' % (path, e))
+            return
+        self._forget(budget, path)
+        with self.cond:
+            self.evicted += 1
+            self.evicted_bytes += size
+        folder = os.path.dirname(path)
+        while os.path.normpath(folder) != os.path.normpath(budget.directory):
+            try:
+                os.rmdir(folder)
+            except OSError:
+                break
+            folder = os.path.dirname(folder)
+
+    def _evict(self, budget):
+        """
+        Deletes the oldest files of the budget until it fits. Files that may still be written are
+        skipped. A finished recording is deleted as a whole (segments and sidecar index), a live one
+        segment by segment, keeping its index.
+        """
+        skipped = []
+        while budget.used > budget.max_bytes and budget.oldest:
+            mtime, path = heapq.heappop(budget.oldest)
+            if path not in budget.sizes:
+                continue
+            if path in budget.growing:
+                skipped.append((mtime, path))
+                continue
+            try:
+                current = os.stat(path).st_mtime
+            except OSError:
+                self._forget(budget, path)
+                continue
+            if current > mtime:
+                # modified since indexed: back in the heap by its new time
+                heapq.heappush(budget.oldest, (current, path))
+                continue
+            recording = self._recording(path)
+            if recording is None:
+                self._remove(budget, path)
+                continue
+            # files not indexed yet were created since the last pass
+            live = any(member in budget.growing or member not in budget.sizes for member in recording)
+            if not live:
+                for member in recording:
+                    self._remove(budget, member)
+            elif path.endswith(RECORDING_INDEX_SUFFIX):
+                skipped.append((mtime, path))
+            else:
+                self._remove(budget, path)
+        for entry in skipped:
+            heapq.heappush(budget.oldest, entry)
+
+    def _check_free_space(self):
+        free = None
+        for budget in self.budgets:
+            try:
+                disk_free = shutil.disk_usage(budget.directory).free
+            except OSError:
+                continue
+            free = disk_free if free is None else min(free, disk_free)
+        with self.cond:
+            self.free = free
+            if free is None:
+                return
+            if not self.paused and free < self.min_free_bytes:
+                print('Only %d MB free, pausing the recordings' % (free // (1024 * 1024)))
+                self.paused = True
+            elif self.paused and free >= self.resume_free_bytes:
+                print('%d MB free, resuming the recordings' % (free // (1024 * 1024)))
+                self.paused = False
+
+    def _run(self):
+        while True:
+            now = time.time()
+            for budget in self.budgets:
+                self._scan(budget, budget.directory, now)
+                self._refresh(budget, now)
+                self._evict(budget)
+            self._check_free_space()
+            with self.cond:
+                if self.cond.wait_for(lambda: self.closed, self.period):
+                    return
+
+    def close(self):
+        """
+        Stops the manager thread (files are not touched)
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'name': self.name,
+                'used': sum(budget.used for budget in self.budgets),
+                'files': sum(len(budget.sizes) for budget in self.budgets),
+                'evicted': self.evicted,
+                'evicted_bytes': self.evicted_bytes,
+                'free': self.free,
+                'paused': self.paused,
+            }
@@ -0,0 +1,103 @@
+import threading
+
+
+class DetectionScheduler:
+    """
+    Decides on which frames of a camera the detector runs: every frame while the
+    camera matters for the warnings (e.g. the road camera while pedestrians are tracked),
+    and at a lower rate otherwise, to free GPU time for the other camera.
+    """
+
+    def __init__(self, name, low_rate_period=0.5):
+        """
+        :param name: str, camera name for the stats
+        :param low_rate_period: float, seconds between detections at the low rate
+        """
+        self.name = name
+        self.low_rate_period = low_rate_period
+        self.last_detection_time = None
+        self.frames_since_detection = 0
+
+        # counters
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.skipped = 0
+        self.full_rate = True
+
+    def should_detect(self, full_rate, timestamp):
+        """
+        :param full_rate: bool, True if the camera has to be detected on every frame
+        :param timestamp: float, capture timestamp of the frame
+        :return: bool telling whether to run the detector on this frame,
+                 and the number of frames elapsed since the previous detection (0 if not detecting)
+        """
+        with self.lock:
+            self.frames += 1
+            self.full_rate = full_rate
+            self.frames_since_detection += 1
+            due = (self.last_detection_time is None or
+                   timestamp - self.last_detection_time >= self.low_rate_period)
+            if not (full_rate or due):
+                self.skipped += 1
+                return False, 0
+            elapsed = self.frames_since_detection
+            self.frames_since_detection = 0
+            self.last_detection_time = timestamp
+            return True, elapsed
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'frames': self.frames,
+                'skipped': self.skipped,
+                'full_rate': self.full_rate,
+            }
+
+
+class KeyframeSelector:
+    """
+    Decides which frames with detections are saved as snapshots: only when the set of tracked
+    objects changes (someone arrives or leaves), or when a tracked object has not been saved for
+    a while, instead of every frame while someone waits in the crosswalk.
+    """
+
+    def __init__(self, name, min_interval=10.0):
+        """
+        :param name: str, name for the stats
+        :param min_interval: float, seconds after which an object still tracked is saved again
+        """
+        self.name = name
+        self.min_interval = min_interval
+        self.last_saved = {}        # time each tracked object was last saved, by key
+
+        # counters
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.saved = 0
+
+    def should_save(self, timestamp, keys):
+        """
+        :param timestamp: float, capture timestamp of the frame
+        :param keys: iterable of hashable keys of the tracked objects, e.g. (camera, trace id)
+        :return: bool telling whether to save this frame
+        """
+        keys = set(keys)
+        with self.lock:
+            self.frames += 1
+            # same objects as in the last saved frame and all of them saved recently
+            if keys == self.last_saved.keys() and \
+                    all(timestamp - saved < self.min_interval for saved in self.last_saved.values()):
+                return False
+            # every tracked object is in the saved frame; the ones gone are forgotten
+            self.last_saved = dict.fromkeys(keys, timestamp)
+            self.saved += 1
+            return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'frames': self.frames,
+                'saved': self.saved,
+            }
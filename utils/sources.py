@@ -0,0 +1,228 @@
+import glob
+import os.path
+import re
+import threading
+import time
+import datetime
+
+import cv2
+import numpy as np
+
+
+class FrameSource:
+    """
+    Common interface of every frame source (live cameras and recorded footage).
+    grab() captures a frame and sets its capture timestamp, retrieve() decodes it
+    into a BGR numpy array, read() does both.
+    """
+
+    # if True, frames must not be skipped by the readers (recorded footage replayed as fast as possible)
+    lossless = False
+
+    def __init__(self):
+        self.width = 0
+        self.height = 0
+        self.timestamp = None
+
+    def grab(self):
+        raise NotImplementedError
+
+    def retrieve(self):
+        raise NotImplementedError
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def release(self):
+        pass
+
+
+class V4L2Source(FrameSource):
+    """
+    Live camera read through OpenCV (V4L2 device file or index)
+    """
+
+    def __init__(self, device):
+        """
+        :param device: str or int, /dev/video* path or index
+        """
+        super().__init__()
+        self.cam = cv2.VideoCapture(device)
+        self.width = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def grab(self):
+        if not self.cam.grab():
+            return False
+        self.timestamp = time.time()
+        return True
+
+    def retrieve(self):
+        return self.cam.retrieve()
+
+    def release(self):
+        self.cam.release()
+
+
+class GstSource(FrameSource):
+    """
+    Live camera read through a jetson.utils GStreamer pipeline.
+    capture_rgba() gives access to the CUDA memory for detectNet.
+    """
+
+    def __init__(self, device, width, height):
+        """
+        :param device: str, /dev/video* path
+        :param width: int, capture width
+        :param height: int, capture height
+        """
+        super().__init__()
+        import jetson.utils
+        self.jetson_utils = jetson.utils
+        self.cam = jetson.utils.gstCamera(width, height, device)
+        self.width = width
+        self.height = height
+        self.cuda_img = None
+
+    def capture_rgba(self, zeroCopy=False):
+        """
+        :param zeroCopy: bool, map the CUDA memory so it can be read from the CPU
+        :return: CUDA image, width and height
+        """
+        self.cuda_img, width, height = self.cam.CaptureRGBA(zeroCopy=zeroCopy)
+        self.timestamp = time.time()
+        return self.cuda_img, width, height
+
+    def grab(self):
+        self.capture_rgba(zeroCopy=1)
+        return self.cuda_img is not None
+
+    def retrieve(self):
+        self.jetson_utils.cudaDeviceSynchronize()
+        frame = self.jetson_utils.cudaToNumpy(self.cuda_img, self.width, self.height, 4)
+        return True, cv2.cvtColor(frame.astype(np.uint8), cv2.COLOR_RGBA2BGR)
+
+
+class ReplayClock:
+    """
+    Shared clock for recorded footage. Maps the media time of each frame to a capture
+    timestamp, so frames recorded at the same moment get the same timestamp in every source.
+    """
+
+    def __init__(self, realtime=True):
+        """
+        :param realtime: bool, True to deliver frames at their original timestamps,
+                         False to deliver them as fast as possible
+        """
+        self.realtime = realtime
+        self.start = None
+        self.lock = threading.Lock()
+
+    def stamp(self, media_time):
+        """
+        :param media_time: float, seconds since the first frame of the recording
+        :return: float, capture timestamp of the frame (waits for it in realtime mode)
+        """
+        with self.lock:
+            if self.start is None:
+                self.start = time.time()
+        timestamp = self.start + media_time
+        if self.realtime:
+            delay = timestamp - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        return timestamp
+
+
+class VideoFileSource(FrameSource):
+    """
+    Recorded video file replayed through OpenCV
+    """
+
+    def __init__(self, path, clock):
+        """
+        :param path: str, video file
+        :param clock: ReplayClock, shared by all the sources of the same replay
+        """
+        super().__init__()
+        self.cam = cv2.VideoCapture(path)
+        self.clock = clock
+        self.lossless = not clock.realtime
+        self.width = int(self.cam.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.cam.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.fps = self.cam.get(cv2.CAP_PROP_FPS) or 30.0
+        self.frame_index = 0
+        self.media_time = -1.0
+
+    def grab(self):
+        if not self.cam.grab():
+            return False
+        media_time = self.cam.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+        if media_time <= self.media_time:
+            # some containers do not report positions, fall back to the nominal frame rate
+            media_time = self.frame_index / self.fps
+        self.media_time = media_time
+        self.frame_index += 1
+        self.timestamp = self.clock.stamp(media_time)
+        return True
+
+    def retrieve(self):
+        return self.cam.retrieve()
+
+    def release(self):
+        self.cam.release()
+
+
+class ImageDirSource(FrameSource):
+    """
+    Replay of a directory tree of snapshots, like the detection snapshots (detect.crosswalk.*,
+    detect.road.*) or the ones of the snapshot command (crosswalk.*, road.*). The capture time is
+    taken from the file name (%Y.%m.%d.%H.%M.%S.%f) if present, otherwise frames are assumed to be
+    evenly spaced at fps. Recordings of recordAllFrames are videos, see VideoFileSource.
+    """
+
+    stamp_regex = re.compile(r'(\d{4}\.\d{2}\.\d{2}\.\d{2}\.\d{2}\.\d{2}\.\d{6})')
+
+    def __init__(self, path, pattern, clock, fps=15.0):
+        """
+        :param path: str, root directory (searched recursively)
+        :param pattern: str, glob of the files of this camera, e.g. 'detect.crosswalk.*'
+        :param clock: ReplayClock, shared by all the sources of the same replay
+        :param fps: float, frame rate assumed for files without a timestamp in their names
+        """
+        super().__init__()
+        self.clock = clock
+        self.lossless = not clock.realtime
+        files = glob.glob(os.path.join(path, '**', pattern), recursive=True)
+        stamped = [(self.file_time(f), f) for f in files]
+        if stamped and all(t is not None for t, _ in stamped):
+            stamped.sort()
+            first = stamped[0][0]
+            self.files = [(t - first, f) for t, f in stamped]
+        else:
+            self.files = [(i / fps, f) for i, f in enumerate(sorted(files))]
+        self.index = 0
+        self.current = None
+        if self.files:
+            first_frame = cv2.imread(self.files[0][1])
+            self.height, self.width = first_frame.shape[:2]
+
+    def file_time(self, path):
+        match = self.stamp_regex.search(os.path.basename(path))
+        if match is None:
+            return None
+        return datetime.datetime.strptime(match.group(1), "%Y.%m.%d.%H.%M.%S.%f").timestamp()
+
+    def grab(self):
+        if self.index >= len(self.files):
+            return False
+        media_time, self.current = self.files[self.index]
+        self.index += 1
+        self.timestamp = self.clock.stamp(media_time)
+        return True
+
+    def retrieve(self):
+        frame = cv2.imread(self.current)
+        return frame is not None, frame
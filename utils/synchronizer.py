@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+class FrameSynchronizer:
+    """
+    Pairs the frames of two CameraReader objects by capture timestamp,
+    so the road and crosswalk frames used in each iteration were taken
+    at (roughly) the same moment.
+    """
+
+    def __init__(self, reader_a, reader_b, max_skew=0.05, max_wait=0.1, reuse=True):
+        """
+        :param reader_a: CameraReader, first camera (crosswalk)
+        :param reader_b: CameraReader, second camera (road)
+        :param max_skew: float, maximum difference in seconds between the timestamps of a pair
+        :param max_wait: float, seconds to wait for the lagging camera to catch up
+        :param reuse: bool, if no pair within max_skew is found after max_wait, True pairs the
+                      newest frames anyway (reusing the lagging camera's frame), False drops them
+        """
+        self.reader_a = reader_a
+        self.reader_b = reader_b
+        self.max_skew = max_skew
+        self.max_wait = max_wait
+        self.reuse = reuse
+
+        self.last_seq_a = 0
+        self.last_seq_b = 0
+
+        # per pair skew statistics
+        self.lock = threading.Lock()
+        self.pairs = 0              # pairs returned
+        self.synced = 0             # pairs within max_skew
+        self.unsynced = 0           # pairs outside max_skew (reuse policy)
+        self.reused = 0             # pairs repeating a frame already used in a previous pair
+        self.dropped = 0            # candidate pairs discarded (drop policy)
+        self.last_skew = 0.0        # signed skew of the last pair, timestamp_a - timestamp_b
+        self.sum_abs_skew = 0.0
+        self.max_abs_skew = 0.0
+
+    def _best_pair(self, recent_a, recent_b):
+        """
+        Finds the newest pair of frames within max_skew, containing at least one frame not used yet
+        :return: tuple of two history entries, or None
+        """
+        best = None
+        best_time = None
+        for entry_a in recent_a:
+            for entry_b in recent_b:
+                if entry_a[0] <= self.last_seq_a and entry_b[0] <= self.last_seq_b:
+                    continue
+                if entry_a[0] < self.last_seq_a or entry_b[0] < self.last_seq_b:
+                    # never go back in time
+                    continue
+                if abs(entry_a[1] - entry_b[1]) > self.max_skew:
+                    continue
+                pair_time = min(entry_a[1], entry_b[1])
+                if best is None or pair_time > best_time:
+                    best = (entry_a, entry_b)
+                    best_time = pair_time
+        return best
+
+    def _emit(self, entry_a, entry_b, synced):
+        seq_a, timestamp_a, frame_a = entry_a
+        seq_b, timestamp_b, frame_b = entry_b
+        skew = timestamp_a - timestamp_b
+        with self.lock:
+            self.pairs += 1
+            if synced:
+                self.synced += 1
+            else:
+                self.unsynced += 1
+            if seq_a <= self.last_seq_a or seq_b <= self.last_seq_b:
+                self.reused += 1
+            self.last_skew = skew
+            self.sum_abs_skew += abs(skew)
+            self.max_abs_skew = max(self.max_abs_skew, abs(skew))
+        self.last_seq_a = seq_a
+        self.last_seq_b = seq_b
+        self.reader_a.consume(seq_a)
+        self.reader_b.consume(seq_b)
+        return frame_a, timestamp_a, frame_b, timestamp_b, skew
+
+    def next_pair(self, timeout=None):
+        """
+        Blocks until a new pair of frames is available
+        :param timeout: float, maximum seconds to wait for each camera
+        :return: frame_a, timestamp_a, frame_b, timestamp_b, skew (seconds),
+                 or None if a camera stopped producing frames
+        """
+        while True:
+            if not (self.reader_a.wait_newer(self.last_seq_a, timeout) and
+                    self.reader_b.wait_newer(self.last_seq_b, timeout)):
+                return None
+
+            deadline = time.time() + self.max_wait
+            while True:
+                recent_a = self.reader_a.recent()
+                recent_b = self.reader_b.recent()
+                best = self._best_pair(recent_a, recent_b)
+                if best is not None:
+                    return self._emit(best[0], best[1], True)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                # wait for the camera whose newest frame is older
+                if recent_a[-1][1] < recent_b[-1][1]:
+                    self.reader_a.wait_newer(recent_a[-1][0], remaining)
+                else:
+                    self.reader_b.wait_newer(recent_b[-1][0], remaining)
+                if self.reader_a.finished or self.reader_b.finished:
+                    break
+
+            if self.reuse:
+                return self._emit(recent_a[-1], recent_b[-1], False)
+            with self.lock:
+                self.dropped += 1
+            self.last_seq_a = recent_a[-1][0]
+            self.last_seq_b = recent_b[-1][0]
+            self.reader_a.consume(self.last_seq_a)
+            self.reader_b.consume(self.last_seq_b)
+
+    def stats(self):
+        """
+        :return: dict with the pairing counters and skew statistics (seconds)
+        """
+        with self.lock:
+            return {
+                'pairs': self.pairs,
+                'synced': self.synced,
+                'unsynced': self.unsynced,
+                'reused': self.reused,
+                'dropped': self.dropped,
+                'last_skew': self.last_skew,
+                'mean_skew': self.sum_abs_skew / self.pairs if self.pairs else 0.0,
+                'max_skew': self.max_abs_skew,
+            }
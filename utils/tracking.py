@@ -1,122 +1,354 @@
 from utils.contour import is_point_in_contour
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
-class PedestrianTracking:
-  """ Class to keep track of mapping of pedestrian indexes to bboxes and detection zone (up/down)"""
-
-  def __init__(self):
-    self.positions = dict()
-    self._up = 0
-    self._down = 1
-
-  def any_currently_tracked(self):
-    return len(self.positions)>0
-
-  def get_tracked_bboxes(self):
-    return self.positions
-
-  def update_pos(self, idxsToRemove, idxsUp, peds_bboxes_up, idxsDown, peds_bboxes_down):
-    for i in idxsToRemove:
-      if i in self.positions:
-        del self.positions[i]
-    going_up = []
-    going_down = []
-    for idxs, bboxes, direction, going in zip((idxsUp, idxsDown), (peds_bboxes_up, peds_bboxes_down), (self._up, self._down), (going_up, going_down)):
-      for i, bbox in zip(idxs, bboxes):
-        bbox.direction = direction
-        if i in self.positions and self.positions[i].direction!=direction:
-          going.append(i)
-        self.positions[i] = bbox
+def create_costs_matrix(A : np.ndarray, B: np.ndarray, mode : str = 'euclidean', maximum_cost : float = None, value_to_use_as_inf : float = None) -> np.ndarray:
+    """
+    Function to get a matrix C from two vectors of positions (A and B) so C_i_j is the cost (distance) between i-th element from A and j-th element from B.
+    The whole matrix is computed with numpy broadcasting, and costs above maximum_cost are gated to value_to_use_as_inf in the same pass.
+    inputs:
+        A : np.ndarray -> Numpy array with shape (n,2), or (n,4) boxes (x1,y1,x2,y2) in 'iou' mode.
+        B : np.ndarray -> Numpy array with shape (m,2), or (m,4) boxes (x1,y1,x2,y2) in 'iou' mode.
+        mode : str -> 'euclidean' (distance), 'sqeuclidean' (squared distance) or 'iou' (1 - intersection over union).
+        maximum_cost : float -> Costs greater than this value are set to value_to_use_as_inf (no gating if None).
+        value_to_use_as_inf : float -> The value to use instead of infinite.
 
-    return going_up, going_down
+    outputs:
+        C : np.ndarray -> Numpy array with shape (n,m).
+    """
 
-class VehicleTracking:
-  """ Class to keep track of mapping of vehicle indexes to bboxes"""
+    assert len(A.shape) == 2
+    assert len(B.shape) == 2
 
-  def __init__(self):
-    self.positions = dict()
+    if mode == 'iou':
+        assert A.shape[1] == 4
+        assert B.shape[1] == 4
+        A = A.astype(np.float64)
+        B = B.astype(np.float64)
+        iw = np.minimum(A[:, None, 2], B[None, :, 2]) - np.maximum(A[:, None, 0], B[None, :, 0])
+        ih = np.minimum(A[:, None, 3], B[None, :, 3]) - np.maximum(A[:, None, 1], B[None, :, 1])
+        intersection = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+        area_A = (A[:, 2] - A[:, 0]) * (A[:, 3] - A[:, 1])
+        area_B = (B[:, 2] - B[:, 0]) * (B[:, 3] - B[:, 1])
+        union = area_A[:, None] + area_B[None, :] - intersection
+        C = 1.0 - intersection / np.maximum(union, 1e-9)
+    else:
+        assert A.shape[1] == 2
+        assert B.shape[1] == 2
+        D = A[:, None, :].astype(np.float64) - B[None, :, :]
+        C = np.einsum('ijk,ijk->ij', D, D)
+        if mode == 'euclidean':
+            np.sqrt(C, out=C)
+        elif mode != 'sqeuclidean':
+            raise ValueError('Unknown cost mode %s' % mode)
+
+    if maximum_cost is not None:
+        C[C > maximum_cost] = value_to_use_as_inf
 
-  def any_currently_tracked(self):
-    return len(self.positions)>0
+    return C
 
-  def get_tracked_bboxes(self):
-    return self.positions
 
-  def update_pos(self, idxsToRemove, idxsPresent, bboxes):
-    for i in idxsToRemove:
-      if i in self.positions:
-        del self.positions[i]
-    areNew = []
-    for i, bbox in zip(idxsPresent, bboxes):
-      if i not in self.positions:
-        areNew.append(i)
-      self.positions[i] = bbox
-    return areNew
+def suppression_keep_mask(candidates : np.ndarray, references : np.ndarray, mode : str = 'chebyshev', threshold : float = 70) -> np.ndarray:
+    """
+    Function to discard the candidates too close to any reference (e.g. the pedestrian detections that are the rider of a motorcycle),
+    comparing every candidate with every reference in a single broadcast operation.
+    inputs:
+        candidates : np.ndarray -> Numpy array with shape (n,2) centers, or (n,4) boxes (x1,y1,x2,y2) in 'overlap' mode.
+        references : np.ndarray -> Numpy array with shape (m,2) centers, or (m,4) boxes (x1,y1,x2,y2) in 'overlap' mode.
+        mode : str -> 'chebyshev' (a candidate is suppressed if both |dx| and |dy| to a reference are lesser than threshold) or
+                      'overlap' (a candidate is suppressed if a reference covers at least a threshold fraction of its box).
+        threshold : float -> Distance in pixels ('chebyshev') or fraction of the candidate area ('overlap').
 
+    outputs:
+        keep : np.ndarray -> Boolean numpy array with shape (n), False for the suppressed candidates.
+    """
+    width = 4 if mode == 'overlap' else 2
+    candidates = np.asarray(candidates, dtype=np.float64).reshape(-1, width)
+    references = np.asarray(references, dtype=np.float64).reshape(-1, width)
+    if candidates.shape[0] == 0 or references.shape[0] == 0:
+        return np.ones(candidates.shape[0], dtype=bool)
+
+    if mode == 'chebyshev':
+        distances = np.abs(candidates[:, None, :] - references[None, :, :]).max(axis=2)
+        suppressed = distances < threshold
+    elif mode == 'overlap':
+        iw = np.minimum(candidates[:, None, 2], references[None, :, 2]) - np.maximum(candidates[:, None, 0], references[None, :, 0])
+        ih = np.minimum(candidates[:, None, 3], references[None, :, 3]) - np.maximum(candidates[:, None, 1], references[None, :, 1])
+        intersection = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+        area = (candidates[:, 2] - candidates[:, 0]) * (candidates[:, 3] - candidates[:, 1])
+        suppressed = intersection >= threshold * np.maximum(area, 1e-9)[:, None]
+    else:
+        raise ValueError('Unknown suppression mode %s' % mode)
+
+    return ~suppressed.any(axis=1)
+
+
+def gated_candidate_pairs(A : np.ndarray, B : np.ndarray, maximum_distance : float):
+    """
+    Function to find every pair (i,j) with A_i and B_j closer than maximum_distance without computing the whole distance matrix.
+    B is bucketed in a grid of cells of side maximum_distance, so the candidates of A_i are in the 3x3 cells around its own cell.
+    inputs:
+        A : np.ndarray -> Numpy array with shape (n,2).
+        B : np.ndarray -> Numpy array with shape (m,2).
+        maximum_distance : float -> Side of the grid cells.
 
-def create_costs_matrix(A : np.ndarray, B: np.ndarray) -> np.ndarray:
+    outputs:
+        rows : np.ndarray -> Indexes in A of the candidate pairs.
+        cols : np.ndarray -> Indexes in B of the candidate pairs.
     """
-    Function to get a matrix C from two vectors of positions (A and B) so C_i_j is the cost (distance) between i-th element from A and j-th element from B.
+    cell_A = np.floor(A / maximum_distance).astype(np.int64)
+    cell_B = np.floor(B / maximum_distance).astype(np.int64)
+    origin = np.minimum(cell_A.min(axis=0), cell_B.min(axis=0)) - 1
+    cell_A -= origin
+    cell_B -= origin
+    width = max(cell_A[:, 1].max(), cell_B[:, 1].max()) + 2
+
+    # Cells of B as sorted scalar keys, so the points of any cell are a contiguous range.
+    keys_B = cell_B[:, 0] * width + cell_B[:, 1]
+    order = np.argsort(keys_B, kind='stable')
+    sorted_keys = keys_B[order]
+
+    rows = []
+    cols = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            keys = (cell_A[:, 0] + dx) * width + cell_A[:, 1] + dy
+            start = np.searchsorted(sorted_keys, keys, 'left')
+            counts = np.searchsorted(sorted_keys, keys, 'right') - start
+            total = counts.sum()
+            if total == 0:
+                continue
+            # Offsets 0..counts[i]-1 inside the range of each point of A.
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows.append(np.repeat(np.arange(A.shape[0]), counts))
+            cols.append(order[np.repeat(start, counts) + offsets])
+
+    if not rows:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def gated_assignment(A : np.ndarray, B : np.ndarray, maximum_distance : float, mode : str = 'euclidean', maximum_cost : float = None, value_to_use_as_inf : float = None):
+    """
+    Function to solve the assignment between A and B without the dense cost matrix.
+    The candidate pairs (cost not above maximum_cost) are found with a spatial grid, the bipartite graph they form is split in
+    connected components and each component is solved on its own with linear_sum_assignment. Since pairs from different components
+    can only be assigned at value_to_use_as_inf cost, the assigned pairs with cost lesser than maximum_cost are the same ones
+    linear_sum_assignment gives for the dense matrix of create_costs_matrix (unless there are ties between optimal assignments).
     inputs:
         A : np.ndarray -> Numpy array with shape (n,2).
         B : np.ndarray -> Numpy array with shape (m,2).
+        maximum_distance : float -> Maximum distance between assigned positions (maximum_cost is its square in 'sqeuclidean' mode).
+        mode : str -> 'euclidean' or 'sqeuclidean' (see create_costs_matrix).
+        maximum_cost : float -> Costs greater than this value are set to value_to_use_as_inf.
+        value_to_use_as_inf : float -> The value to use instead of infinite.
 
     outputs:
-        C : np.ndarray -> Numpy array with shape (n,m).
+        rows : np.ndarray -> Indexes in A of the assigned pairs with cost lesser than maximum_cost.
+        cols : np.ndarray -> Indexes in B of the assigned pairs with cost lesser than maximum_cost.
+        costs : np.ndarray -> Cost of each assigned pair.
+    """
+    assert len(A.shape) == 2 and A.shape[1] == 2
+    assert len(B.shape) == 2 and B.shape[1] == 2
+
+    empty = np.zeros(0, dtype=np.int64)
+    if A.shape[0] == 0 or B.shape[0] == 0:
+        return empty, empty, np.zeros(0)
+
+    rows, cols = gated_candidate_pairs(A, B, maximum_distance)
+    D = A[rows].astype(np.float64) - B[cols]
+    costs = np.einsum('ij,ij->i', D, D)
+    if mode == 'euclidean':
+        np.sqrt(costs, out=costs)
+    elif mode != 'sqeuclidean':
+        raise ValueError('Unsupported cost mode for gated assignment %s' % mode)
+    # Same gating as create_costs_matrix: only the costs greater than maximum_cost are set to value_to_use_as_inf.
+    inside = costs <= maximum_cost
+    return solve_candidate_pairs(rows[inside], cols[inside], costs[inside], np.full(np.count_nonzero(inside), maximum_cost),
+                                 value_to_use_as_inf)
+
+
+def solve_candidate_pairs(rows : np.ndarray, cols : np.ndarray, costs : np.ndarray, limits : np.ndarray, value_to_use_as_inf : float):
     """
+    Function to solve a sparse assignment: the bipartite graph of the candidate pairs is split in connected components
+    and each component is solved on its own with linear_sum_assignment (missing pairs cost value_to_use_as_inf).
+    inputs:
+        rows : np.ndarray -> Row index of each candidate pair.
+        cols : np.ndarray -> Column index of each candidate pair.
+        costs : np.ndarray -> Cost of each candidate pair.
+        limits : np.ndarray -> A pair is only an assignment if its cost is lesser than its limit.
+        value_to_use_as_inf : float -> The value to use instead of infinite.
 
-    #print(B)
-    assert len(A.shape) == 2
-    assert len(B.shape) == 2
-    assert A.shape[1] == 2
-    assert B.shape[1] == 2
+    outputs:
+        rows : np.ndarray -> Row indexes of the assigned pairs.
+        cols : np.ndarray -> Column indexes of the assigned pairs.
+        costs : np.ndarray -> Cost of each assigned pair.
+    """
+    empty = np.zeros(0, dtype=np.int64)
+    if rows.shape[0] == 0:
+        return empty, empty, np.zeros(0)
+
+    # Connected components of the bipartite graph (nodes 0..n-1 are rows, n..n+m-1 are columns).
+    n = rows.max() + 1
+    size = n + cols.max() + 1
+    graph = coo_matrix((np.ones(rows.shape[0]), (rows, n + cols)), shape=(size, size))
+    _, labels = connected_components(graph, directed=False)
+
+    # Pairs grouped by component.
+    order = np.argsort(labels[rows], kind='stable')
+    rows, cols, costs, limits = rows[order], cols[order], costs[order], limits[order]
+    bounds = np.flatnonzero(np.diff(labels[rows])) + 1
+
+    assigned = []
+    for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [rows.shape[0]]])):
+        if end - start == 1:
+            # A single candidate pair is always assigned.
+            assigned.append(np.arange(start, end))
+            continue
+        component_rows, local_rows = np.unique(rows[start:end], return_inverse=True)
+        component_cols, local_cols = np.unique(cols[start:end], return_inverse=True)
+        C = np.full((component_rows.shape[0], component_cols.shape[0]), value_to_use_as_inf, dtype=np.float64)
+        C[local_rows, local_cols] = costs[start:end]
+        # Index of the candidate pair in each cell of C (-1 where there is none).
+        P = np.full(C.shape, -1, dtype=np.int64)
+        P[local_rows, local_cols] = np.arange(start, end)
+        r, c = linear_sum_assignment(C)
+        assigned.append(P[r, c][P[r, c] >= 0])
+
+    assigned = np.concatenate(assigned)
+    # As in the dense case, pairs exactly at their limit are not assignments.
+    assigned = assigned[costs[assigned] < limits[assigned]]
+    return rows[assigned], cols[assigned], costs[assigned]
+
+
+# Largest growth of the gating distances when frames are elapsed between detections.
+MAXIMUM_GATE_GROWTH = 1.5
+
+
+def elapsed_gate(maximum_distance, elapsed_frames : int):
+    """
+    Function to widen gating distances when frames were elapsed without detection. They grow with the uncertainty of the
+    positions (sqrt of the elapsed frames), not linearly, and up to MAXIMUM_GATE_GROWTH times: scaled linearly they would
+    cover the whole frame at low detection rates, and objects leaving would be taken over by the ones entering.
+    inputs:
+        maximum_distance : float or np.ndarray -> Gating distances for consecutive detections.
+        elapsed_frames : int -> Frames elapsed since the previous detection.
 
-    n = A.shape[0]
-    m = B.shape[0]
-    C = -1*np.ones(shape=(n, m))
+    outputs:
+        gates : float or np.ndarray -> Gating distances to use.
+    """
+    return maximum_distance * min(np.sqrt(max(elapsed_frames, 1)), MAXIMUM_GATE_GROWTH)
 
-    for i in range(n):
-        for j in range(m):
-            C[i,j] = np.linalg.norm(A[i]-B[j])
 
-    return C
+def kalman_initial_covariance(measurement_noise : float, velocity_variance : float) -> np.ndarray:
+    """
+    Covariance of a new constant velocity state (x, y, vx, vy): the object starts still, with a large uncertainty on its velocity.
+    """
+    return np.diag([measurement_noise, measurement_noise, velocity_variance, velocity_variance])
+
+
+def kalman_predict(states : np.ndarray, covariances : np.ndarray, elapsed_frames : int, process_noise : float):
+    """
+    Function to move constant velocity states elapsed_frames ahead, all at once.
+    inputs:
+        states : np.ndarray -> Numpy array with shape (n,4), (x, y, vx, vy) with velocities in pixels per frame.
+        covariances : np.ndarray -> Numpy array with shape (n,4,4).
+        elapsed_frames : int -> Frames to predict.
+        process_noise : float -> Variance of the acceleration (pixels^2/frame^4).
+
+    outputs:
+        states : np.ndarray -> Predicted states.
+        covariances : np.ndarray -> Predicted covariances.
+    """
+    dt = float(elapsed_frames)
+    F = np.array([[1, 0, dt, 0],
+                  [0, 1, 0, dt],
+                  [0, 0, 1, 0],
+                  [0, 0, 0, 1]])
+    # Piecewise constant white acceleration.
+    G = np.array([[dt ** 2 / 2, 0], [0, dt ** 2 / 2], [dt, 0], [0, dt]])
+    Q = process_noise * G @ G.T
+    return states @ F.T, F @ covariances @ F.T + Q
+
+
+def kalman_update(states : np.ndarray, covariances : np.ndarray, indices : np.ndarray, positions : np.ndarray, measurement_noise : float):
+    """
+    Function to correct some of the states with their measured positions, in place.
+    inputs:
+        states : np.ndarray -> Numpy array with shape (n,4).
+        covariances : np.ndarray -> Numpy array with shape (n,4,4).
+        indices : np.ndarray -> Indexes of the corrected states, shape (k).
+        positions : np.ndarray -> Measured positions, shape (k,2).
+        measurement_noise : float -> Variance of the measured positions (pixels^2).
+    """
+    P = covariances[indices]
+    S = P[:, :2, :2] + measurement_noise * np.eye(2)                    # Innovation covariances (k,2,2).
+    K = P[:, :, :2] @ np.linalg.inv(S)                                  # Kalman gains (k,4,2).
+    innovation = positions - states[indices, :2]
+    states[indices] += (K @ innovation[:, :, None])[:, :, 0]
+    covariances[indices] = P - K @ P[:, :2, :]
 
 
 class Trace:
     """
     Class to represent a complete trace.
+    The history of positions is a fixed-capacity ring buffer of float32 positions plus a validity mask (False for skipped frames),
+    and the last valid position is cached, so long-lived traces take constant memory and constant time per frame.
     """
 
-    def __init__(self, trace_id:int, initial_position:np.ndarray):
+    __slots__ = 'id', 'positions', 'valid', 'head', 'count', 'last_valid_position', 'skipped_frames'
+
+    def __init__(self, trace_id:int, initial_position:np.ndarray, history_length:int = 64):
         """
         inputs:
             trace_id : int -> trace identification number.
             initial_position : np.ndarray -> Numpy array with shape (2).
+            history_length : int -> Number of frames (positions or skipped) kept in the history.
         """
-        self.id = trace_id                          # Trace id.
-        self.positions = [initial_position]         # Last known position.
-        self.skipped_frames = 0                     # Number of frames already skipped.
-
-    def skipped(self):
+        self.id = trace_id                                                  # Trace id.
+        self.positions = np.zeros((history_length, 2), dtype=np.float32)    # Ring buffer of positions.
+        self.valid = np.zeros(history_length, dtype=bool)                   # False where the frame was skipped.
+        self.head = 0                                                       # Index of the next slot to write.
+        self.count = 0                                                      # Number of frames in the history.
+        self.last_valid_position = None                                     # Last known position.
+        self.skipped_frames = 0                                             # Number of frames already skipped.
+        self.add_position(initial_position)
+
+    def _push(self, position):
+        if position is None:
+            self.valid[self.head] = False
+        else:
+            self.positions[self.head] = position
+            self.valid[self.head] = True
+        self.head = (self.head + 1) % len(self.valid)
+        self.count = min(self.count + 1, len(self.valid))
+
+    def _ordered_indexes(self):
+        # Indexes of the history from the oldest to the newest frame.
+        return np.arange(self.head - self.count, self.head) % len(self.valid)
+
+    def skipped(self, frames=1):
         self.add_None_position()
-        self.skipped_frames += 1
+        self.skipped_frames += frames
 
     def get_last_position(self):
-        return self.positions[-1]
+        if self.skipped_frames > 0:
+            return None
+        return self.last_valid_position
 
     def get_last_not_None_position(self):
-        for p in reversed(self.positions):
-            if not p is None:
-                return p
+        return self.last_valid_position
 
     def add_position(self, position):
         assert not position is None
-        self.positions.append(position)
+        self._push(position)
+        self.last_valid_position = self.positions[(self.head - 1) % len(self.valid)].copy()
         self.skipped_frames = 0
 
     def add_None_position(self):
-        self.positions.append(None)
+        self._push(None)
 
     def get_skipped_frames(self):
         return self.skipped_frames
@@ -125,26 +357,34 @@ class Trace:
         return self.id
 
     def get_positions(self):
-        return self.positions
+        return [self.positions[i].copy() if self.valid[i] else None for i in self._ordered_indexes()]
 
     def get_not_None_positions(self):
-
-        l = []
-        for p in self.positions:
-            if not p is None:
-                l.append(p)
-        return l
+        idxs = self._ordered_indexes()
+        return list(self.positions[idxs[self.valid[idxs]]])
 
 class Tracker:
     """
     Class to rerepresent a Tracker.
     """
-    def __init__(self, maximum_distance_to_assign:int, maximum_frames_to_skip_before_set_trace_as_inactive:int, value_to_use_as_inf = 50000):
+    def __init__(self, maximum_distance_to_assign:int, maximum_frames_to_skip_before_set_trace_as_inactive:int, value_to_use_as_inf = 50000, cost_mode = 'euclidean', trace_history_length = 64,
+                 motion_model = 'static', process_noise = 1.0, measurement_noise = 10.0, assignment = 'dense'):
         """
         inputs:
             maximum_distance_to_assign : int -> The reference we will use as maximum distance in order to avoid assignments between positions too far.
             maximum_frames_to_skip_before_set_trace_as_inactive : int -> The amount of frames we will allow to be skkiped by a trace before setting it as inactive.
             value_to_use_as_inf : int -> The value to use instead of infinite as "very large value" in order to avoid numerical problems.
+            cost_mode : str -> 'euclidean' or 'sqeuclidean' (see create_costs_matrix). Squared distances avoid the square roots and
+                               penalize long jumps more in the assignment; the gating is the same in both modes.
+            trace_history_length : int -> Number of frames kept in the history of each trace.
+            motion_model : str -> 'static' (incomming positions are associated to the last known position of each trace) or
+                                  'kalman' (constant velocity Kalman filter: they are associated to the predicted position of each trace,
+                                  so fast objects are not lost when they move farther than maximum_distance_to_assign between detections).
+            process_noise : float -> Kalman mode, variance of the acceleration (pixels^2/frame^4) allowed by the constant velocity model.
+            measurement_noise : float -> Kalman mode, variance of the detected positions (pixels^2).
+            assignment : str -> 'dense' (linear_sum_assignment on the whole costs matrix) or 'sparse' (see gated_assignment: same
+                                result, faster only with many traces and a gate small
+                                compared to the frame, so that they split in many groups).
         """
         self.active_traces = []                                         # Active traces.
         #self.inactive_traces = []                                       # Old traces. self.active_traces and self.inactive_traces should be disjoint sets.
@@ -153,34 +393,117 @@ class Tracker:
         self.maximum_frames_to_skip_before_set_trace_as_inactive = maximum_frames_to_skip_before_set_trace_as_inactive # Maximum skipped frames number before set a trace as inactive.
 
         self.value_to_use_as_inf = value_to_use_as_inf
+        self.cost_mode = cost_mode
+        self.trace_history_length = trace_history_length
+
+        if not motion_model in ('static', 'kalman'):
+            raise ValueError('Unknown motion model %s' % motion_model)
+        self.motion_model = motion_model
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        if not assignment in ('dense', 'sparse'):
+            raise ValueError('Unknown assignment %s' % assignment)
+        self.assignment = assignment
+        # Kalman mode: state (x, y, vx, vy) and covariance of every active trace, in the same order as self.active_traces,
+        # so all traces are predicted and updated at once. Velocities are in pixels per frame.
+        self.states = np.zeros((0, 4), dtype=np.float64)
+        self.covariances = np.zeros((0, 4, 4), dtype=np.float64)
 
     def new_trace(self, position):
-        self.active_traces.append(Trace(self.next_trace_id, position))
+        self.active_traces.append(Trace(self.next_trace_id, position, self.trace_history_length))
         self.next_trace_id += 1
 
+        if self.motion_model == 'kalman':
+            state = np.array([[position[0], position[1], 0.0, 0.0]])
+            covariance = kalman_initial_covariance(self.measurement_noise, self.maximum_distance_to_assign ** 2)
+            self.states = np.concatenate([self.states, state])
+            self.covariances = np.concatenate([self.covariances, covariance[None]])
+
         return self.next_trace_id-1
 
+    def _remove_inactive_traces(self):
+        """
+        Removes the active traces with too much skipped frames.
+        outputs:
+            inactive_traces : list -> Ids of the removed traces.
+        """
+        inactive_traces = []
+        keep = []
+        for trace_index, trace in enumerate(self.active_traces):
+            if trace.get_skipped_frames() > self.maximum_frames_to_skip_before_set_trace_as_inactive:
+                #self.inactive_traces.append(trace)
+                inactive_traces.append(trace.get_id())
+            else:
+                keep.append(trace_index)
+        if inactive_traces:
+            self.active_traces = [self.active_traces[trace_index] for trace_index in keep]
+            if self.motion_model == 'kalman':
+                self.states = self.states[keep]
+                self.covariances = self.covariances[keep]
+        return inactive_traces
+
     def active_traces_last_positions(self):
         last_positions = []
         for trace in self.active_traces:
             last_positions.append(trace.get_last_not_None_position())
 
-        return np.array(last_positions)
+        return np.array(last_positions, dtype=np.float32)
+
+    def active_traces_predicted_positions(self):
+        """
+        outputs:
+            predicted_positions : np.ndarray -> Numpy array with shape (n,2), the positions the traces are associated against
+                                                (the last known positions in 'static' mode).
+        """
+        if self.motion_model == 'kalman':
+            return self.states[:, :2].astype(np.float32)
+        return self.active_traces_last_positions()
+
+    def active_traces_velocities(self):
+        """
+        outputs:
+            velocities : np.ndarray -> Numpy array with shape (n,2), velocity of each active trace in pixels per frame
+                                       (zeros in 'static' mode).
+        """
+        if self.motion_model == 'kalman':
+            return self.states[:, 2:].astype(np.float32)
+        return np.zeros((len(self.active_traces), 2), dtype=np.float32)
+
+    def get_velocity(self, trace_id):
+        """
+        inputs:
+            trace_id : int -> Id of an active trace.
+
+        outputs:
+            velocity : np.ndarray -> Numpy array with shape (2), in pixels per frame, or None if the trace is not active.
+        """
+        for trace_index, trace in enumerate(self.active_traces):
+            if trace.get_id() == trace_id:
+                return self.active_traces_velocities()[trace_index]
+        return None
 
     def get_active_traces(self):
         return self.active_traces
 
-    def assign_incomming_positions(self, new_positions:np.ndarray):
+    def assign_incomming_positions(self, new_positions:np.ndarray, elapsed_frames:int = 1):
         """
         Method to insert new positions in order to be associated to active traces. All position without valid association will start its own new trace.
         intpus:
             new_positions : np.ndarray -> A numpy array with shape (n,2).
+            elapsed_frames : int -> Frames elapsed since the previous call (greater than 1 if detection runs at a lower rate than capture).
+                                    The skipped frames are scaled accordingly, and the maximum distance to assign grows (see elapsed_gate).
 
         outputs:
             associated_ids : np.ndarray -> Each trace id associated to the incomming positions.
         """
         associated_ids = new_positions.shape[0]*[None]
         inactive_traces = []
+        # Objects move farther between calls if frames were elapsed without detection.
+        maximum_distance_to_assign = min(elapsed_gate(self.maximum_distance_to_assign, elapsed_frames), self.value_to_use_as_inf - 1)
+
+        # In Kalman mode, every active trace is moved to its predicted position before the association.
+        if self.motion_model == 'kalman' and len(self.active_traces) > 0:
+            self.states, self.covariances = kalman_predict(self.states, self.covariances, elapsed_frames, self.process_noise)
 
         # If there are no active traces.
         if len(self.active_traces) == 0:
@@ -192,58 +515,299 @@ class Tracker:
         if new_positions.shape[0] == 0:
             # We will increase skipped frames for each trace.
             for trace_index in range(len(self.active_traces)):
-                self.active_traces[trace_index].skipped()
+                self.active_traces[trace_index].skipped(elapsed_frames)
 
             # We will move each active trace with too much skipped frames to inactive traces.
-            for trace_index in reversed(list(range(len(self.active_traces)))):
-                if self.active_traces[trace_index].get_skipped_frames() > self.maximum_frames_to_skip_before_set_trace_as_inactive:
-                    trace = self.active_traces.pop(trace_index)
-                    #self.inactive_traces.append(trace)
-                    inactive_traces.append(trace.get_id())
+            inactive_traces = self._remove_inactive_traces()
 
         if len(self.active_traces) > 0 and  new_positions.shape[0] > 0:
-            traces_last_positions = self.active_traces_last_positions()
-
-            costs_matrix = create_costs_matrix(traces_last_positions, new_positions) # We get the assignment cost between incomming positions and active traces last known positions.
-
-            assert costs_matrix.shape[0] == traces_last_positions.shape[0]
-            assert costs_matrix.shape[1] == new_positions.shape[0]
-
-            # We set any cost value greater than self.maximum_distance_to_assign as self.value_to_use_as_inf.
-            costs_matrix[costs_matrix > self.maximum_distance_to_assign] = self.value_to_use_as_inf
-
-            # https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.linear_sum_assignment.html
-            trace_indices, pos_indices = linear_sum_assignment(costs_matrix)
+            # Last known positions, or predicted positions in Kalman mode.
+            traces_last_positions = self.active_traces_predicted_positions()
+
+            # With squared distances, the gate and the "infinite" value are squared too (keeping their ratio).
+            if self.cost_mode == 'sqeuclidean':
+                maximum_cost = maximum_distance_to_assign ** 2
+                value_to_use_as_inf = self.value_to_use_as_inf * maximum_distance_to_assign
+            else:
+                maximum_cost = maximum_distance_to_assign
+                value_to_use_as_inf = self.value_to_use_as_inf
+
+            if self.assignment == 'sparse':
+                # Only the pairs closer than the maximum distance are evaluated, and each group of nearby traces is solved on its own.
+                trace_indices, pos_indices, costs = gated_assignment(traces_last_positions, new_positions, maximum_distance_to_assign,
+                                                                     self.cost_mode, maximum_cost, value_to_use_as_inf)
+            else:
+                # We get the assignment cost between incomming positions and active traces last known positions.
+                # Any cost value greater than maximum_cost is set as value_to_use_as_inf in the same pass.
+                costs_matrix = create_costs_matrix(traces_last_positions, new_positions, self.cost_mode, maximum_cost, value_to_use_as_inf)
+
+                assert costs_matrix.shape[0] == traces_last_positions.shape[0]
+                assert costs_matrix.shape[1] == new_positions.shape[0]
+
+                # https://docs.scipy.org/doc/scipy/reference/generated/scipy.optimize.linear_sum_assignment.html
+                trace_indices, pos_indices = linear_sum_assignment(costs_matrix)
+                costs = costs_matrix[trace_indices, pos_indices]
 
             assigned_positions = []
             assigned_traces = []
 
             # Now the i-th index in trace_indices and i-th in pos_indices should be the optimal assignment.
-            for trace_index, pos_index in zip(trace_indices, pos_indices):
-                cost = costs_matrix[trace_index, pos_index]
-                # If the assignment has lesser cost than self.maximum_distance_to_assign, we assignt the position to the trace.
-                if cost < self.maximum_distance_to_assign:
+            for trace_index, pos_index, cost in zip(trace_indices, pos_indices, costs):
+                # If the assignment has lesser cost than maximum_cost, we assignt the position to the trace.
+                if cost < maximum_cost:
                     self.active_traces[trace_index].add_position(new_positions[pos_index])
                     assigned_positions.append(pos_index)
                     assigned_traces.append(trace_index)
                     associated_ids[pos_index] = self.active_traces[trace_index].get_id()
 
+            # All the assigned traces are corrected at once.
+            if self.motion_model == 'kalman' and assigned_traces:
+                kalman_update(self.states, self.covariances, np.array(assigned_traces),
+                              new_positions[assigned_positions].astype(np.float64), self.measurement_noise)
+
             # We will increase skipped frames for each non assigned trace.
+            assigned_traces_set = set(assigned_traces)
             for trace_index in range(len(self.active_traces)):
-                if not trace_index in assigned_traces:
-                    self.active_traces[trace_index].skipped()
+                if not trace_index in assigned_traces_set:
+                    self.active_traces[trace_index].skipped(elapsed_frames)
 
             # We will move each active trace with too much skipped frames to inactive traces.
-            for trace_index in reversed(list(range(len(self.active_traces)))):
-                if self.active_traces[trace_index].get_skipped_frames() > self.maximum_frames_to_skip_before_set_trace_as_inactive:
-                    trace = self.active_traces.pop(trace_index)
-                    #self.inactive_traces.append(trace)
-                    inactive_traces.append(trace.get_id())
+            inactive_traces = self._remove_inactive_traces()
 
             # We will generate new traces from non assigned positions.
+            assigned_positions_set = set(assigned_positions)
             for pos_index in range(new_positions.shape[0]):
-                if not pos_index in assigned_positions:
+                if not pos_index in assigned_positions_set:
                     new_trace_id = self.new_trace(new_positions[pos_index])
                     associated_ids[pos_index] = new_trace_id
 
         return associated_ids, inactive_traces
+
+
+class TrackingEvents:
+    """
+    Class to represent the result of MultiClassTracker.update: the trace of each incomming position and what happened to the traces of each class.
+    """
+    def __init__(self, ids:np.ndarray, class_names:list):
+        self.ids = ids                                                      # Trace id associated to each incomming position.
+        self.new = {name: [] for name in class_names}                       # Ids of the new traces, by class.
+        self.removed = {name: [] for name in class_names}                   # Ids of the traces set as inactive, by class.
+        self.transitions = {name: [] for name in class_names}               # (id, previous zone, new zone) of the traces that changed of zone, by class.
+
+    def transitions_to(self, class_name, zone):
+        return [trace_id for trace_id, _, new_zone in self.transitions[class_name] if new_zone == zone]
+
+
+class MultiClassTracker:
+    """
+    Class to represent a tracker of several classes of objects seen by one camera.
+    The active traces of every class are kept in shared numpy arrays (ids, class, last position, zone, skipped frames, and the
+    Kalman state in 'kalman' mode), and each update associates all the classes in a single pass: pairs of different classes,
+    or farther than the gating distance of the class of the trace, cost value_to_use_as_inf.
+    """
+    NO_ZONE = -1
+
+    def __init__(self, classes:dict, value_to_use_as_inf = 50000, motion_model = 'static', process_noise = 1.0, measurement_noise = 10.0, assignment = 'dense'):
+        """
+        inputs:
+            classes : dict -> For each class name, a tuple (maximum_distance_to_assign, maximum_frames_to_skip_before_set_trace_as_inactive).
+                              The labels given to update() are the indexes of the classes in this dict.
+            value_to_use_as_inf : int -> The value to use instead of infinite as "very large value" in order to avoid numerical problems.
+            motion_model : str -> 'static' or 'kalman' (see Tracker).
+            process_noise : float -> Kalman mode, variance of the acceleration (pixels^2/frame^4).
+            measurement_noise : float -> Kalman mode, variance of the detected positions (pixels^2).
+            assignment : str -> 'dense' or 'sparse' (see Tracker).
+        """
+        if not motion_model in ('static', 'kalman'):
+            raise ValueError('Unknown motion model %s' % motion_model)
+        if not assignment in ('dense', 'sparse'):
+            raise ValueError('Unknown assignment %s' % assignment)
+
+        self.class_names = list(classes.keys())
+        self.class_index = {name: index for index, name in enumerate(self.class_names)}
+        self.maximum_distances = np.array([classes[name][0] for name in self.class_names], dtype=np.float64)
+        self.maximum_skipped = np.array([classes[name][1] for name in self.class_names], dtype=np.int64)
+        self.value_to_use_as_inf = value_to_use_as_inf
+        self.motion_model = motion_model
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+        self.assignment = assignment
+        self.next_trace_id = 0
+
+        # State of the active traces, one row per trace.
+        self.ids = np.zeros(0, dtype=np.int64)                              # Trace ids.
+        self.labels = np.zeros(0, dtype=np.int64)                           # Class indexes.
+        self.positions = np.zeros((0, 2), dtype=np.float32)                 # Last assigned positions.
+        self.zones = np.zeros(0, dtype=np.int64)                            # Zones of the last assigned positions (NO_ZONE if none).
+        self.skipped = np.zeros(0, dtype=np.int64)                          # Frames skipped since the last assigned position.
+        self.states = np.zeros((0, 4), dtype=np.float64)                    # Kalman mode, (x, y, vx, vy).
+        self.covariances = np.zeros((0, 4, 4), dtype=np.float64)            # Kalman mode, state covariances.
+        self.items = []                                                     # Object given with the last assigned position (e.g. its bbox).
+
+    def __len__(self):
+        return self.ids.shape[0]
+
+    def any_tracked(self, class_name=None):
+        labels = self.labels
+        if class_name is None:
+            return labels.shape[0] > 0
+        return bool(np.any(labels == self.class_index[class_name]))
+
+    def class_positions(self, class_name):
+        """
+        outputs:
+            positions : np.ndarray -> Numpy array with shape (k,2), last assigned positions of the active traces of the class.
+        """
+        return self.positions[self.labels == self.class_index[class_name]]
+
+    def velocities(self):
+        """
+        outputs:
+            velocities : np.ndarray -> Numpy array with shape (n,2), velocity of each active trace in pixels per frame (zeros in 'static' mode).
+        """
+        if self.motion_model == 'kalman':
+            return self.states[:, 2:].astype(np.float32)
+        return np.zeros((len(self), 2), dtype=np.float32)
+
+    def state(self):
+        """
+        outputs:
+            traces : list -> One dict per active trace (id, class, position, velocity, zone, skipped frames), with plain Python values.
+        """
+        velocities = self.velocities()
+        return [{'id': int(self.ids[i]),
+                 'class': self.class_names[self.labels[i]],
+                 'position': self.positions[i].tolist(),
+                 'velocity': velocities[i].tolist(),
+                 'zone': int(self.zones[i]),
+                 'skipped': int(self.skipped[i])}
+                for i in range(len(self))]
+
+    def tracked_items(self, class_name=None):
+        """
+        outputs:
+            items : dict -> Trace id to the object given with its last assigned position, for the active traces (of the class if given).
+        """
+        if class_name is None:
+            return dict(zip(self.ids.tolist(), self.items))
+        label = self.class_index[class_name]
+        return {trace_id: item for trace_id, item, trace_label in zip(self.ids.tolist(), self.items, self.labels) if trace_label == label}
+
+    def _associate(self, reference, new_positions, new_labels, gates):
+        """
+        outputs:
+            rows : np.ndarray -> Indexes of the assigned traces.
+            cols : np.ndarray -> Indexes of their assigned positions.
+        """
+        if self.assignment == 'sparse':
+            rows, cols = gated_candidate_pairs(reference, new_positions, gates.max())
+            D = reference[rows].astype(np.float64) - new_positions[cols]
+            costs = np.sqrt(np.einsum('ij,ij->i', D, D))
+            inside = (self.labels[rows] == new_labels[cols]) & (costs <= gates[rows])
+            rows, cols, _ = solve_candidate_pairs(rows[inside], cols[inside], costs[inside], gates[rows[inside]], self.value_to_use_as_inf)
+            return rows, cols
+
+        costs_matrix = create_costs_matrix(reference, new_positions, 'euclidean')
+        costs_matrix[(costs_matrix > gates[:, None]) | (self.labels[:, None] != new_labels[None, :])] = self.value_to_use_as_inf
+        rows, cols = linear_sum_assignment(costs_matrix)
+        accepted = costs_matrix[rows, cols] < gates[rows]
+        return rows[accepted], cols[accepted]
+
+    def update(self, new_positions:np.ndarray, new_labels:np.ndarray, new_zones:np.ndarray = None, new_items:list = None, elapsed_frames:int = 1, class_names:list = None):
+        """
+        Method to insert the new positions of every class in order to be associated to active traces. All position without valid association will start its own new trace.
+        inputs:
+            new_positions : np.ndarray -> A numpy array with shape (n,2).
+            new_labels : np.ndarray -> Class index of each position, shape (n).
+            new_zones : np.ndarray -> Zone of each position, shape (n), NO_ZONE if none (all NO_ZONE if not given).
+            new_items : list -> Object kept with each position (e.g. its bbox), see tracked_items().
+            elapsed_frames : int -> Frames elapsed since the previous call, the skipped frames are scaled accordingly and the gating distances grow (see elapsed_gate).
+            class_names : list -> Only the traces of these classes are predicted, associated and skip frames (every class if None), so some classes
+                                  can be updated before the positions of the others are filtered with them. The new labels must be of these classes.
+
+        outputs:
+            events : TrackingEvents -> Associated trace ids, and new traces, removed traces and zone transitions by class.
+        """
+        new_positions = np.asarray(new_positions, dtype=np.float32).reshape(-1, 2)
+        new_labels = np.asarray(new_labels, dtype=np.int64).reshape(-1)
+        n = new_positions.shape[0]
+        new_zones = np.full(n, self.NO_ZONE, dtype=np.int64) if new_zones is None else np.asarray(new_zones, dtype=np.int64).reshape(-1)
+        new_items = n * [None] if new_items is None else new_items
+        events = TrackingEvents(np.full(n, -1, dtype=np.int64), self.class_names)
+        if class_names is None:
+            updated = np.ones(len(self), dtype=bool)
+        else:
+            updated_labels = [self.class_index[name] for name in class_names]
+            if not np.all(np.isin(new_labels, updated_labels)):
+                raise ValueError('Positions of classes other than %s' % class_names)
+            updated = np.isin(self.labels, updated_labels)
+
+        # In Kalman mode, every active trace is moved to its predicted position before the association.
+        if self.motion_model == 'kalman' and np.any(updated):
+            self.states[updated], self.covariances[updated] = kalman_predict(self.states[updated], self.covariances[updated],
+                                                                             elapsed_frames, self.process_noise)
+
+        rows = np.zeros(0, dtype=np.int64)
+        cols = np.zeros(0, dtype=np.int64)
+        if len(self) > 0 and n > 0:
+            reference = self.states[:, :2] if self.motion_model == 'kalman' else self.positions
+            gates = np.minimum(elapsed_gate(self.maximum_distances[self.labels], elapsed_frames), self.value_to_use_as_inf - 1)
+            # the traces of the other classes cannot be assigned
+            gates[~updated] = -1
+            rows, cols = self._associate(reference, new_positions, new_labels, gates)
+
+        # Assigned traces.
+        events.ids[cols] = self.ids[rows]
+        previous_zones = self.zones[rows]
+        changed = (previous_zones != new_zones[cols]) & (previous_zones != self.NO_ZONE) & (new_zones[cols] != self.NO_ZONE)
+        for row, col in zip(rows[changed], cols[changed]):
+            events.transitions[self.class_names[self.labels[row]]].append((int(self.ids[row]), int(self.zones[row]), int(new_zones[col])))
+        self.positions[rows] = new_positions[cols]
+        self.zones[rows] = new_zones[cols]
+        for row, col in zip(rows, cols):
+            self.items[row] = new_items[col]
+        if self.motion_model == 'kalman' and rows.shape[0] > 0:
+            kalman_update(self.states, self.covariances, rows, new_positions[cols].astype(np.float64), self.measurement_noise)
+
+        # Non assigned traces skip frames, and are set as inactive after too many.
+        assigned = np.zeros(len(self), dtype=bool)
+        assigned[rows] = True
+        self.skipped[assigned] = 0
+        self.skipped[~assigned & updated] += elapsed_frames
+        inactive = self.skipped > self.maximum_skipped[self.labels]
+        if np.any(inactive):
+            for row in np.flatnonzero(inactive):
+                events.removed[self.class_names[self.labels[row]]].append(int(self.ids[row]))
+            keep = ~inactive
+            self.items = [item for item, kept in zip(self.items, keep) if kept]
+            self.ids, self.labels, self.positions = self.ids[keep], self.labels[keep], self.positions[keep]
+            self.zones, self.skipped = self.zones[keep], self.skipped[keep]
+            if self.motion_model == 'kalman':
+                self.states, self.covariances = self.states[keep], self.covariances[keep]
+
+        # New traces from non assigned positions.
+        unassigned = np.ones(n, dtype=bool)
+        unassigned[cols] = False
+        new_indexes = np.flatnonzero(unassigned)
+        if new_indexes.shape[0] > 0:
+            new_ids = np.arange(self.next_trace_id, self.next_trace_id + new_indexes.shape[0], dtype=np.int64)
+            self.next_trace_id += new_indexes.shape[0]
+            events.ids[new_indexes] = new_ids
+            for index, trace_id in zip(new_indexes, new_ids):
+                events.new[self.class_names[new_labels[index]]].append(int(trace_id))
+            self.items = self.items + [new_items[index] for index in new_indexes]
+            self.positions = np.concatenate([self.positions, new_positions[new_indexes]])
+            self.zones = np.concatenate([self.zones, new_zones[new_indexes]])
+            self.skipped = np.concatenate([self.skipped, np.zeros(new_indexes.shape[0], dtype=np.int64)])
+            if self.motion_model == 'kalman':
+                states = np.zeros((new_indexes.shape[0], 4))
+                states[:, :2] = new_positions[new_indexes]
+                covariances = np.stack([kalman_initial_covariance(self.measurement_noise, self.maximum_distances[label] ** 2)
+                                        for label in new_labels[new_indexes]])
+                self.states = np.concatenate([self.states, states])
+                self.covariances = np.concatenate([self.covariances, covariances])
+            # labels and ids last: other threads checking any_tracked() see the new traces once their state is complete
+            self.labels = np.concatenate([self.labels, new_labels[new_indexes]])
+            self.ids = np.concatenate([self.ids, new_ids])
+
+        return events
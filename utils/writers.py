@@ -0,0 +1,587 @@
+import bisect
+import datetime
+import os
+import threading
+from collections import deque
+
+import cv2
+
+
+class ImageWriter:
+    """
+    Encodes and writes images to disk in a pool of worker threads, so the calling thread
+    does not wait for the encoder and the SD card. Images wait in a bounded queue; when it
+    is full, write() either drops the oldest queued image, drops the new one, or blocks.
+    """
+
+    POLICIES = ('drop_oldest', 'drop_newest', 'block')
+
+    def __init__(self, workers=2, maxsize=32, image_format='jpg', quality=90, policy='drop_oldest', name='images'):
+        """
+        :param workers: int, number of writer threads
+        :param maxsize: int, maximum number of queued images
+        :param image_format: str, file extension ('jpg', 'png' or 'webp'), appended to the paths
+        :param quality: int, 0-100 encoder quality for jpg / webp (png is always lossless)
+        :param policy: str, what to do when the queue is full, one of POLICIES
+        :param name: str, name for the stats
+        """
+        if policy not in self.POLICIES:
+            raise Exception('Unknown image writer policy %s' % policy)
+        self.name = name
+        self.maxsize = maxsize
+        self.image_format = image_format
+        self.policy = policy
+        if image_format == 'jpg':
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif image_format == 'webp':
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        elif image_format == 'png':
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, 1]
+        else:
+            raise Exception('Unknown image format %s' % image_format)
+
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run, name='%s-writer-%d' % (name, i), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, path, image):
+        """
+        Queues an image to be written (the image must not be modified afterwards)
+        :param path: str, file path without extension
+        :param image: BGR numpy image
+        :return: bool, False if the image was dropped
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    return False
+                elif self.policy == 'drop_oldest':
+                    self.items.popleft()
+                    self.dropped += 1
+                else:
+                    self.cond.wait_for(lambda: len(self.items) < self.maxsize or self.closed)
+                    if self.closed:
+                        return False
+            self.items.append(('%s.%s' % (path, self.image_format), image))
+            self.queued += 1
+            self.cond.notify_all()
+            return True
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.items or self.closed)
+                if not self.items:
+                    return
+                path, image = self.items.popleft()
+                self.cond.notify_all()
+            try:
+                ok = cv2.imwrite(path, image, self.params)
+            except cv2.error as e:
+                print('Could not write %s: %s' % (path, e))
+                ok = False
+            with self.cond:
+                if ok:
+                    self.written += 1
+                else:
+                    self.failed += 1
+
+    def close(self):
+        """
+        Writes the images still queued and stops the workers
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'name': self.name,
+                'queued': self.queued,
+                'pending': len(self.items),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+            }
+
+
+class SegmentedVideoRecorder:
+    """
+    Records the frames of one camera into video files of segment_seconds each, encoded in a
+    background thread. A sidecar index (<name>.index.csv, one line per frame: frame number,
+    capture timestamp, segment file, frame offset in the segment) lets RecordingIndex pull single
+    frames out of the segments. Frames dropped from the queue, or not recorded because the segment
+    could not be opened, are in the index too, with 'dropped' or 'failed' as segment and offset -1.
+    """
+
+    def __init__(self, directory, name, fps=15.0, segment_seconds=300, fourcc='mp4v', extension='mp4',
+                 gst_pipeline=None, maxsize=64):
+        """
+        :param directory: str, folder for the segments and the index (created if missing, one recording per folder)
+        :param name: str, camera name, prefix of the files
+        :param fps: float, nominal frame rate stored in the segments (the index keeps the real timestamps)
+        :param segment_seconds: float, length of each segment in capture time
+        :param fourcc: str, four character code of the OpenCV encoder
+        :param extension: str, extension of the segment files
+        :param gst_pipeline: str, GStreamer pipeline with a %s for the file path (e.g. with a hardware encoder),
+                             used instead of the OpenCV encoder if given
+        :param maxsize: int, maximum number of frames waiting to be encoded (the oldest ones are dropped)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.fps = fps
+        self.segment_seconds = segment_seconds
+        self.fourcc = fourcc
+        self.extension = extension
+        self.gst_pipeline = gst_pipeline
+        self.maxsize = maxsize
+
+        self.writer = None
+        self.segment_file = None
+        self.segment_start = None
+        self.segment_frames = 0
+        self.frame_number = 0           # number of the next frame given to write()
+        self.index_path = os.path.join(directory, '%s.index.csv' % name)
+        self.index = open(self.index_path, 'wt')
+        self.index.write('frame,timestamp,segment,offset\n')
+
+        self.items = deque()            # (frame number, image, timestamp) waiting to be recorded
+        self.lost = deque()             # (frame number, timestamp) dropped from the queue, for the index
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # counters
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.segments = 0
+
+        self.thread = threading.Thread(target=self._run, name='%s-recorder' % name, daemon=True)
+        self.thread.start()
+
+    def write(self, image, timestamp):
+        """
+        Queues a frame to be recorded (the image must not be modified afterwards)
+        :param image: BGR numpy image
+        :param timestamp: float, capture timestamp
+        :return: bool, False if the recorder is closed
+        """
+        with self.cond:
+            if self.closed:
+                return False
+            if len(self.items) >= self.maxsize:
+                frame_number, _, dropped_timestamp = self.items.popleft()
+                self.lost.append((frame_number, dropped_timestamp))
+                self.dropped += 1
+            self.items.append((self.frame_number, image, timestamp))
+            self.frame_number += 1
+            self.queued += 1
+            self.cond.notify_all()
+            return True
+
+    def _open_segment(self, image, timestamp):
+        height, width = image.shape[:2]
+        stamp = datetime.datetime.fromtimestamp(timestamp).strftime("%Y.%m.%d.%H.%M.%S")
+        self.segment_file = '%s.%s.%s' % (self.name, stamp, self.extension)
+        path = os.path.join(self.directory, self.segment_file)
+        if self.gst_pipeline is not None:
+            self.writer = cv2.VideoWriter(self.gst_pipeline % path, cv2.CAP_GSTREAMER, 0, self.fps, (width, height))
+        else:
+            self.writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+        if not self.writer.isOpened():
+            print('Could not open video segment %s' % path)
+        self.segment_start = timestamp
+        self.segment_frames = 0
+        self.segments += 1
+
+    def _close_segment(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+            self.index.flush()
+
+    def _record(self, frame_number, image, timestamp):
+        """
+        :return: bool, False if the frame could not be recorded
+        """
+        if self.writer is None or timestamp - self.segment_start >= self.segment_seconds:
+            self._close_segment()
+            self._open_segment(image, timestamp)
+        if not self.writer.isOpened():
+            # until the next segment: RecordingIndex must not point into it
+            self.index.write('%d,%.6f,failed,-1\n' % (frame_number, timestamp))
+            return False
+        self.writer.write(image)
+        self.index.write('%d,%.6f,%s,%d\n' % (frame_number, timestamp, self.segment_file, self.segment_frames))
+        self.segment_frames += 1
+        return True
+
+    def _write_lost(self, lost):
+        for frame_number, timestamp in lost:
+            self.index.write('%d,%.6f,dropped,-1\n' % (frame_number, timestamp))
+
+    def _run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.items or self.closed)
+                # the frames dropped meanwhile are older than the ones still queued
+                lost = list(self.lost)
+                self.lost.clear()
+                item = self.items.popleft() if self.items else None
+            self._write_lost(lost)
+            if item is None:
+                break
+            recorded = self._record(*item)
+            with self.cond:
+                if recorded:
+                    self.written += 1
+                else:
+                    self.failed += 1
+        self._close_segment()
+        self.index.close()
+
+    def close(self):
+        """
+        Records the frames still queued and closes the last segment and the index
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'name': self.name,
+                'queued': self.queued,
+                'pending': len(self.items),
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'segments': self.segments,
+            }
+
+
+class RecordingIndex:
+    """
+    Sidecar index of a SegmentedVideoRecorder, to pull single frames out of the segments
+    (e.g. for labeling) by frame number or by capture timestamp. Frames that were dropped or
+    failed are listed in `lost` (frame number -> 'dropped' or 'failed'), not in the recording.
+    """
+
+    def __init__(self, index_path):
+        """
+        :param index_path: str, <name>.index.csv file
+        """
+        self.directory = os.path.dirname(index_path)
+        self.frames = []
+        self.timestamps = []
+        self.locations = []
+        self.lost = {}
+        with open(index_path, 'rt') as f:
+            next(f)
+            for line in f:
+                frame, timestamp, segment, offset = line.rstrip('\n').split(',')
+                if int(offset) < 0:
+                    self.lost[int(frame)] = segment
+                    continue
+                self.frames.append(int(frame))
+                self.timestamps.append(float(timestamp))
+                self.locations.append((segment, int(offset)))
+        self.capture = None
+        self.capture_segment = None
+        self.capture_position = None
+
+    def __len__(self):
+        return len(self.frames)
+
+    def locate(self, frame_number):
+        """
+        :param frame_number: int, frame number of the recording
+        :return: tuple, (segment file, frame offset in the segment)
+        """
+        i = bisect.bisect_left(self.frames, frame_number)
+        if i >= len(self.frames) or self.frames[i] != frame_number:
+            if frame_number in self.lost:
+                raise Exception('Frame %d was not recorded (%s)' % (frame_number, self.lost[frame_number]))
+            raise Exception('Frame %d is not in the recording' % frame_number)
+        return self.locations[i]
+
+    def nearest_frame(self, timestamp):
+        """
+        :param timestamp: float, capture timestamp
+        :return: int, frame number of the frame captured nearest to timestamp
+        """
+        i = bisect.bisect_left(self.timestamps, timestamp)
+        if i > 0 and (i == len(self.timestamps) or timestamp - self.timestamps[i - 1] <= self.timestamps[i] - timestamp):
+            i -= 1
+        return self.frames[i]
+
+    def read(self, frame_number):
+        """
+        :param frame_number: int, frame number of the recording
+        :return: BGR numpy frame, or None if it cannot be decoded
+        """
+        segment, offset = self.locate(frame_number)
+        if self.capture_segment != segment:
+            if self.capture is not None:
+                self.capture.release()
+            self.capture = cv2.VideoCapture(os.path.join(self.directory, segment))
+            self.capture_segment = segment
+            self.capture_position = 0
+        # seek only when not reading sequentially
+        if self.capture_position != offset:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, offset)
+        ok, frame = self.capture.read()
+        self.capture_position = offset + 1
+        return frame if ok else None
+
+    def read_at(self, timestamp):
+        """
+        :param timestamp: float, capture timestamp
+        :return: BGR numpy frame captured nearest to timestamp
+        """
+        return self.read(self.nearest_frame(timestamp))
+
+    def release(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+            self.capture_segment = None
+
+
+class EventClipRecorder:
+    """
+    Keeps the last pre_seconds of frames of one camera in memory and, when an event is
+    triggered (e.g. a warning), writes a clip with those frames and the ones of the next
+    post_seconds in a background thread. Retriggering during a clip extends it.
+    Memory is capped at max_bytes: the oldest buffered frames are dropped beyond it, and
+    frames can be kept as JPEG bytes to fit more seconds in the same memory. add() and trigger()
+    only queue the frames and the events: the frames are encoded in another background thread.
+    """
+
+    def __init__(self, directory, name, pre_seconds=5.0, post_seconds=5.0, max_bytes=64 * 1024 * 1024,
+                 jpeg_quality=None, fps=15.0, fourcc='mp4v', extension='mp4', maxsize=8):
+        """
+        :param directory: str, folder for the clips (created if missing)
+        :param name: str, camera name, prefix of the clips
+        :param pre_seconds: float, seconds of frames kept before the event
+        :param post_seconds: float, seconds of frames recorded after the (last) trigger
+        :param max_bytes: int, memory cap of the buffered frames (pre-event buffer plus frames waiting to be written)
+        :param jpeg_quality: int, keep the frames as JPEG bytes of this quality (None keeps the raw frames)
+        :param fps: float, nominal frame rate of the clips
+        :param fourcc: str, four character code of the OpenCV encoder
+        :param extension: str, extension of the clip files
+        :param maxsize: int, maximum number of frames waiting to be encoded (the oldest ones are dropped)
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_bytes = max_bytes
+        self.jpeg_quality = jpeg_quality
+        self.fps = fps
+        self.fourcc = fourcc
+        self.extension = extension
+        self.maxsize = maxsize
+
+        self.incoming = deque()         # ('frame', timestamp, image) and ('trigger', timestamp, None), in call order
+        self.incoming_frames = 0
+        self.ring = deque()             # (timestamp, payload, size), oldest first
+        self.ring_bytes = 0
+        self.pending = deque()          # (clip path, timestamp, payload, size) waiting to be written, None closes a clip
+        self.pending_bytes = 0
+        self.event_end = None           # capture time when the current clip ends (None if no clip is being recorded)
+        self.clip_path = None
+        self.cond = threading.Condition()
+        self.closing = False            # no more frames or events are accepted
+        self.closed = False             # every frame and event accepted has been buffered
+
+        # counters
+        self.buffered = 0
+        self.dropped = 0
+        self.clips = 0
+        self.written = 0
+
+        self.encoder_thread = threading.Thread(target=self._encode_run, name='%s-clips-encoder' % name, daemon=True)
+        self.encoder_thread.start()
+        self.thread = threading.Thread(target=self._run, name='%s-clips' % name, daemon=True)
+        self.thread.start()
+
+    def _trim(self):
+        # drop the oldest frames beyond the memory cap: first from the pre-event buffer, then from the pending ones
+        while self.ring and self.ring_bytes + self.pending_bytes > self.max_bytes:
+            self.ring_bytes -= self.ring.popleft()[2]
+            self.dropped += 1
+        while self.pending_bytes > self.max_bytes:
+            for i, item in enumerate(self.pending):
+                if item is not None:
+                    del self.pending[i]
+                    self.pending_bytes -= item[3]
+                    self.dropped += 1
+                    break
+
+    def add(self, image, timestamp):
+        """
+        Queues a new frame (the image must not be modified afterwards)
+        :param image: BGR numpy image
+        :param timestamp: float, capture timestamp
+        """
+        with self.cond:
+            if self.closing:
+                return
+            if self.incoming_frames >= self.maxsize:
+                # the oldest frame waiting goes, the events stay
+                for i, item in enumerate(self.incoming):
+                    if item[0] == 'frame':
+                        del self.incoming[i]
+                        break
+                self.incoming_frames -= 1
+                self.dropped += 1
+            self.incoming.append(('frame', timestamp, image))
+            self.incoming_frames += 1
+            self.buffered += 1
+            self.cond.notify_all()
+
+    def trigger(self, timestamp):
+        """
+        Starts a clip with the buffered frames, or extends the current one
+        :param timestamp: float, capture timestamp of the event
+        """
+        with self.cond:
+            if self.closing:
+                return
+            self.incoming.append(('trigger', timestamp, None))
+            self.cond.notify_all()
+
+    def _buffer(self, payload, size, timestamp):
+        if self.event_end is not None:
+            if timestamp <= self.event_end:
+                self.pending.append((self.clip_path, timestamp, payload, size))
+                self.pending_bytes += size
+                self.cond.notify_all()
+            else:
+                self._end_clip()
+        self.ring.append((timestamp, payload, size))
+        self.ring_bytes += size
+        while self.ring and self.ring[0][0] < timestamp - self.pre_seconds:
+            self.ring_bytes -= self.ring.popleft()[2]
+        self._trim()
+
+    def _end_clip(self):
+        self.pending.append(None)
+        self.event_end = None
+        self.clip_path = None
+        self.cond.notify_all()
+
+    def _trigger(self, timestamp):
+        if self.event_end is None:
+            stamp = datetime.datetime.fromtimestamp(timestamp).strftime("%Y.%m.%d.%H.%M.%S")
+            self.clip_path = os.path.join(self.directory, '%s.event.%s.%s' % (self.name, stamp, self.extension))
+            self.clips += 1
+            # the frames of the pre-event buffer go to the clip (their payloads are shared, not copied)
+            for frame_time, payload, size in self.ring:
+                if frame_time >= timestamp - self.pre_seconds:
+                    self.pending.append((self.clip_path, frame_time, payload, size))
+                    self.pending_bytes += size
+            self._trim()
+            self.cond.notify_all()
+        self.event_end = timestamp + self.post_seconds
+
+    def _encode_run(self):
+        # frames and events are handled in call order, so a trigger sees the frames added before it
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.incoming or self.closing)
+                if not self.incoming:
+                    break
+                kind, timestamp, image = self.incoming.popleft()
+                if kind == 'trigger':
+                    self._trigger(timestamp)
+                    continue
+                self.incoming_frames -= 1
+            if self.jpeg_quality is not None:
+                ok, payload = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                if not ok:
+                    with self.cond:
+                        self.dropped += 1
+                    continue
+            else:
+                payload = image
+            with self.cond:
+                self._buffer(payload, payload.nbytes, timestamp)
+        with self.cond:
+            if self.event_end is not None:
+                self._end_clip()
+            self.closed = True
+            self.cond.notify_all()
+
+    def _run(self):
+        writer = None
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.pending or self.closed)
+                if not self.pending:
+                    break
+                item = self.pending.popleft()
+                if item is not None:
+                    self.pending_bytes -= item[3]
+            if item is None:
+                if writer is not None:
+                    writer.release()
+                    writer = None
+                continue
+            path, _, payload, _ = item
+            image = cv2.imdecode(payload, cv2.IMREAD_COLOR) if self.jpeg_quality is not None else payload
+            if writer is None:
+                height, width = image.shape[:2]
+                writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (width, height))
+                if not writer.isOpened():
+                    print('Could not open event clip %s' % path)
+            writer.write(image)
+            with self.cond:
+                self.written += 1
+        if writer is not None:
+            writer.release()
+
+    def close(self):
+        """
+        Buffers the frames still queued, ends the current clip, writes the frames still pending and stops the threads
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.encoder_thread.join()
+        self.thread.join()
+
+    def stats(self):
+        with self.cond:
+            return {
+                'name': self.name,
+                'queued': self.buffered,
+                'written': self.written,
+                'dropped': self.dropped,
+                'clips': self.clips,
+                'memory': self.ring_bytes + self.pending_bytes,
+            }